@@ -0,0 +1,244 @@
+import json
+import os
+import secrets
+import struct
+import threading
+import zlib
+from datetime import date, datetime, timedelta
+
+from db import (
+    db_archive_messages,
+    db_find_idle_conversations,
+    db_load_archive_segments,
+    db_load_conversation_messages,
+    db_load_daily_activity,
+    db_load_settings,
+    db_oldest_message_at,
+    db_restore_messages,
+    db_take_archive_entry,
+    get_db_path,
+    now_timestamp,
+    write_transaction,
+)
+
+# Idle conversations are checked for this often by each instance; admins can
+# also start a sweep from the Settings page.
+ARCHIVE_SWEEP_SECONDS = float(os.environ.get("CHATBOT_ARCHIVE_SWEEP_HOURS", "6")) * 3600
+ARCHIVE_BATCH_SIZE = 200
+# A segment takes appends until it reaches this size or this age, then a new
+# one is started. Each process writes segments of its own, so instances that
+# share data/ never append to the same file.
+SEGMENT_MAX_BYTES = int(os.environ.get("CHATBOT_ARCHIVE_SEGMENT_MB", "64")) * 1024 * 1024
+SEGMENT_OPEN_SECONDS = 24 * 3600
+SEGMENT_SUFFIX = ".seg"
+# Each record is the magic, the payload length, then the zlib-compressed JSON
+# of one conversation's messages, so a segment can be read without the index.
+RECORD_MAGIC = b"CHA1"
+RECORD_HEADER = struct.Struct(">4sI")
+
+# Archived chats drop out of search and the activity feeds, so an admin
+# turns archiving on.
+ARCHIVE_DEFAULTS = {
+    "archive_enabled": False,
+    "archive_after_days": 180,
+}
+
+class ArchiveError(Exception):
+    pass
+
+def get_archive_dir() -> str:
+    archive_dir = os.path.join(os.path.dirname(get_db_path()), "archive")
+    os.makedirs(archive_dir, exist_ok=True)
+    return archive_dir
+
+def segment_path(segment: str) -> str:
+    return os.path.join(get_archive_dir(), segment)
+
+def segment_created_at(segment: str) -> datetime | None:
+    try:
+        return datetime.strptime(segment.split("-", 1)[0], "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+
+def encode_record(conversation_id: str, messages: list) -> bytes:
+    payload = zlib.compress(
+        json.dumps({"conversation_id": conversation_id, "messages": messages}).encode("utf-8")
+    )
+    return RECORD_HEADER.pack(RECORD_MAGIC, len(payload)) + payload
+
+def read_record(entry: dict) -> list:
+    try:
+        with open(segment_path(entry["segment"]), "rb") as handle:
+            handle.seek(entry["byte_offset"])
+            data = handle.read(entry["byte_length"])
+    except OSError as exc:
+        raise ArchiveError(f"Archive segment {entry['segment']} cannot be read: {exc}") from exc
+    if len(data) < RECORD_HEADER.size:
+        raise ArchiveError(f"Archive segment {entry['segment']} is truncated.")
+    magic, length = RECORD_HEADER.unpack_from(data)
+    if magic != RECORD_MAGIC or length != len(data) - RECORD_HEADER.size:
+        raise ArchiveError(f"Archive segment {entry['segment']} has no record at {entry['byte_offset']}.")
+    try:
+        record = json.loads(zlib.decompress(data[RECORD_HEADER.size:]))
+    except (zlib.error, ValueError) as exc:
+        raise ArchiveError(f"Archive segment {entry['segment']} is damaged: {exc}") from exc
+    if record["conversation_id"] != entry["conversation_id"]:
+        raise ArchiveError(f"Archive segment {entry['segment']} holds another conversation there.")
+    return record["messages"]
+
+class SegmentWriter:
+    def __init__(self):
+        self._segment = None
+        self._lock = threading.Lock()
+
+    def _needs_new_segment(self) -> bool:
+        if self._segment is None:
+            return True
+        created_at = segment_created_at(self._segment)
+        if (datetime.now() - created_at).total_seconds() >= SEGMENT_OPEN_SECONDS:
+            return True
+        try:
+            return os.path.getsize(segment_path(self._segment)) >= SEGMENT_MAX_BYTES
+        except OSError:
+            return False
+
+    # Returns (segment, byte offset). The record is on disk before this
+    # returns, so the messages can be deleted from the database afterwards.
+    def append(self, record: bytes) -> tuple:
+        with self._lock:
+            if self._needs_new_segment():
+                self._segment = f"{datetime.now():%Y%m%d%H%M%S}-{secrets.token_hex(4)}{SEGMENT_SUFFIX}"
+            with open(segment_path(self._segment), "ab") as handle:
+                offset = handle.seek(0, os.SEEK_END)
+                handle.write(record)
+                handle.flush()
+                os.fsync(handle.fileno())
+            return self._segment, offset
+
+segment_writer = SegmentWriter()
+
+# Moves one conversation's messages into the current segment. The record is
+# written before the write lock is taken; if the conversation gained a message
+# in the meantime it is left as it was and the record is simply never used.
+def archive_conversation(conversation_id: str, cutoff: str) -> int:
+    messages = db_load_conversation_messages(conversation_id)
+    if not messages or messages[-1]["created_at"] >= cutoff:
+        return 0
+    record = encode_record(conversation_id, messages)
+    segment, offset = segment_writer.append(record)
+    archived = db_archive_messages(
+        {
+            "conversation_id": conversation_id,
+            "segment": segment,
+            "byte_offset": offset,
+            "byte_length": len(record),
+            "message_count": len(messages),
+            "last_message_at": messages[-1]["created_at"],
+            "archived_at": now_timestamp(),
+        },
+        messages[-1]["id"],
+    )
+    return len(messages) if archived else 0
+
+# Puts an archived conversation's messages back under their original ids and
+# returns how many there were; 0 when it was not archived (any more). If the
+# record cannot be read the conversation stays archived.
+def restore_conversation(conversation_id: str) -> int:
+    with write_transaction():
+        entry = db_take_archive_entry(conversation_id, now_timestamp())
+        if entry is None:
+            return 0
+        messages = read_record(entry)
+        db_restore_messages(conversation_id, messages)
+    return len(messages)
+
+# Deletes segments whose every record has been restored or whose conversations
+# were deleted. Only segments past their open period qualify, so a file some
+# instance may still append to is never removed.
+def reclaim_segments() -> int:
+    referenced = db_load_archive_segments()
+    closed_before = datetime.now() - timedelta(seconds=2 * SEGMENT_OPEN_SECONDS)
+    removed = 0
+    for segment in os.listdir(get_archive_dir()):
+        created_at = segment_created_at(segment)
+        if (
+            not segment.endswith(SEGMENT_SUFFIX)
+            or segment in referenced
+            or created_at is None
+            or created_at >= closed_before
+        ):
+            continue
+        try:
+            os.unlink(segment_path(segment))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+def archive_disk_bytes() -> int:
+    archive_dir = get_archive_dir()
+    return sum(
+        os.path.getsize(os.path.join(archive_dir, segment))
+        for segment in os.listdir(archive_dir)
+        if segment.endswith(SEGMENT_SUFFIX)
+    )
+
+def archive_idle_conversations(after_days: int) -> int:
+    cutoff = (datetime.now() - timedelta(days=after_days)).strftime("%Y-%m-%d %H:%M:%S")
+    oldest = db_oldest_message_at()
+    archived = 0
+    if oldest is not None and oldest < cutoff:
+        # Daily activity for past days is computed from messages the first
+        # time a dashboard asks and kept from then on. Filling it in for the
+        # archived days first keeps them in the dashboard history.
+        db_load_daily_activity(oldest[:10], cutoff[:10], date.today().isoformat())
+        while True:
+            conversation_ids = db_find_idle_conversations(cutoff, ARCHIVE_BATCH_SIZE)
+            moved = [archive_conversation(conversation_id, cutoff) for conversation_id in conversation_ids]
+            archived += sum(1 for count in moved if count)
+            if len(conversation_ids) < ARCHIVE_BATCH_SIZE or not any(moved):
+                break
+    reclaim_segments()
+    return archived
+
+# Sweeps for idle conversations on a background thread: once when the app
+# starts, then every ARCHIVE_SWEEP_SECONDS or when woken from the admin page.
+class Archiver:
+    def __init__(self, interval: float = ARCHIVE_SWEEP_SECONDS):
+        self.interval = interval
+        # finished_at, archived and error of the most recent sweep.
+        self.last_sweep = None
+        self._wake = False
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._changed:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="archiver", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self.start()
+        with self._changed:
+            self._wake = True
+            self._changed.notify()
+
+    def sweep(self):
+        try:
+            settings = db_load_settings(ARCHIVE_DEFAULTS)
+            if not settings["archive_enabled"]:
+                return
+            archived = archive_idle_conversations(int(settings["archive_after_days"]))
+            self.last_sweep = {"finished_at": now_timestamp(), "archived": archived, "error": None}
+        except Exception as exc:
+            self.last_sweep = {"finished_at": now_timestamp(), "archived": 0, "error": str(exc)}
+
+    def _run(self):
+        while True:
+            self.sweep()
+            with self._changed:
+                self._changed.wait_for(lambda: self._wake, timeout=self.interval)
+                self._wake = False
+
+archiver = Archiver()
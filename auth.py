@@ -0,0 +1,247 @@
+import base64
+import hashlib
+import hmac
+import math
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db import (
+    db_end_session,
+    db_get_or_create_setting,
+    db_get_user,
+    db_session_ended,
+    db_upgrade_password_hash,
+)
+from metrics import observe
+
+PASSWORD_ITERATIONS = 120000
+# PBKDF2 takes tens of milliseconds of CPU per attempt. hashlib releases the
+# GIL while hashing, so a few workers keep a burst of sign-ins from queueing
+# behind each other. They cannot take every core from sessions that are
+# chatting, and past the queue limit a sign-in is turned away, not queued.
+AUTH_WORKERS = int(os.environ.get("CHATBOT_AUTH_WORKERS", "2"))
+AUTH_QUEUE_LIMIT = int(os.environ.get("CHATBOT_AUTH_QUEUE_LIMIT", "32"))
+# Failed attempts an account gets before it has to wait. Each further failure
+# doubles the wait, up to the maximum. Counted per instance.
+LOGIN_FREE_ATTEMPTS = int(os.environ.get("CHATBOT_LOGIN_FREE_ATTEMPTS", "5"))
+LOGIN_LOCKOUT_MAX_SECONDS = float(os.environ.get("CHATBOT_LOGIN_LOCKOUT_MAX_SECONDS", "900"))
+# A session token restores a signed-in session after a reload without the
+# password. Each restore issues a fresh one, so only idle sessions expire.
+SESSION_TTL_HOURS = float(os.environ.get("CHATBOT_SESSION_TTL_HOURS", "12"))
+# Shared by every instance. Taken from the environment when set, otherwise
+# generated once and kept in app_settings.
+SESSION_SECRET = os.environ.get("CHATBOT_SESSION_SECRET", "")
+
+class SignInBusy(Exception):
+    pass
+
+class SignInThrottled(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many failed attempts. Try again in {math.ceil(retry_after)} s.")
+        self.retry_after = retry_after
+
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PASSWORD_ITERATIONS)
+    return f"pbkdf2${base64.b64encode(salt).decode('utf-8')}${base64.b64encode(digest).decode('utf-8')}"
+
+# Hashes from before salting are plain unsalted SHA-256 hex digests.
+def is_legacy_hash(password_hash: str) -> bool:
+    return not password_hash.startswith("pbkdf2$")
+
+def verify_password(password: str, password_hash: str) -> bool:
+    if not password_hash:
+        return False
+    if is_legacy_hash(password_hash):
+        candidate = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        return secrets.compare_digest(candidate, password_hash)
+    try:
+        _, salt_b64, digest_b64 = password_hash.split("$", 2)
+    except ValueError:
+        return False
+    salt = base64.b64decode(salt_b64)
+    expected = base64.b64decode(digest_b64)
+    candidate = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PASSWORD_ITERATIONS)
+    return secrets.compare_digest(candidate, expected)
+
+# Runs on an auth worker. A legacy hash that matches is replaced by a salted
+# one in the same job, so the upgrade costs the script thread nothing extra.
+def check_password(password: str, password_hash: str) -> tuple:
+    if not verify_password(password, password_hash):
+        return False, None
+    if password_hash and is_legacy_hash(password_hash):
+        return True, hash_password(password)
+    return True, None
+
+_dummy_hash = None
+
+def dummy_password_hash() -> str:
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(secrets.token_urlsafe(32))
+    return _dummy_hash
+
+class LoginThrottle:
+    def __init__(
+        self,
+        free_attempts: int = LOGIN_FREE_ATTEMPTS,
+        max_seconds: float = LOGIN_LOCKOUT_MAX_SECONDS,
+    ):
+        self.free_attempts = free_attempts
+        self.max_seconds = max_seconds
+        # user id -> (failures, time of the last one, locked until)
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, user_id: str) -> float:
+        with self._lock:
+            entry = self._failures.get(user_id)
+        if entry is None:
+            return 0.0
+        return max(entry[2] - time.monotonic(), 0.0)
+
+    def failed(self, user_id: str):
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.get(user_id, (0, now, now))[0] + 1
+            locked_until = now
+            if failures > self.free_attempts:
+                locked_until += min(2 ** (failures - self.free_attempts - 1), self.max_seconds)
+            self._failures[user_id] = (failures, now, locked_until)
+            # Attempts against many different ids must not grow this without
+            # bound; an account quiet for the longest lockout starts over.
+            if len(self._failures) > 1024:
+                forget_before = now - self.max_seconds
+                for key, (_, last_failure, _) in list(self._failures.items()):
+                    if last_failure < forget_before:
+                        del self._failures[key]
+
+    def succeeded(self, user_id: str):
+        with self._lock:
+            self._failures.pop(user_id, None)
+
+class Authenticator:
+    def __init__(self, workers: int = AUTH_WORKERS, queue_limit: int = AUTH_QUEUE_LIMIT):
+        self.queue_limit = queue_limit
+        self.throttle = LoginThrottle()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    # Returns the user row when the password matches and None otherwise.
+    # Throttled accounts are refused before any hashing, so guessing at one
+    # account cannot use up the workers.
+    def authenticate(self, user_id: str, password: str) -> dict | None:
+        retry_after = self.throttle.retry_after(user_id)
+        if retry_after > 0:
+            raise SignInThrottled(retry_after)
+        user = db_get_user(user_id)
+        with self._lock:
+            if self._pending >= self.queue_limit:
+                raise SignInBusy("Too many people are signing in right now. Try again in a few seconds.")
+            self._pending += 1
+        queued_at = time.perf_counter()
+        # An unknown account is checked against a hash that matches nothing,
+        # so it takes as long to turn away as a wrong password.
+        password_hash = user["password_hash"] if user else dummy_password_hash()
+        future = self._executor.submit(check_password, password, password_hash)
+        future.add_done_callback(self._finished)
+        matched, upgraded_hash = future.result()
+        observe("auth_hash", time.perf_counter() - queued_at)
+        if not user or not matched:
+            self.throttle.failed(user_id)
+            return None
+        self.throttle.succeeded(user_id)
+        if upgraded_hash is not None:
+            db_upgrade_password_hash(user_id, user["password_hash"], upgraded_hash)
+            user["password_hash"] = upgraded_hash
+        return user
+
+authenticator = Authenticator()
+
+_secret = None
+_secret_lock = threading.Lock()
+
+def session_secret() -> bytes:
+    global _secret
+    if _secret is None:
+        with _secret_lock:
+            if _secret is None:
+                value = SESSION_SECRET or db_get_or_create_setting(
+                    "session_secret", secrets.token_urlsafe(32)
+                )
+                _secret = value.encode("utf-8")
+    return _secret
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def unb64url(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+# The signature also covers the password hash and the session version. A
+# password change or signing out everywhere then invalidates every token
+# issued before it, without keeping a list of tokens. Signing out of one
+# browser ends just its session id.
+def token_signature(user: dict, expires: int, session_id: str) -> bytes:
+    message = "\n".join(
+        [
+            user["id"],
+            str(expires),
+            session_id,
+            user["password_hash"],
+            str(user.get("session_version") or 0),
+        ]
+    )
+    return hmac.new(session_secret(), message.encode("utf-8"), hashlib.sha256).digest()
+
+# A restored session keeps its id, so signing out ends it whichever of its
+# tokens the browser still holds.
+def issue_session_token(user: dict, session_id: str | None = None) -> str:
+    expires = int(time.time() + SESSION_TTL_HOURS * 3600)
+    session_id = session_id or secrets.token_urlsafe(12)
+    return ".".join(
+        [
+            b64url(user["id"].encode("utf-8")),
+            str(expires),
+            session_id,
+            b64url(token_signature(user, expires, session_id)),
+        ]
+    )
+
+# (user id, expires, session id, signature), or None when the token is malformed.
+def parse_session_token(token: str) -> tuple | None:
+    try:
+        user_part, expires_part, session_id, signature_part = token.split(".")
+        return unb64url(user_part).decode("utf-8"), int(expires_part), session_id, unb64url(signature_part)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+# Returns the signed-in user for a valid, unexpired token and None for
+# anything else.
+def verify_session_token(token: str) -> dict | None:
+    parsed = parse_session_token(token)
+    if parsed is None:
+        return None
+    user_id, expires, session_id, signature = parsed
+    if expires < time.time():
+        return None
+    user = db_get_user(user_id)
+    if not user or not hmac.compare_digest(token_signature(user, expires, session_id), signature):
+        return None
+    if db_session_ended(session_id):
+        return None
+    return user
+
+def end_session(token: str):
+    parsed = parse_session_token(token)
+    if parsed is not None:
+        _, expires, session_id, _ = parsed
+        db_end_session(session_id, expires)
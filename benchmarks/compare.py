@@ -0,0 +1,45 @@
+import argparse
+import json
+import sys
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare two benchmark results from run.py.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="flag median slowdowns above this fraction"
+    )
+    return parser.parse_args()
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
+
+def main():
+    args = parse_args()
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    if baseline["meta"]["scale"] != candidate["meta"]["scale"]:
+        print("warning: the runs used databases of different sizes", file=sys.stderr)
+    print(
+        f"{'case':<48} {'baseline':>10} {'candidate':>10} {'change':>8}"
+        f"   {baseline['meta']['commit'] or '?':.8} -> {candidate['meta']['commit'] or '?':.8}"
+    )
+    regressions = []
+    for name, result in candidate["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<48} {'—':>10} {result['median_ms']:>10.2f} {'new':>8}")
+            continue
+        change = result["median_ms"] / before["median_ms"] - 1 if before["median_ms"] else 0.0
+        flag = ""
+        if change > args.threshold:
+            regressions.append(name)
+            flag = "  slower"
+        print(
+            f"{name:<48} {before['median_ms']:>10.2f} {result['median_ms']:>10.2f} {change:>+8.0%}{flag}"
+        )
+    # A non-zero exit lets CI fail on a regression.
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
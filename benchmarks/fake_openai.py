@@ -0,0 +1,169 @@
+import argparse
+import base64
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILLER = (
+    "Here is a draft that keeps the tone friendly and the message short so the "
+    "audience sees the offer first and the details second"
+).split()
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft-ms", type=float, default=400, help="delay before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--jitter", type=float, default=0.25, help="+/- fraction applied to each delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="streams cut off half way")
+    parser.add_argument("--image-seconds", type=float, default=15)
+
+def jittered(value: float, config) -> float:
+    return max(value * random.uniform(1 - config.jitter, 1 + config.jitter), 0.0)
+
+def png(width: int, height: int, rgb: tuple) -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rows = b"".join(b"\x00" + bytes(rgb) * width for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+class Stats:
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+# Speaks just enough of the OpenAI HTTP API for the app: streamed chat
+# completions (with the usage chunk) and image generation.
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, payload: dict):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        config = self.server.config
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        kind = "chat" if self.path.endswith("/chat/completions") else "image"
+        if not self.path.endswith(("/chat/completions", "/images/generations")):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+            return
+        self.server.stats.add(kind)
+        if random.random() < config.error_rate:
+            self.server.stats.add(f"{kind}_error")
+            self.send_json(
+                config.error_status,
+                {"error": {"message": "Injected failure", "type": "server_error", "code": None}},
+            )
+            return
+        if kind == "chat":
+            self.stream_chat(body, config)
+        else:
+            self.generate_image(body, config)
+
+    def stream_chat(self, body: dict, config):
+        prompt = body["messages"][-1]["content"] if body.get("messages") else ""
+        count = max(int(jittered(config.reply_tokens, config)), 1)
+        words = (prompt.split()[:8] + FILLER * (count // len(FILLER) + 1))[:count]
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model")}
+        time.sleep(jittered(config.ttft_ms / 1000, config))
+        if not body.get("stream"):
+            self.send_json(
+                200,
+                {
+                    **chunk,
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": count, "total_tokens": len(prompt) // 4 + count},
+                },
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        cut_at = count // 2 if random.random() < config.disconnect_rate else None
+        for index, word in enumerate(words):
+            if index == cut_at:
+                self.server.stats.add("chat_disconnect")
+                self.close_connection = True
+                return
+            self.send_event({**chunk, "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]})
+            time.sleep(jittered(1 / config.tokens_per_second, config))
+        self.send_event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if body.get("stream_options", {}).get("include_usage"):
+            self.send_event(
+                {**chunk, "choices": [], "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": count, "total_tokens": len(prompt) // 4 + count}}
+            )
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def generate_image(self, body: dict, config):
+        time.sleep(jittered(config.image_seconds, config))
+        image = png(64, 64, tuple(random.randrange(256) for _ in range(3)))
+        self.send_json(
+            200,
+            {
+                "created": int(time.time()),
+                "data": [{"b64_json": base64.b64encode(image).decode("ascii")}],
+                "usage": {"input_tokens": len(body.get("prompt", "")) // 4, "output_tokens": 272, "total_tokens": 272},
+            },
+        )
+
+def start_server(config) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((config.host, config.port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = Stats()
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the OpenAI chat and image endpoints. Point the app at it "
+        "with OPENAI_BASE_URL=http://HOST:PORT/v1."
+    )
+    add_arguments(parser)
+    config = parser.parse_args()
+    server = start_server(config)
+    print(f"Serving on http://{config.host}:{server.server_port}/v1", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.snapshot()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = (
+    "brief campaign launch draft copy headline audience budget review client "
+    "deadline slide deck logo palette concept storyboard persona channel social "
+    "email landing page metrics conversion funnel spring summer autumn winter "
+    "product feature pricing tone voice tagline banner video script interview "
+    "survey insight competitor roadmap sprint retro onboarding guide checklist "
+    "summary translate rewrite shorten expand formal casual friendly bold"
+).split()
+MODELS = ("gpt-4o", "gpt-4o-mini")
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fill a fresh chatbot database with synthetic users, chats and messages."
+    )
+    parser.add_argument("--db", default=os.path.join(ROOT, "data", "benchmark.db"))
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--conversations", type=int, default=200_000)
+    parser.add_argument("--messages", type=int, default=5_000_000)
+    parser.add_argument("--days", type=int, default=180, help="history spread over this many days")
+    parser.add_argument("--end-date", default=date.today().isoformat())
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=50_000)
+    parser.add_argument("--force", action="store_true", help="replace an existing database")
+    return parser.parse_args()
+
+def log(text: str):
+    print(text, file=sys.stderr, flush=True)
+
+def sentence(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+# A few users own most of the chats, as in a real workspace.
+def pick_user(rng: random.Random, user_ids: list) -> str:
+    return user_ids[int(len(user_ids) * rng.random() ** 2)]
+
+def message_counts(rng: random.Random, conversations: int, messages: int) -> list:
+    counts = [1] * conversations
+    for _ in range(messages - conversations):
+        counts[int(conversations * rng.random() ** 1.5)] += 1
+    rng.shuffle(counts)
+    return counts
+
+def main():
+    args = parse_args()
+    if args.messages < args.conversations:
+        sys.exit("--messages must be at least --conversations")
+    if os.path.exists(args.db):
+        if not args.force:
+            sys.exit(f"{args.db} exists; pass --force to replace it")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    os.environ["CHATBOT_DB_PATH"] = args.db
+
+    from db import get_db, init_db, rebuild_model_counters, rebuild_usage_counters, write_transaction
+
+    init_db()
+    rng = random.Random(args.seed)
+    end = datetime.fromisoformat(args.end_date) + timedelta(days=1)
+    start = end - timedelta(days=args.days)
+    span_seconds = int((end - start).total_seconds())
+    started = time.perf_counter()
+
+    user_ids = [f"user{index:06d}@bench.local" for index in range(args.users)]
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO users (id, name, email, role, status, created_at, last_active, password_hash)
+            VALUES (?, ?, ?, 'Member', 'Active', ?, ?, '')
+            """,
+            [
+                (user_id, f"User {index}", user_id, start.strftime("%Y-%m-%d %H:%M:%S"), start.strftime("%Y-%m-%d %H:%M:%S"))
+                for index, user_id in enumerate(user_ids)
+            ],
+        )
+    log(f"users: {args.users}")
+
+    conversations = []
+    for index in range(args.conversations):
+        created_at = start + timedelta(seconds=rng.randrange(span_seconds))
+        conversations.append((f"c{index:07d}", pick_user(rng, user_ids), sentence(rng, 2, 6), created_at))
+    with write_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO conversations (id, user_id, title, created_at) VALUES (?, ?, ?, ?)",
+            [
+                (conversation_id, user_id, title, created_at.strftime("%Y-%m-%d %H:%M:%S"))
+                for conversation_id, user_id, title, created_at in conversations
+            ],
+        )
+    log(f"conversations: {args.conversations}")
+
+    message_id = 0
+    messages = []
+    api_rows = []
+    for (conversation_id, user_id, _, created_at), count in zip(
+        conversations, message_counts(rng, args.conversations, args.messages)
+    ):
+        moment = created_at
+        for position in range(count):
+            message_id += 1
+            moment = min(moment + timedelta(seconds=rng.randint(5, 900)), end - timedelta(seconds=1))
+            timestamp = moment.strftime("%Y-%m-%d %H:%M:%S")
+            role = "user" if position % 2 == 0 else "assistant"
+            content = sentence(rng, 4, 30) if role == "user" else sentence(rng, 20, 120)
+            messages.append(
+                (message_id, conversation_id, role, content, timestamp, (len(content) + 3) // 4)
+            )
+            if role == "assistant":
+                model = rng.choice(MODELS)
+                api_rows.append(
+                    (message_id, user_id, conversation_id, model, timestamp, rng.randint(50, 4000),
+                     len(content) // 4, rng.uniform(150, 1500), rng.uniform(800, 12000))
+                )
+        if len(messages) >= args.batch:
+            write_messages(write_transaction, messages, api_rows)
+            log(f"messages: {message_id}")
+            messages, api_rows = [], []
+    write_messages(write_transaction, messages, api_rows)
+    log(f"messages: {message_id}")
+
+    with write_transaction() as conn:
+        rebuild_usage_counters(conn)
+        rebuild_model_counters(conn)
+    get_db().execute("ANALYZE")
+    log(f"done in {time.perf_counter() - started:.1f}s: {args.db}")
+
+def write_messages(write_transaction, messages: list, api_rows: list):
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO messages (id, conversation_id, role, content, created_at, token_count)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            messages,
+        )
+        conn.executemany(
+            """
+            INSERT INTO api_usage
+                (message_id, user_id, conversation_id, model, prompt_tokens, completion_tokens, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (message_id, user_id, conversation_id, model, prompt, completion, timestamp)
+                for message_id, user_id, conversation_id, model, timestamp, prompt, completion, _, _ in api_rows
+            ],
+        )
+        conn.executemany(
+            """
+            INSERT INTO api_calls
+                (kind, model, user_id, conversation_id, started_at, ttft_ms, latency_ms,
+                 prompt_tokens, completion_tokens, retries, http_status)
+            VALUES ('chat', ?, ?, ?, ?, ?, ?, ?, ?, 0, 200)
+            """,
+            [
+                (model, user_id, conversation_id, timestamp, ttft, latency, prompt, completion)
+                for _, user_id, conversation_id, model, timestamp, prompt, completion, ttft, latency in api_rows
+            ],
+        )
+
+if __name__ == "__main__":
+    main()
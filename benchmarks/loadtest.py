@@ -0,0 +1,317 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_openai  # noqa: E402
+
+PASSWORD = "loadtest"
+# prepare_app_test patches AppTest internals of this release.
+STREAMLIT_VERSION = "1.66.0"
+# Chat prompts steer clear of the words that route a prompt to image generation.
+PROMPT_WORDS = (
+    "draft a short launch email for the spring campaign aimed at returning "
+    "customers with a friendly tone and a clear call to action under eighty words"
+).split()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Drive concurrent app sessions against a fake OpenAI server and report latency."
+    )
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="seconds of traffic after sign-in")
+    parser.add_argument("--think-seconds", type=float, default=2.0, help="mean pause between actions")
+    parser.add_argument("--switch-rate", type=float, default=0.2, help="share of actions that change chat")
+    parser.add_argument("--image-rate", type=float, default=0.0, help="share of prompts that ask for an image")
+    parser.add_argument(
+        "--db", default=os.path.join(ROOT, "data", "loadtest.db"), help="SQLite file, unless CHATBOT_DATABASE_URL is set"
+    )
+    parser.add_argument("--base-url", help="use this server instead of starting the fake in-process")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--user-prefix", default="load", help="distinct per driver when several share one database"
+    )
+    fake_openai.add_arguments(parser.add_argument_group("fake server (ignored with --base-url)"))
+    return parser.parse_args()
+
+def log(text: str):
+    print(text, file=sys.stderr, flush=True)
+
+# Nearest rank, as db_load_api_latency_by_model computes it.
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    def rank(q: float) -> float:
+        return round(ordered[max(int(q * len(ordered) + 0.999999) - 1, 0)], 1)
+    return {
+        "count": len(ordered),
+        "p50_ms": rank(0.50),
+        "p95_ms": rank(0.95),
+        "p99_ms": rank(0.99),
+        "max_ms": round(ordered[-1], 1),
+    }
+
+def user_id_for(prefix: str, index: int) -> str:
+    return f"{prefix}{index:04d}@bench.local"
+
+# Traffic is timed from the moment every session has signed in.
+class TrafficWindow:
+    def __init__(self, sessions: int, duration: float):
+        self.duration = duration
+        self.started = None
+        self.started_at = None
+        self.deadline = None
+        self.barrier = threading.Barrier(sessions, action=self.open)
+
+    def open(self):
+        from db import now_timestamp
+
+        self.started_at = now_timestamp()
+        self.started = time.monotonic()
+        self.deadline = self.started + self.duration
+
+class Session:
+    def __init__(self, index: int, args, window: TrafficWindow, timings: dict, lock: threading.Lock):
+        from streamlit.testing.v1 import AppTest
+
+        self.user_id = user_id_for(args.user_prefix, index)
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.args = args
+        self.window = window
+        self.timings = timings
+        self.lock = lock
+        self.errors = []
+        self.app = AppTest.from_file(os.path.join(ROOT, "streamlit_app.py"), default_timeout=600)
+
+    def run(self, action: str):
+        started = time.perf_counter()
+        self.app.run()
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.timings.setdefault(action, []).append(elapsed)
+        if self.app.exception:
+            self.errors.extend(exception.message for exception in self.app.exception)
+
+    def button(self, prefix: str):
+        return [button for button in self.app.button if (button.key or "").startswith(prefix)]
+
+    def sign_in(self) -> bool:
+        self.run("first_load")
+        if self.app.exception:
+            return False
+        self.app.text_input[0].input(self.user_id)
+        self.app.text_input[1].input(PASSWORD)
+        self.app.button[0].click()
+        self.run("sign_in")
+        return not self.app.exception and bool(self.app.chat_input)
+
+    def act(self):
+        chats = self.button("chat_select_")
+        if chats and self.rng.random() < self.args.switch_rate:
+            new_chat = [button for button in self.app.button if button.label == "➕ New chat"]
+            if len(chats) < 4 and new_chat:
+                new_chat[0].click()
+                self.run("new_chat")
+            else:
+                self.rng.choice(chats).click()
+                self.run("switch_chat")
+            return
+        words = self.rng.sample(PROMPT_WORDS, self.rng.randint(5, 12))
+        if self.rng.random() < self.args.image_rate:
+            self.app.chat_input[0].set_value("/image " + " ".join(words))
+            self.run("image_prompt")
+        else:
+            self.app.chat_input[0].set_value(" ".join(words))
+            self.run("prompt")
+
+    def main(self):
+        try:
+            signed_in = self.sign_in()
+        except Exception as exc:
+            self.errors.append(f"{type(exc).__name__}: {exc}")
+            signed_in = False
+        self.window.barrier.wait()
+        if not signed_in:
+            self.errors.append(f"{self.user_id} could not sign in")
+            return
+        try:
+            while time.monotonic() < self.window.deadline:
+                time.sleep(self.rng.expovariate(1 / self.args.think_seconds) if self.args.think_seconds else 0)
+                if self.app.chat_input and self.app.chat_input[0].disabled:
+                    self.run("poll")
+                else:
+                    self.act()
+        except Exception as exc:
+            self.errors.append(f"{type(exc).__name__}: {exc}")
+
+# AppTest is written for one session at a time; three of its habits would
+# otherwise dominate the numbers or break under concurrency.
+# - It compiles the script again on every run, which a real server does once.
+#   One shared cache, filled by an untimed run before the sessions start,
+#   keeps that cost out of the timings and keeps sessions from compiling
+#   concurrently, which CPython 3.11 does not handle.
+# - Each run installs a mock runtime globally and clears it when it ends,
+#   under any other session still running. Clearing is skipped.
+# - Each run switches on the app-testing config flag and restores the old
+#   value when it ends, again under the others. The flag stays on.
+# These reach into Streamlit internals, checked against the version pinned in
+# requirements.txt; anything missing stops the run instead of measuring an
+# unpatched AppTest.
+def prepare_app_test():
+    import streamlit
+    from streamlit import config
+
+    if streamlit.__version__ != STREAMLIT_VERSION:
+        log(f"loadtest is written against streamlit {STREAMLIT_VERSION}; found {streamlit.__version__}")
+    try:
+        from streamlit.runtime import Runtime
+        from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+        from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+        from streamlit.testing.v1.util import build_mock_config_get_option
+    except ImportError as exc:
+        sys.exit(f"streamlit {streamlit.__version__} is not supported by loadtest: {exc}")
+    missing = [
+        name
+        for module, attribute, name in (
+            (app_test, "ScriptCache", "app_test.ScriptCache"),
+            (app_test, "Runtime", "app_test.Runtime"),
+            (local_script_runner, "ScriptCache", "local_script_runner.ScriptCache"),
+            (Runtime, "_instance", "Runtime._instance"),
+            (config, "get_option", "config.get_option"),
+        )
+        if not hasattr(module, attribute)
+    ]
+    if missing:
+        sys.exit(f"streamlit {streamlit.__version__} is not supported by loadtest: no {', '.join(missing)}")
+
+    shared = ScriptCache()
+    app_test.ScriptCache = lambda: shared
+    local_script_runner.ScriptCache = lambda: shared
+
+    class KeepInstance(type):
+        def __setattr__(cls, name, value):
+            if name == "_instance" and value is None:
+                return
+            setattr(Runtime, name, value)
+
+    app_test.Runtime = KeepInstance("Runtime", (Runtime,), {})
+    config.get_option = build_mock_config_get_option({"global.appTest": True})
+    AppTest.from_file(os.path.join(ROOT, "streamlit_app.py"), default_timeout=600).run()
+
+def seed_users(prefix: str, count: int):
+    from db import db_get_user, db_insert_user, now_timestamp
+
+    # Legacy unsalted hashes keep seeding cheap; the first sign-in upgrades them.
+    password_hash = hashlib.sha256(PASSWORD.encode("utf-8")).hexdigest()
+    for index in range(count):
+        user_id = user_id_for(prefix, index)
+        if db_get_user(user_id) is None:
+            db_insert_user(
+                {
+                    "id": user_id,
+                    "name": f"Load {index}",
+                    "email": user_id,
+                    "role": "Member",
+                    "status": "Active",
+                    "created_at": now_timestamp(),
+                    "last_active": now_timestamp(),
+                    "password_hash": password_hash,
+                }
+            )
+
+def main():
+    args = parse_args()
+    server = None
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    else:
+        server = fake_openai.start_server(args)
+        os.environ["OPENAI_BASE_URL"] = f"http://{args.host}:{server.server_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-loadtest")
+    os.environ["CHATBOT_DB_PATH"] = args.db
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+
+    from db import flush_api_calls, get_db, id_list_param, init_db
+
+    init_db()
+    seed_users(args.user_prefix, args.sessions)
+    prepare_app_test()
+    timings = {}
+    lock = threading.Lock()
+    window = TrafficWindow(args.sessions, args.duration)
+    sessions = [Session(index, args, window, timings, lock) for index in range(args.sessions)]
+    threads = [
+        threading.Thread(target=session.main, name=f"session-{index}")
+        for index, session in enumerate(sessions)
+    ]
+    log(f"{args.sessions} sessions against {os.environ['OPENAI_BASE_URL']} for {args.duration:.0f}s")
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - window.started
+    flush_api_calls()
+
+    calls = [
+        dict(row)
+        for row in get_db().execute(
+            """
+            SELECT kind, ttft_ms, latency_ms, completion_tokens, error_class FROM api_calls
+            WHERE started_at >= ? AND user_id IN (SELECT value FROM json_each(?))
+            """,
+            (window.started_at, id_list_param(session.user_id for session in sessions)),
+        )
+    ]
+    chat_calls = [call for call in calls if call["kind"] == "chat"]
+    completed = [call for call in chat_calls if call["error_class"] is None]
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "sessions": args.sessions,
+            "duration_s": round(elapsed, 1),
+            "think_seconds": args.think_seconds,
+            "base_url": os.environ["OPENAI_BASE_URL"],
+            "fake_server": None if server is None else {
+                "ttft_ms": args.ttft_ms,
+                "tokens_per_second": args.tokens_per_second,
+                "reply_tokens": args.reply_tokens,
+                "error_rate": args.error_rate,
+                "disconnect_rate": args.disconnect_rate,
+                "requests": server.stats.snapshot(),
+            },
+            "python": platform.python_version(),
+        },
+        "throughput": {
+            "chat_replies": len(completed),
+            "chat_replies_per_s": round(len(completed) / elapsed, 3),
+            "completion_tokens_per_s": round(sum(call["completion_tokens"] or 0 for call in completed) / elapsed, 1),
+            "chat_errors": len(chat_calls) - len(completed),
+            "images": len([call for call in calls if call["kind"] == "image" and call["error_class"] is None]),
+        },
+        "ttft": percentiles([call["ttft_ms"] for call in completed if call["ttft_ms"] is not None]),
+        "openai_latency": percentiles([call["latency_ms"] for call in completed if call["latency_ms"] is not None]),
+        # Each rerun is timed around AppTest.run(), so it includes the
+        # harness's own overhead; a prompt's rerun lasts until the reply ends.
+        "reruns": {action: percentiles(values) for action, values in sorted(timings.items())},
+        "session_errors": [error for session in sessions for error in session.errors],
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
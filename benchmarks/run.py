@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time the storage and dashboard paths against a database from generate.py."
+    )
+    parser.add_argument("--db", default=os.path.join(ROOT, "data", "benchmark.db"))
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case after the first")
+    parser.add_argument("--inserts", type=int, default=200, help="messages written by the insert cases")
+    parser.add_argument("--only", action="append", default=[], help="run cases whose name starts with this")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    return parser.parse_args()
+
+def log(text: str):
+    print(text, file=sys.stderr, flush=True)
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# The first run is reported on its own: it pays for cold pages and for caches
+# such as daily_activity being filled, which later runs read back.
+def measure(func, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat + 1):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    first, rest = timings[0], timings[1:] or timings
+    return {
+        "runs": len(rest),
+        "first_ms": round(first, 3),
+        "min_ms": round(min(rest), 3),
+        "median_ms": round(statistics.median(rest), 3),
+        "mean_ms": round(statistics.fmean(rest), 3),
+        "max_ms": round(max(rest), 3),
+    }
+
+def main():
+    args = parse_args()
+    if not os.path.exists(args.db):
+        sys.exit(f"{args.db} not found; create it with benchmarks/generate.py")
+    os.environ["CHATBOT_DB_PATH"] = args.db
+    os.environ.setdefault("CHATBOT_METRICS", "0")
+
+    from archive import ARCHIVE_BATCH_SIZE, archive_conversation, restore_conversation
+    from db import (
+        db_add_message,
+        db_create_conversation,
+        db_delete_conversation,
+        db_find_idle_conversations,
+        db_insert_user,
+        db_load_api_calls,
+        db_load_api_latency_by_model,
+        db_load_api_route_models,
+        db_load_api_stats_by_route,
+        db_load_conversations,
+        db_load_counters,
+        db_load_daily_activity,
+        db_load_daily_token_usage,
+        db_load_model_health,
+        db_load_recent_messages,
+        db_load_usage_by_model,
+        db_load_usage_by_user,
+        db_load_users,
+        db_load_weekly_active_users,
+        db_get_user,
+        db_record_api_usage,
+        db_response_cache_stats,
+        db_search,
+        get_db,
+        init_db,
+        now_timestamp,
+        unit_of_work,
+    )
+    from state_loader import empty_state, load_state_from_db
+
+    init_db()
+    conn = get_db()
+    scale = {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("users", "conversations", "messages", "api_calls")
+    }
+    ranked_users = [
+        row["user_id"]
+        for row in conn.execute("SELECT user_id FROM usage_by_user ORDER BY message_count DESC")
+    ]
+    if not ranked_users:
+        sys.exit(f"{args.db} has no messages; create it with benchmarks/generate.py")
+    heavy_user = ranked_users[0]
+    typical_user = ranked_users[len(ranked_users) // 2]
+    today = date.today()
+    dashboard_start = (today - timedelta(days=55)).isoformat()
+    api_filters = {
+        "start_day": (today - timedelta(days=6)).isoformat(),
+        "end_bound": (today + timedelta(days=1)).isoformat(),
+    }
+
+    def session_load(user_id: str, window: int | None):
+        return lambda: load_state_from_db(empty_state(), [user_id], window=window)
+
+    synced_state = empty_state()
+    load_state_from_db(synced_state, [heavy_user], window=30)
+
+    def dashboard():
+        db_load_users()
+        db_load_usage_by_user()
+        db_load_usage_by_model()
+        db_load_daily_activity(dashboard_start, today.isoformat(), today.isoformat())
+        db_load_daily_token_usage(dashboard_start, today.isoformat())
+        db_load_weekly_active_users(dashboard_start, today.isoformat())
+        db_load_counters(["response_cache_hits", "response_cache_misses"])
+        db_response_cache_stats()
+        db_load_recent_messages(7)
+        db_load_recent_messages(7, role="user")
+
+    def deep_feed_page():
+        row = conn.execute(
+            "SELECT created_at, id FROM messages ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?",
+            (scale["messages"] // 2,),
+        ).fetchone()
+        return lambda: db_load_recent_messages(7, (row["created_at"], row["id"]))
+
+    def api_logs():
+        db_load_api_latency_by_model(api_filters)
+        db_load_api_calls(api_filters, 26)
+
+    cases = [
+        ("load_state_from_db.typical_window", session_load(typical_user, 30)),
+        ("load_state_from_db.heavy_window", session_load(heavy_user, 30)),
+        ("load_state_from_db.heavy_full", session_load(heavy_user, None)),
+        ("load_state_from_db.heavy_resync", lambda: load_state_from_db(synced_state, [heavy_user], window=30)),
+        ("load_state_from_db.all_users_window", lambda: load_state_from_db(empty_state(), window=30)),
+        ("db_load_conversations.typical", lambda: db_load_conversations(typical_user)),
+        ("db_load_conversations.heavy", lambda: db_load_conversations(heavy_user)),
+        ("admin.dashboard", dashboard),
+        ("admin.dashboard.recent_activity_deep_page", deep_feed_page()),
+        ("admin.users", lambda: (db_load_users(), db_load_usage_by_user())),
+        ("admin.chat_usage", lambda: db_load_recent_messages(11, role="user", user_ids=[heavy_user])),
+        ("admin.tokens_costs", lambda: (
+            db_load_usage_by_model(), db_load_daily_token_usage(dashboard_start, today.isoformat())
+        )),
+        ("admin.api_logs", api_logs),
+        ("admin.routing", lambda: (
+            db_load_api_stats_by_route(api_filters), db_load_api_route_models(api_filters)
+        )),
+        ("router.model_health", lambda: db_load_model_health(api_filters["start_day"])),
+        ("admin.search", lambda: db_search("campaign brief", None, 9)),
+        ("admin.search.prefix", lambda: db_search("launch dea", None, 9)),
+        ("archive.idle_scan", lambda: db_find_idle_conversations(
+            f"{today - timedelta(days=180)} 00:00:00", ARCHIVE_BATCH_SIZE
+        )),
+    ]
+
+    # Writes go last and into a scratch user's chat, deleted afterwards, so the
+    # read cases above always see the generated data.
+    writer_id = "benchmark-writer@bench.local"
+    if db_get_user(writer_id) is None:
+        db_insert_user(
+            {
+                "id": writer_id,
+                "name": "Benchmark writer",
+                "email": writer_id,
+                "role": "Member",
+                "status": "Active",
+                "created_at": now_timestamp(),
+                "last_active": now_timestamp(),
+                "password_hash": "",
+            }
+        )
+    conversation_id = db_create_conversation(writer_id, "Benchmark", now_timestamp())
+    insert_runs = max(args.inserts // 2, 1)
+
+    def insert_message():
+        for _ in range(insert_runs):
+            db_add_message(conversation_id, "user", "Draft a launch brief for the spring campaign.", now_timestamp())
+
+    def insert_turn():
+        for _ in range(insert_runs // 2 or 1):
+            created_at = now_timestamp()
+            with unit_of_work() as unit:
+                unit.add(db_add_message, conversation_id, "user", "Shorten the tagline.", created_at)
+                unit.add(db_add_message, conversation_id, "assistant", "Spring, sooner. " * 20, created_at)
+                unit.add(
+                    db_record_api_usage,
+                    {
+                        "message_id": None,
+                        "user_id": writer_id,
+                        "conversation_id": conversation_id,
+                        "model": "gpt-4o-mini",
+                        "prompt_tokens": 120,
+                        "completion_tokens": 80,
+                        "created_at": created_at,
+                    },
+                )
+
+    # Archives the scratch chat (every message counts as idle before this
+    # cutoff) and reads it straight back.
+    def archive_roundtrip():
+        archive_conversation(conversation_id, "9999-12-31 00:00:00")
+        restore_conversation(conversation_id)
+
+    write_cases = [
+        (f"insert.db_add_message_x{insert_runs}", insert_message),
+        (f"insert.chat_turn_x{insert_runs // 2 or 1}", insert_turn),
+        ("archive.roundtrip", archive_roundtrip),
+    ]
+
+    results = {}
+    try:
+        for name, func in cases + write_cases:
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            results[name] = measure(func, args.repeat)
+            log(f"{name}: {results[name]['median_ms']} ms")
+    finally:
+        db_delete_conversation(conversation_id)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "db": os.path.abspath(args.db),
+            "scale": scale,
+            "heavy_user_messages": db_load_usage_by_user()[heavy_user]["message_count"],
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
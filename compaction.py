@@ -0,0 +1,166 @@
+import os
+import threading
+
+from db import (
+    db_get_conversation_summary,
+    db_load_messages_after,
+    db_load_settings,
+    db_message_tokens_after,
+    db_record_api_usage,
+    db_save_conversation_summary,
+    now_timestamp,
+)
+from generation import ApiCall
+from tokens import NON_CONTEXT_CONTENT, count_tokens
+
+# Summaries are written by the small model; they are read by every later
+# turn, not by people, so the cheaper model is enough.
+COMPACTION_MODEL = os.environ.get("CHATBOT_COMPACTION_MODEL", "gpt-4o-mini")
+# Messages summarized per call. A conversation far past the threshold is
+# brought down over several calls, each folding into the summary so far.
+COMPACTION_BATCH_TOKENS = int(os.environ.get("CHATBOT_COMPACTION_BATCH_TOKENS", "6000"))
+SUMMARY_MAX_WORDS = 400
+
+# A conversation is compacted once the messages after its summary pass
+# compact_after_tokens; the newest keep_recent_tokens of them stay verbatim.
+# Summaries are extra model calls, so an admin turns compaction on.
+COMPACTION_DEFAULTS = {
+    "compaction_enabled": False,
+    "compact_after_tokens": 8000,
+    "keep_recent_tokens": 3000,
+}
+
+SUMMARY_INSTRUCTIONS = (
+    "You keep a running summary of a chat between a user and an assistant at a branding and "
+    "marketing agency. Fold the new messages into the summary. Keep facts, names, decisions, "
+    "requirements, preferences, drafts the user approved and open questions; drop small talk. "
+    f"Write compact notes of at most {SUMMARY_MAX_WORDS} words and nothing else."
+)
+
+def message_tokens(message: dict) -> int:
+    if message.get("token_count") is not None:
+        return message["token_count"]
+    return len(message["content"]) // 4
+
+# The oldest unsummarized messages, up to limit tokens. Stops at a reply that
+# is still streaming, so the summary never runs past an unfinished turn.
+def next_batch(conversation_id: str, after_id: int, limit: int) -> list:
+    batch = []
+    used = 0
+    while True:
+        rows = db_load_messages_after(conversation_id, after_id, 100)
+        for row in rows:
+            if row["status"] == "streaming":
+                return batch
+            tokens = message_tokens(row)
+            if batch and used + tokens > limit:
+                return batch
+            batch.append(row)
+            used += tokens
+        if len(rows) < 100:
+            return batch
+        after_id = rows[-1]["id"]
+
+def summarize(client, conversation_id: str, user_id: str, summary: str, messages: list) -> str:
+    transcript = "\n\n".join(
+        f"{message['role'].capitalize()}: {message['content']}"
+        for message in messages
+        if message["status"] == "complete" and message["content"] not in NON_CONTEXT_CONTENT
+    )
+    if not transcript:
+        return summary
+    call = ApiCall(client, "summary", COMPACTION_MODEL, user_id, conversation_id)
+    try:
+        raw_response = client.chat.completions.with_raw_response.create(
+            model=COMPACTION_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                {
+                    "role": "user",
+                    "content": f"Summary so far:\n{summary or '(none)'}\n\nNew messages:\n{transcript}",
+                },
+            ],
+        )
+        call.responded(raw_response)
+        response = raw_response.parse()
+    except Exception as exc:
+        call.finish(error=exc)
+        raise
+    usage = {
+        "prompt_tokens": response.usage.prompt_tokens,
+        "completion_tokens": response.usage.completion_tokens,
+    }
+    call.finish(usage)
+    db_record_api_usage(
+        {
+            "message_id": None,
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "kind": "summary",
+            "model": COMPACTION_MODEL,
+            "created_at": now_timestamp(),
+            **usage,
+        }
+    )
+    return response.choices[0].message.content.strip()
+
+def compact_conversation(conversation_id: str, user_id: str, client):
+    settings = db_load_settings(COMPACTION_DEFAULTS)
+    if not settings["compaction_enabled"]:
+        return
+    current = db_get_conversation_summary(conversation_id)
+    summary = current["summary"] if current else ""
+    through_id = current["through_message_id"] if current else 0
+    while True:
+        pending = db_message_tokens_after(conversation_id, through_id)
+        if pending <= settings["compact_after_tokens"]:
+            return
+        limit = min(pending - settings["keep_recent_tokens"], COMPACTION_BATCH_TOKENS)
+        if limit <= 0:
+            return
+        batch = next_batch(conversation_id, through_id, limit)
+        if not batch:
+            return
+        summary = summarize(client, conversation_id, user_id, summary, batch)
+        through_id = batch[-1]["id"]
+        db_save_conversation_summary(
+            {
+                "conversation_id": conversation_id,
+                "summary": summary,
+                "through_message_id": through_id,
+                "token_count": count_tokens(summary),
+                "updated_at": now_timestamp(),
+            }
+        )
+
+# Compacts conversations one at a time on a single background thread; it is
+# never urgent, since a turn that finds no summary yet just sends the history
+# as before. A conversation requested again while it waits is queued once.
+class Compactor:
+    def __init__(self):
+        self._waiting = {}
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def request(self, conversation_id: str, user_id: str, client):
+        with self._changed:
+            self._waiting.setdefault(conversation_id, (user_id, client))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="compactor", daemon=True)
+                self._thread.start()
+            self._changed.notify()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._waiting:
+                    self._changed.wait()
+                conversation_id = next(iter(self._waiting))
+                user_id, client = self._waiting.pop(conversation_id)
+            try:
+                compact_conversation(conversation_id, user_id, client)
+            except Exception:
+                # The call is in the API log; the next turn asks again.
+                pass
+
+compactor = Compactor()
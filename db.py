@@ -0,0 +1,1754 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from storage import DATABASE_ERRORS, PostgresBackend, SQLiteBackend
+from tokens import count_tokens
+
+BUSY_TIMEOUT_MS = int(os.environ.get("CHATBOT_DB_BUSY_TIMEOUT_MS", "5000"))
+# NORMAL is durable across application crashes in WAL mode; only an OS crash
+# or power loss can roll back the most recent commits.
+SYNCHRONOUS = os.environ.get("CHATBOT_DB_SYNCHRONOUS", "NORMAL")
+# A negative cache_size is a size in KiB rather than a page count.
+CACHE_SIZE = -int(os.environ.get("CHATBOT_DB_CACHE_KIB", "20000"))
+MMAP_SIZE = int(os.environ.get("CHATBOT_DB_MMAP_BYTES", str(256 * 1024 * 1024)))
+POOL_MAX_IDLE = int(os.environ.get("CHATBOT_DB_POOL_MAX_IDLE", "16"))
+# A postgresql:// URL moves storage to a server database that several app
+# replicas can share; unset, the app uses the SQLite file below.
+DATABASE_URL = os.environ.get("CHATBOT_DATABASE_URL", "")
+POOL_MIN_SIZE = int(os.environ.get("CHATBOT_DB_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.environ.get("CHATBOT_DB_POOL_MAX_SIZE", "20"))
+POOL_TIMEOUT_SECONDS = float(os.environ.get("CHATBOT_DB_POOL_TIMEOUT_SECONDS", "30"))
+# USD per million tokens, seeded once; admins can edit them afterwards.
+DEFAULT_MODEL_PRICES = [
+    ("gpt-4o", 2.50, 10.00),
+    ("gpt-4o-mini", 0.15, 0.60),
+    ("gpt-image-1", 5.00, 40.00),
+]
+ACTIVITY_FLUSH_SECONDS = float(os.environ.get("CHATBOT_ACTIVITY_FLUSH_SECONDS", "5"))
+API_LOG_FLUSH_SECONDS = float(os.environ.get("CHATBOT_API_LOG_FLUSH_SECONDS", "2"))
+# A full batch is written straight away instead of waiting for the interval.
+API_LOG_BATCH_SIZE = 200
+
+def now_timestamp() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def get_db_path() -> str:
+    # Benchmarks and tests point the app at a database of their own.
+    if os.environ.get("CHATBOT_DB_PATH"):
+        return os.path.abspath(os.environ["CHATBOT_DB_PATH"])
+    root = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(root, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, "chatbot.db")
+
+_backend = None
+_backend_lock = threading.Lock()
+_local = threading.local()
+_initialized_backends = set()
+_held = {}
+_held_lock = threading.Lock()
+# Both backends allow one writer at a time. Serializing writers in-process
+# keeps threads from spinning on the busy timeout or the write lock; readers
+# never take this lock and can read while a write is in progress.
+_write_lock = threading.RLock()
+
+def get_backend() -> SQLiteBackend | PostgresBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if DATABASE_URL:
+                    _backend = PostgresBackend(
+                        DATABASE_URL, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT_SECONDS
+                    )
+                else:
+                    _backend = SQLiteBackend(
+                        get_db_path(),
+                        POOL_MAX_IDLE,
+                        {
+                            "journal_mode": "WAL",
+                            "busy_timeout": BUSY_TIMEOUT_MS,
+                            "synchronous": SYNCHRONOUS,
+                            "cache_size": CACHE_SIZE,
+                            "mmap_size": MMAP_SIZE,
+                            "temp_store": "MEMORY",
+                            "foreign_keys": "ON",
+                        },
+                        BUSY_TIMEOUT_MS,
+                    )
+    return _backend
+
+# With SQLite each thread keeps one connection for its lifetime and hands it
+# back to the pool once the thread has finished, so Streamlit's short-lived
+# script threads reuse connections instead of reopening the database. A
+# finished thread's object can outlive it for a whole session (the script
+# runner keeps it), so connections are reclaimed from finished threads
+# whenever another is needed rather than when the object is collected.
+# PostgreSQL's pool is bounded and shared by every worker and streaming
+# thread, so there a connection is only taken for one statement, or for one
+# write transaction, and handed straight back.
+def get_db():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        backend = get_backend()
+        if backend.dialect == "postgres":
+            return backend.pooled
+        with _held_lock:
+            finished = [thread for thread in _held if not thread.is_alive()]
+            reclaimed = [_held.pop(thread) for thread in finished]
+        for stale in reclaimed:
+            backend.release(stale)
+        conn = backend.acquire()
+        _local.conn = conn
+        with _held_lock:
+            _held[threading.current_thread()] = conn
+    return conn
+
+@contextmanager
+def write_transaction():
+    backend = get_backend()
+    with _write_lock:
+        depth = getattr(_local, "write_depth", 0)
+        taken = depth == 0 and backend.dialect == "postgres"
+        if taken:
+            _local.conn = backend.acquire()
+        conn = get_db()
+        _local.write_depth = depth + 1
+        try:
+            if depth == 0:
+                backend.begin(conn)
+            yield conn
+            if depth == 0:
+                conn.commit()
+        except BaseException:
+            if depth == 0:
+                conn.rollback()
+            raise
+        finally:
+            _local.write_depth = depth
+            if taken:
+                _local.conn = None
+                backend.release(conn)
+
+# Groups the writes of one logical operation (a chat turn) into a single
+# transaction. Writes are queued while the turn runs, so no write lock is held
+# across slow calls such as a streamed completion, and are flushed together on
+# exit, including when the script is interrupted by a rerun.
+class UnitOfWork:
+    def __init__(self):
+        self._pending = []
+
+    def add(self, func, *args, on_done=None):
+        self._pending.append((func, args, on_done))
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        # Callbacks run as each write completes, so a later queued write can
+        # use an id assigned by an earlier one.
+        with write_transaction():
+            for func, args, on_done in pending:
+                result = func(*args)
+                if on_done is not None:
+                    on_done(result)
+
+@contextmanager
+def unit_of_work():
+    unit = UnitOfWork()
+    try:
+        yield unit
+    finally:
+        unit.flush()
+
+def init_db():
+    backend = get_backend()
+    if backend.key in _initialized_backends:
+        return
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                email TEXT NOT NULL,
+                role TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                last_active TEXT NOT NULL,
+                password_hash TEXT NOT NULL
+            )
+            """
+        )
+        # Bumped to sign a user out everywhere, which invalidates every session
+        # token issued before.
+        ensure_column(conn, "users", "session_version", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                restored_at TEXT,
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+            """
+        )
+        # Set when an archived conversation is opened again, so it is not
+        # archived straight back before it has been idle for the full period.
+        ensure_column(conn, "conversations", "restored_at", "TEXT")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                token_count INTEGER,
+                status TEXT NOT NULL DEFAULT 'complete',
+                image_sha256 TEXT,
+                FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+            )
+            """
+        )
+        ensure_column(conn, "messages", "token_count", "INTEGER")
+        # Assistant replies are written while they stream: 'streaming' until the
+        # worker finishes, then 'complete' or 'failed' (partial text kept).
+        ensure_column(conn, "messages", "status", "TEXT NOT NULL DEFAULT 'complete'")
+        # Generated images live in the image store; the row keeps their hash.
+        ensure_column(conn, "messages", "image_sha256", "TEXT")
+        # Usage counters are maintained by db_add_message and, for tokens, by
+        # db_record_api_usage, so dashboards read one row per user (or per user
+        # and day) instead of scanning messages or api_usage.
+        has_usage_counters = backend.table_exists(conn, "usage_by_user")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS usage_by_user (
+                user_id TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                prompt_count INTEGER NOT NULL DEFAULT 0,
+                char_count INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                last_activity TEXT,
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS usage_by_day (
+                day TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                prompt_count INTEGER NOT NULL DEFAULT 0,
+                char_count INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                last_activity TEXT,
+                PRIMARY KEY (day, user_id),
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+            """
+        )
+        # Closed days only; the current day is always computed live.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_activity (
+                day TEXT PRIMARY KEY,
+                prompt_count INTEGER NOT NULL,
+                active_users INTEGER NOT NULL
+            )
+            """
+        )
+        # Usage reported by the API for each call. Rows outlive the chat they
+        # belong to so cost history is not lost when a conversation is deleted.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS api_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id INTEGER,
+                user_id TEXT NOT NULL,
+                conversation_id TEXT,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE SET NULL
+            )
+            """
+        )
+        # What the call was for, as in api_calls: chat, image or summary.
+        # Rows from before the column are replies, told apart by their message.
+        added_usage_kinds = "kind" not in backend.columns(conn, "api_usage")
+        if added_usage_kinds:
+            conn.execute("ALTER TABLE api_usage ADD COLUMN kind TEXT NOT NULL DEFAULT 'chat'")
+            conn.execute(
+                """
+                UPDATE api_usage SET kind = 'image'
+                WHERE message_id IN (SELECT id FROM messages WHERE image_sha256 IS NOT NULL)
+                """
+            )
+        # Per kind and model totals of api_usage, maintained by
+        # db_record_api_usage for the Tokens & Costs page. Cost is worked out
+        # when read, so edited prices apply to past usage as well.
+        has_model_counters = backend.table_exists(conn, "usage_by_model")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS usage_by_model (
+                kind TEXT NOT NULL,
+                model TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (kind, model)
+            )
+            """
+        )
+        if not has_model_counters or added_usage_kinds:
+            rebuild_model_counters(conn)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS model_prices (
+                model TEXT PRIMARY KEY,
+                input_per_million REAL NOT NULL,
+                output_per_million REAL NOT NULL
+            )
+            """
+        )
+        conn.executemany(
+            """
+            INSERT INTO model_prices (model, input_per_million, output_per_million)
+            VALUES (?, ?, ?)
+            ON CONFLICT(model) DO NOTHING
+            """,
+            DEFAULT_MODEL_PRICES,
+        )
+        # A rolling summary of a conversation's messages up to and including
+        # through_message_id, sent to the model in their place.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                conversation_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                through_message_id INTEGER NOT NULL,
+                token_count INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+            )
+            """
+        )
+        # Where an archived conversation's messages went: a compressed record
+        # in one of the segment files under data/archive. The conversation row
+        # itself stays, so chat lists and titles are unaffected.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_archive (
+                conversation_id TEXT PRIMARY KEY,
+                segment TEXT NOT NULL,
+                byte_offset INTEGER NOT NULL,
+                byte_length INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                last_message_at TEXT NOT NULL,
+                archived_at TEXT NOT NULL,
+                FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+            )
+            """
+        )
+        # Sessions signed out of one browser, kept until their last token has
+        # expired.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ended_sessions (
+                session_id TEXT PRIMARY KEY,
+                expires_at INTEGER NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS app_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS app_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                last_used_at TEXT NOT NULL
+            )
+            """
+        )
+        # One row per image request; coalesced rows shared another request's
+        # API call.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS image_jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                conversation_id TEXT,
+                prompt TEXT NOT NULL,
+                status TEXT NOT NULL,
+                coalesced INTEGER NOT NULL DEFAULT 0,
+                message_id INTEGER,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT
+            )
+            """
+        )
+        # One row per OpenAI request, successful or not. Times are in ms.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS api_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                model TEXT NOT NULL,
+                user_id TEXT,
+                conversation_id TEXT,
+                started_at TEXT NOT NULL,
+                ttft_ms REAL,
+                latency_ms REAL NOT NULL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                retries INTEGER NOT NULL DEFAULT 0,
+                http_status INTEGER,
+                error_class TEXT
+            )
+            """
+        )
+        # The routing rule that picked the model; NULL when it was picked by hand.
+        ensure_column(conn, "api_calls", "route", "TEXT")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_api_calls_started_at ON api_calls(started_at)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_api_usage_created_at ON api_usage(created_at)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used_at ON response_cache(last_used_at)"
+        )
+        # Deleting messages (archiving or deleting a chat) clears the
+        # api_usage rows that point at them; unindexed, each one scans the table.
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_api_usage_message_id ON api_usage(message_id)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversation_archive_segment ON conversation_archive(segment)"
+        )
+        if not has_usage_counters:
+            rebuild_usage_counters(conn)
+        elif "token_count" in backend.columns(conn, "usage_by_user"):
+            migrate_token_counters(conn)
+        backend.create_search_index(conn)
+    _initialized_backends.add(backend.key)
+
+def ensure_column(conn, table: str, column: str, definition: str):
+    if column not in get_backend().columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def rebuild_usage_counters(conn):
+    conn.execute("DELETE FROM usage_by_user")
+    conn.execute("DELETE FROM usage_by_day")
+    conn.execute(
+        """
+        INSERT INTO usage_by_user
+            (user_id, message_count, prompt_count, char_count, last_activity)
+        SELECT c.user_id, COUNT(*), SUM(CASE WHEN m.role = 'user' THEN 1 ELSE 0 END), SUM(LENGTH(m.content)),
+               MAX(m.created_at)
+        FROM messages m
+        JOIN conversations c ON c.id = m.conversation_id
+        GROUP BY c.user_id
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO usage_by_day
+            (day, user_id, message_count, prompt_count, char_count, last_activity)
+        SELECT substr(m.created_at, 1, 10), c.user_id, COUNT(*), SUM(CASE WHEN m.role = 'user' THEN 1 ELSE 0 END),
+               SUM(LENGTH(m.content)), MAX(m.created_at)
+        FROM messages m
+        JOIN conversations c ON c.id = m.conversation_id
+        GROUP BY substr(m.created_at, 1, 10), c.user_id
+        """
+    )
+    rebuild_token_counters(conn)
+
+# Token counters add up the usage the API reported, not the text stored.
+# Usage of users that no longer exist has no counter row to go to.
+def rebuild_token_counters(conn):
+    conn.execute(
+        """
+        INSERT INTO usage_by_user (user_id, prompt_tokens, completion_tokens)
+        SELECT a.user_id, SUM(a.prompt_tokens), SUM(a.completion_tokens)
+        FROM api_usage a
+        JOIN users u ON u.id = a.user_id
+        GROUP BY a.user_id
+        ON CONFLICT(user_id) DO UPDATE SET
+            prompt_tokens = excluded.prompt_tokens,
+            completion_tokens = excluded.completion_tokens
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO usage_by_day (day, user_id, prompt_tokens, completion_tokens)
+        SELECT substr(a.created_at, 1, 10), a.user_id, SUM(a.prompt_tokens), SUM(a.completion_tokens)
+        FROM api_usage a
+        JOIN users u ON u.id = a.user_id
+        GROUP BY substr(a.created_at, 1, 10), a.user_id
+        ON CONFLICT(day, user_id) DO UPDATE SET
+            prompt_tokens = excluded.prompt_tokens,
+            completion_tokens = excluded.completion_tokens
+        """
+    )
+
+def rebuild_model_counters(conn):
+    conn.execute("DELETE FROM usage_by_model")
+    conn.execute(
+        """
+        INSERT INTO usage_by_model (kind, model, calls, prompt_tokens, completion_tokens)
+        SELECT kind, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens)
+        FROM api_usage
+        GROUP BY kind, model
+        """
+    )
+
+# Databases from before token usage was recorded estimated tokens from the
+# message text. The estimate is dropped and the counters are filled in from
+# api_usage once.
+def migrate_token_counters(conn):
+    for table in ("usage_by_user", "usage_by_day", "daily_activity"):
+        if "token_count" in get_backend().columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} DROP COLUMN token_count")
+    for table in ("usage_by_user", "usage_by_day"):
+        ensure_column(conn, table, "prompt_tokens", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(conn, table, "completion_tokens", "INTEGER NOT NULL DEFAULT 0")
+    rebuild_token_counters(conn)
+
+def db_get_user(user_id: str):
+    conn = get_db()
+    row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+def db_insert_user(user: dict):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO users (id, name, email, role, status, created_at, last_active, password_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                user["id"],
+                user["name"],
+                user["email"],
+                user["role"],
+                user["status"],
+                user["created_at"],
+                user["last_active"],
+                user["password_hash"],
+            ),
+        )
+
+# Only replaces the hash that was verified, so a password changed meanwhile
+# is not overwritten.
+def db_upgrade_password_hash(user_id: str, old_hash: str, new_hash: str):
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+            (new_hash, user_id, old_hash),
+        )
+
+def db_end_user_sessions(user_id: str):
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE users SET session_version = session_version + 1 WHERE id = ?",
+            (user_id,),
+        )
+
+# Sessions whose tokens have all expired are dropped on the way.
+def db_end_session(session_id: str, expires_at: int):
+    with write_transaction() as conn:
+        conn.execute("DELETE FROM ended_sessions WHERE expires_at < ?", (int(time.time()),))
+        conn.execute(
+            """
+            INSERT INTO ended_sessions (session_id, expires_at) VALUES (?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET expires_at = excluded.expires_at
+            """,
+            (session_id, expires_at),
+        )
+
+def db_session_ended(session_id: str) -> bool:
+    conn = get_db()
+    return conn.execute(
+        "SELECT 1 FROM ended_sessions WHERE session_id = ?", (session_id,)
+    ).fetchone() is not None
+
+def db_update_users_activity(last_active_by_user: dict):
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            UPDATE users
+            SET last_active = CASE WHEN :last_active > last_active THEN :last_active ELSE last_active END
+            WHERE id = :user_id
+            """,
+            [
+                {"user_id": user_id, "last_active": last_active}
+                for user_id, last_active in last_active_by_user.items()
+            ],
+        )
+
+# last_active only needs to be roughly current, so updates from every session
+# are coalesced per user and written in one transaction every few seconds.
+class ActivityWriter:
+    def __init__(self, interval: float = ACTIVITY_FLUSH_SECONDS):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def touch(self, user_id: str, last_active: str):
+        with self._lock:
+            if last_active > self._pending.get(user_id, ""):
+                self._pending[user_id] = last_active
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="activity-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            db_update_users_activity(pending)
+        except DATABASE_ERRORS:
+            with self._lock:
+                for user_id, last_active in pending.items():
+                    if last_active > self._pending.get(user_id, ""):
+                        self._pending[user_id] = last_active
+            raise
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except DATABASE_ERRORS:
+                continue
+
+_activity_writer = ActivityWriter()
+
+def touch_user_activity(user_id: str, last_active: str):
+    _activity_writer.touch(user_id, last_active)
+
+def db_insert_api_calls(calls: list):
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO api_calls
+                (kind, model, route, user_id, conversation_id, started_at, ttft_ms, latency_ms,
+                 prompt_tokens, completion_tokens, retries, http_status, error_class)
+            VALUES
+                (:kind, :model, :route, :user_id, :conversation_id, :started_at, :ttft_ms, :latency_ms,
+                 :prompt_tokens, :completion_tokens, :retries, :http_status, :error_class)
+            """,
+            calls,
+        )
+
+# API call records are appended in memory and written in batches by a
+# background thread, so logging never waits on the database.
+class ApiCallWriter:
+    def __init__(self, interval: float = API_LOG_FLUSH_SECONDS, batch_size: int = API_LOG_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def append(self, call: dict):
+        with self._lock:
+            self._pending.append(call)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="api-call-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            db_insert_api_calls(pending)
+        except DATABASE_ERRORS:
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except DATABASE_ERRORS:
+                continue
+
+_api_call_writer = ApiCallWriter()
+
+def log_api_call(call: dict):
+    _api_call_writer.append(call)
+
+def flush_api_calls():
+    _api_call_writer.flush()
+
+# Id sets are bound as a single JSON array parameter, so a batch costs the same
+# query whatever its size and never hits SQLite's bound-variable limit.
+def id_list_param(ids) -> str:
+    return json.dumps(list(ids))
+
+def db_load_users(user_ids: list | None = None) -> dict:
+    conn = get_db()
+    users = {}
+    if user_ids is None:
+        rows = conn.execute("SELECT * FROM users")
+    else:
+        rows = conn.execute(
+            "SELECT * FROM users WHERE id IN (SELECT value FROM json_each(?))",
+            (id_list_param(user_ids),),
+        )
+    for row in rows:
+        users[row["id"]] = dict(row)
+    return users
+
+def db_load_conversations_for_users(user_ids: list, window: int | None = None) -> dict:
+    conn = get_db()
+    ids_param = id_list_param(user_ids)
+    conversations_by_user = {user_id: [] for user_id in user_ids}
+    conversations_by_id = {}
+    for row in conn.execute(
+        """
+        SELECT c.*, a.archived_at FROM conversations c
+        LEFT JOIN conversation_archive a ON a.conversation_id = c.id
+        WHERE c.user_id IN (SELECT value FROM json_each(?))
+        ORDER BY c.created_at DESC
+        """,
+        (ids_param,),
+    ):
+        convo = dict(row)
+        convo["messages"] = []
+        convo["has_earlier"] = False
+        conversations_by_user[row["user_id"]].append(convo)
+        conversations_by_id[row["id"]] = convo
+    if window is None:
+        rows = conn.execute(
+            """
+            SELECT m.id, m.conversation_id, m.role, m.content, m.created_at, m.status,
+                   m.image_sha256
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE c.user_id IN (SELECT value FROM json_each(?))
+            ORDER BY m.id
+            """,
+            (ids_param,),
+        )
+    else:
+        # Each conversation's window starts at its (window + 1)th newest
+        # message, found by stepping back along idx_messages_conversation_id;
+        # only the messages from there on are read. The one extra message
+        # tells us whether older ones exist.
+        rows = conn.execute(
+            """
+            WITH windows AS MATERIALIZED (
+                SELECT c.id AS conversation_id,
+                       COALESCE(
+                           (
+                               SELECT id FROM messages
+                               WHERE conversation_id = c.id
+                               ORDER BY id DESC
+                               LIMIT 1 OFFSET ?
+                           ),
+                           0
+                       ) AS first_id
+                FROM conversations c
+                WHERE c.user_id IN (SELECT value FROM json_each(?))
+            )
+            SELECT m.id, m.conversation_id, m.role, m.content, m.created_at, m.status,
+                   m.image_sha256
+            FROM windows w
+            JOIN messages m ON m.conversation_id = w.conversation_id AND m.id >= w.first_id
+            ORDER BY m.id
+            """,
+            (window, ids_param),
+        )
+    for msg in rows:
+        convo = conversations_by_id.get(msg["conversation_id"])
+        if convo is None:
+            continue
+        convo["messages"].append(
+            {
+                "id": msg["id"],
+                "role": msg["role"],
+                "content": msg["content"],
+                "created_at": msg["created_at"],
+                "status": msg["status"],
+                "image_sha256": msg["image_sha256"],
+            }
+        )
+    if window is not None:
+        for convo in conversations_by_id.values():
+            if len(convo["messages"]) > window:
+                del convo["messages"][0]
+                convo["has_earlier"] = True
+    return conversations_by_user
+
+def db_load_conversations(user_id: str) -> list:
+    return db_load_conversations_for_users([user_id])[user_id]
+
+def db_load_conversation_headers(user_ids: list) -> list:
+    conn = get_db()
+    return [
+        dict(row)
+        for row in conn.execute(
+            """
+            SELECT c.id, c.user_id, c.title, c.created_at, a.archived_at FROM conversations c
+            LEFT JOIN conversation_archive a ON a.conversation_id = c.id
+            WHERE c.user_id IN (SELECT value FROM json_each(?))
+            ORDER BY c.created_at DESC
+            """,
+            (id_list_param(user_ids),),
+        )
+    ]
+
+def db_load_messages_since(message_id: int, user_ids: list) -> list:
+    conn = get_db()
+    return [
+        dict(row)
+        for row in conn.execute(
+            """
+            SELECT m.id, m.conversation_id, m.role, m.content, m.created_at, m.status,
+                   m.image_sha256
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE m.id > ? AND c.user_id IN (SELECT value FROM json_each(?))
+            ORDER BY m.id
+            """,
+            (message_id, id_list_param(user_ids)),
+        )
+    ]
+
+def db_load_messages_before(conversation_id: str, message_id: int, limit: int) -> list:
+    conn = get_db()
+    rows = conn.execute(
+        """
+        SELECT id, role, content, created_at, status, image_sha256 FROM messages
+        WHERE conversation_id = ? AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+        """,
+        (conversation_id, message_id, limit),
+    ).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+def db_load_messages_by_ids(message_ids) -> list:
+    conn = get_db()
+    return [
+        dict(row)
+        for row in conn.execute(
+            """
+            SELECT id, conversation_id, role, content, created_at, status, image_sha256
+            FROM messages
+            WHERE id IN (SELECT CAST(value AS INTEGER) FROM json_each(?))
+            """,
+            (id_list_param(message_ids),),
+        )
+    ]
+
+# Newest first, one keyset page at a time, so a caller that stops early (the
+# context builder) never reads the rest of the thread or leaves a statement open.
+# Unfinished replies are left out of the context.
+def db_iter_message_history_desc(
+    conversation_id: str,
+    page_size: int = 50,
+    before_id: int | None = None,
+    after_id: int | None = None,
+):
+    conn = get_db()
+    after = "" if after_id is None else "AND id > ?"
+    while True:
+        before = "" if before_id is None else "AND id < ?"
+        rows = conn.execute(
+            f"""
+            SELECT id, role, content, token_count, status FROM messages
+            WHERE conversation_id = ? {before} {after}
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (
+                conversation_id,
+                *([] if before_id is None else [before_id]),
+                *([] if after_id is None else [after_id]),
+                page_size,
+            ),
+        ).fetchall()
+        for row in rows:
+            if row["status"] == "complete":
+                yield dict(row)
+        if len(rows) < page_size:
+            return
+        before_id = rows[-1]["id"]
+
+# Messages without a stored count are estimated at four characters a token.
+def db_message_tokens_after(conversation_id: str, after_id: int, before_id: int | None = None) -> int:
+    conn = get_db()
+    before = "" if before_id is None else "AND id < ?"
+    return conn.execute(
+        f"""
+        SELECT COALESCE(SUM(COALESCE(token_count, LENGTH(content) / 4)), 0) AS tokens FROM messages
+        WHERE conversation_id = ? AND id > ? {before} AND status = 'complete'
+        """,
+        (conversation_id, after_id, *([] if before_id is None else [before_id])),
+    ).fetchone()["tokens"]
+
+def db_get_conversation_summary(conversation_id: str) -> dict | None:
+    conn = get_db()
+    row = conn.execute(
+        "SELECT * FROM conversation_summaries WHERE conversation_id = ?", (conversation_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
+# Only moves forward, so a slower compaction of the same conversation (from
+# another instance) cannot replace a newer summary.
+def db_save_conversation_summary(summary: dict):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO conversation_summaries
+                (conversation_id, summary, through_message_id, token_count, updated_at)
+            VALUES (:conversation_id, :summary, :through_message_id, :token_count, :updated_at)
+            ON CONFLICT(conversation_id) DO UPDATE SET
+                summary = excluded.summary,
+                through_message_id = excluded.through_message_id,
+                token_count = excluded.token_count,
+                updated_at = excluded.updated_at
+            WHERE excluded.through_message_id > conversation_summaries.through_message_id
+            """,
+            summary,
+        )
+
+def db_count_messages_from(conversation_id: str, message_id: int) -> int:
+    conn = get_db()
+    return conn.execute(
+        "SELECT COUNT(*) AS message_count FROM messages WHERE conversation_id = ? AND id >= ?",
+        (conversation_id, message_id),
+    ).fetchone()["message_count"]
+
+def db_load_messages_after(conversation_id: str, message_id: int, limit: int) -> list:
+    conn = get_db()
+    return [
+        dict(row)
+        for row in conn.execute(
+            """
+            SELECT id, role, content, created_at, status, image_sha256, token_count FROM messages
+            WHERE conversation_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+            """,
+            (conversation_id, message_id, limit),
+        )
+    ]
+
+# Newest first across the workspace (or the given users), one keyset page at
+# a time: `before` is the (created_at, id) of the last row of the previous
+# page, so every page is a short range scan of idx_messages_created_at no
+# matter how much history there is.
+def db_load_recent_messages(
+    limit: int,
+    before: tuple | None = None,
+    role: str | None = None,
+    user_ids: list | None = None,
+) -> list:
+    conn = get_db()
+    conditions = []
+    params = []
+    if before is not None:
+        conditions.append("(m.created_at, m.id) < (?, ?)")
+        params.extend(before)
+    if role is not None:
+        conditions.append("m.role = ?")
+        params.append(role)
+    if user_ids is not None:
+        conditions.append("c.user_id IN (SELECT value FROM json_each(?))")
+        params.append(id_list_param(user_ids))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return [
+        dict(row)
+        for row in conn.execute(
+            f"""
+            SELECT m.id, m.conversation_id, m.role, m.content, m.created_at, c.user_id,
+                   COALESCE(u.name, c.user_id) AS user_name
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            LEFT JOIN users u ON u.id = c.user_id
+            {where}
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT ?
+            """,
+            (*params, limit),
+        )
+    ]
+
+# Matching messages and chat titles, best first. user_ids=None searches the
+# whole workspace. Snippets mark the matched terms in bold.
+def db_search(text: str, user_ids: list | None, limit: int, offset: int = 0) -> list:
+    backend = get_backend()
+    query = backend.search_query(text)
+    if query is None:
+        return []
+    conn = get_db()
+    params = {"query": query, "limit": limit, "offset": offset}
+    user_filter = ""
+    if user_ids is not None:
+        user_filter = "AND c.user_id IN (SELECT value FROM json_each(:user_ids))"
+        params["user_ids"] = id_list_param(user_ids)
+    return [dict(row) for row in conn.execute(backend.search_sql(user_filter), params)]
+
+def db_set_message_token_counts(token_counts: dict):
+    with write_transaction() as conn:
+        conn.executemany(
+            "UPDATE messages SET token_count = ? WHERE id = ?",
+            [(token_count, message_id) for message_id, token_count in token_counts.items()],
+        )
+
+def db_max_message_id() -> int:
+    conn = get_db()
+    return conn.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM messages").fetchone()["max_id"]
+
+def db_create_conversation(user_id: str, title: str, created_at: str) -> str:
+    conversation_id = str(uuid.uuid4())[:8]
+    with write_transaction() as conn:
+        conn.execute(
+            "INSERT INTO conversations (id, user_id, title, created_at) VALUES (?, ?, ?, ?)",
+            (conversation_id, user_id, title, created_at),
+        )
+    return conversation_id
+
+def db_delete_conversation(conversation_id: str):
+    with write_transaction() as conn:
+        conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+def db_update_conversation_title(conversation_id: str, title: str):
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE conversations SET title = ? WHERE id = ?",
+            (title, conversation_id),
+        )
+
+# Conversations whose newest message is older than cutoff and that have not
+# been restored since then. Only conversations with a message before the
+# cutoff are looked at, so chats started since cost nothing.
+def db_find_idle_conversations(cutoff: str, limit: int) -> list:
+    conn = get_db()
+    return [
+        row["id"]
+        for row in conn.execute(
+            """
+            SELECT c.id FROM conversations c
+            WHERE c.id IN (SELECT conversation_id FROM messages WHERE created_at < :cutoff)
+              AND COALESCE(c.restored_at, '') < :cutoff
+              AND NOT EXISTS (SELECT 1 FROM conversation_archive a WHERE a.conversation_id = c.id)
+              AND (
+                  SELECT created_at FROM messages
+                  WHERE id = (SELECT MAX(id) FROM messages WHERE conversation_id = c.id)
+              ) < :cutoff
+            LIMIT :limit
+            """,
+            {"cutoff": cutoff, "limit": limit},
+        )
+    ]
+
+def db_load_conversation_messages(conversation_id: str) -> list:
+    conn = get_db()
+    return [
+        dict(row)
+        for row in conn.execute(
+            """
+            SELECT id, role, content, created_at, token_count, status, image_sha256 FROM messages
+            WHERE conversation_id = ?
+            ORDER BY id
+            """,
+            (conversation_id,),
+        )
+    ]
+
+def db_oldest_message_at() -> str | None:
+    conn = get_db()
+    return conn.execute("SELECT MIN(created_at) AS oldest FROM messages").fetchone()["oldest"]
+
+# Records where a conversation's messages were archived and removes them from
+# messages. Returns False, changing nothing, when the conversation has gained a
+# message past through_id or another instance archived it first.
+def db_archive_messages(entry: dict, through_id: int) -> bool:
+    with write_transaction() as conn:
+        newest = conn.execute(
+            "SELECT MAX(id) AS newest FROM messages WHERE conversation_id = ?",
+            (entry["conversation_id"],),
+        ).fetchone()["newest"]
+        if newest != through_id:
+            return False
+        inserted = conn.execute(
+            """
+            INSERT INTO conversation_archive
+                (conversation_id, segment, byte_offset, byte_length, message_count,
+                 last_message_at, archived_at)
+            VALUES (:conversation_id, :segment, :byte_offset, :byte_length, :message_count,
+                    :last_message_at, :archived_at)
+            ON CONFLICT(conversation_id) DO NOTHING
+            RETURNING conversation_id
+            """,
+            entry,
+        ).fetchone()
+        if inserted is None:
+            return False
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (entry["conversation_id"],))
+    return True
+
+# Removes and returns a conversation's archive entry, or None when it is not
+# archived (any more). The caller puts the messages back in the same
+# transaction.
+def db_take_archive_entry(conversation_id: str, restored_at: str) -> dict | None:
+    with write_transaction() as conn:
+        row = conn.execute(
+            "DELETE FROM conversation_archive WHERE conversation_id = ? RETURNING *",
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE conversations SET restored_at = ? WHERE id = ?", (restored_at, conversation_id)
+        )
+    return dict(row)
+
+# Archived messages come back under their original ids. Usage counters already
+# include them, so unlike db_add_message this does not count them again.
+def db_restore_messages(conversation_id: str, messages: list):
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO messages
+                (id, conversation_id, role, content, created_at, token_count, status, image_sha256)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO NOTHING
+            """,
+            [
+                (
+                    message["id"],
+                    conversation_id,
+                    message["role"],
+                    message["content"],
+                    message["created_at"],
+                    message["token_count"],
+                    message["status"],
+                    message["image_sha256"],
+                )
+                for message in messages
+            ],
+        )
+
+def db_load_archive_stats() -> dict:
+    conn = get_db()
+    return dict(
+        conn.execute(
+            """
+            SELECT COUNT(*) AS conversations, COALESCE(SUM(message_count), 0) AS messages
+            FROM conversation_archive
+            """
+        ).fetchone()
+    )
+
+def db_load_archive_segments() -> set:
+    conn = get_db()
+    return {row["segment"] for row in conn.execute("SELECT DISTINCT segment FROM conversation_archive")}
+
+# Counters move by deltas, so a reply that grows while streaming is counted
+# once as a message and then only by the text it gains.
+def add_usage(conn, conversation_id: str, created_at: str, usage: tuple):
+    conn.execute(
+        """
+        INSERT INTO usage_by_user
+            (user_id, message_count, prompt_count, char_count, last_activity)
+        SELECT user_id, ?, ?, ?, ? FROM conversations WHERE id = ?
+        ON CONFLICT(user_id) DO UPDATE SET
+            message_count = usage_by_user.message_count + excluded.message_count,
+            prompt_count = usage_by_user.prompt_count + excluded.prompt_count,
+            char_count = usage_by_user.char_count + excluded.char_count,
+            last_activity = CASE
+                WHEN excluded.last_activity > COALESCE(usage_by_user.last_activity, '')
+                THEN excluded.last_activity ELSE usage_by_user.last_activity
+            END
+        """,
+        (*usage, created_at, conversation_id),
+    )
+    conn.execute(
+        """
+        INSERT INTO usage_by_day
+            (day, user_id, message_count, prompt_count, char_count, last_activity)
+        SELECT ?, user_id, ?, ?, ?, ? FROM conversations WHERE id = ?
+        ON CONFLICT(day, user_id) DO UPDATE SET
+            message_count = usage_by_day.message_count + excluded.message_count,
+            prompt_count = usage_by_day.prompt_count + excluded.prompt_count,
+            char_count = usage_by_day.char_count + excluded.char_count,
+            last_activity = CASE
+                WHEN excluded.last_activity > COALESCE(usage_by_day.last_activity, '')
+                THEN excluded.last_activity ELSE usage_by_day.last_activity
+            END
+        """,
+        (created_at[:10], *usage, created_at, conversation_id),
+    )
+
+def db_add_message(
+    conversation_id: str,
+    role: str,
+    content: str,
+    created_at: str,
+    status: str = "complete",
+    image_sha256: str | None = None,
+) -> int:
+    # Streaming rows are recounted when they are finished.
+    token_count = count_tokens(content) if status != "streaming" else None
+    with write_transaction() as conn:
+        message_id = conn.execute(
+            """
+            INSERT INTO messages
+                (conversation_id, role, content, created_at, token_count, status, image_sha256)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+            """,
+            (conversation_id, role, content, created_at, token_count, status, image_sha256),
+        ).fetchone()["id"]
+        add_usage(
+            conn,
+            conversation_id,
+            created_at,
+            (1, int(role == "user"), len(content)),
+        )
+    return message_id
+
+def db_update_message_content(message_id: int, content: str, status: str):
+    token_count = count_tokens(content) if status != "streaming" else None
+    with write_transaction() as conn:
+        row = conn.execute(
+            "SELECT conversation_id, content, created_at FROM messages WHERE id = ?",
+            (message_id,),
+        ).fetchone()
+        if row is None:
+            return
+        conn.execute(
+            "UPDATE messages SET content = ?, status = ?, token_count = ? WHERE id = ?",
+            (content, status, token_count, message_id),
+        )
+        add_usage(
+            conn,
+            row["conversation_id"],
+            row["created_at"],
+            (0, 0, len(content) - len(row["content"])),
+        )
+
+def db_compute_daily_activity(start_day: str, end_day: str) -> dict:
+    conn = get_db()
+    end_bound = (date.fromisoformat(end_day) + timedelta(days=1)).isoformat()
+    return {
+        row["day"]: dict(row)
+        for row in conn.execute(
+            """
+            SELECT substr(m.created_at, 1, 10) AS day,
+                   SUM(CASE WHEN m.role = 'user' THEN 1 ELSE 0 END) AS prompt_count,
+                   COUNT(DISTINCT CASE
+                       WHEN m.role = 'user' AND u.role != 'Admin' THEN c.user_id
+                   END) AS active_users
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            JOIN users u ON u.id = c.user_id
+            WHERE m.created_at >= ? AND m.created_at < ?
+            GROUP BY day
+            """,
+            (start_day, end_bound),
+        )
+    }
+
+def db_load_daily_activity(start_day: str, end_day: str, today: str) -> dict:
+    conn = get_db()
+    days = []
+    current = date.fromisoformat(start_day)
+    while current.isoformat() <= end_day:
+        days.append(current.isoformat())
+        current += timedelta(days=1)
+    activity = {
+        row["day"]: dict(row)
+        for row in conn.execute(
+            "SELECT * FROM daily_activity WHERE day >= ? AND day <= ? AND day < ?",
+            (start_day, end_day, today),
+        )
+    }
+    missing = [day for day in days if day < today and day not in activity]
+    if missing:
+        computed = db_compute_daily_activity(missing[0], missing[-1])
+        empty = {"prompt_count": 0, "active_users": 0}
+        for day in missing:
+            activity[day] = {**empty, **computed.get(day, {}), "day": day}
+        with write_transaction() as write_conn:
+            write_conn.executemany(
+                """
+                INSERT INTO daily_activity (day, prompt_count, active_users)
+                VALUES (:day, :prompt_count, :active_users)
+                ON CONFLICT(day) DO UPDATE SET
+                    prompt_count = excluded.prompt_count,
+                    active_users = excluded.active_users
+                """,
+                [activity[day] for day in missing],
+            )
+    if start_day <= today <= end_day:
+        activity[today] = db_compute_daily_activity(today, today).get(
+            today, {"day": today, "prompt_count": 0, "active_users": 0}
+        )
+    return {day: activity[day] for day in days}
+
+def db_load_weekly_active_users(start_day: str, end_day: str) -> dict:
+    conn = get_db()
+    return {
+        row["week"]: row["active_users"]
+        for row in conn.execute(
+            f"""
+            SELECT {get_backend().week_start("d.day")} AS week,
+                   COUNT(DISTINCT d.user_id) AS active_users
+            FROM usage_by_day d
+            JOIN users u ON u.id = d.user_id
+            WHERE d.day >= ? AND d.day <= ? AND d.prompt_count > 0 AND u.role != 'Admin'
+            GROUP BY week
+            """,
+            (start_day, end_day),
+        )
+    }
+
+def db_record_api_usage(usage: dict):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO api_usage
+                (message_id, user_id, conversation_id, kind, model, prompt_tokens,
+                 completion_tokens, created_at)
+            VALUES
+                (:message_id, :user_id, :conversation_id, :kind, :model, :prompt_tokens,
+                 :completion_tokens, :created_at)
+            """,
+            usage,
+        )
+        conn.execute(
+            """
+            INSERT INTO usage_by_user (user_id, prompt_tokens, completion_tokens)
+            SELECT id, :prompt_tokens, :completion_tokens FROM users WHERE id = :user_id
+            ON CONFLICT(user_id) DO UPDATE SET
+                prompt_tokens = usage_by_user.prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = usage_by_user.completion_tokens + excluded.completion_tokens
+            """,
+            usage,
+        )
+        conn.execute(
+            """
+            INSERT INTO usage_by_day (day, user_id, prompt_tokens, completion_tokens)
+            SELECT :day, id, :prompt_tokens, :completion_tokens FROM users WHERE id = :user_id
+            ON CONFLICT(day, user_id) DO UPDATE SET
+                prompt_tokens = usage_by_day.prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = usage_by_day.completion_tokens + excluded.completion_tokens
+            """,
+            {**usage, "day": usage["created_at"][:10]},
+        )
+        conn.execute(
+            """
+            INSERT INTO usage_by_model (kind, model, calls, prompt_tokens, completion_tokens)
+            VALUES (:kind, :model, 1, :prompt_tokens, :completion_tokens)
+            ON CONFLICT(kind, model) DO UPDATE SET
+                calls = usage_by_model.calls + 1,
+                prompt_tokens = usage_by_model.prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = usage_by_model.completion_tokens + excluded.completion_tokens
+            """,
+            usage,
+        )
+
+def db_insert_image_job(job: dict):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO image_jobs (id, user_id, conversation_id, prompt, status, created_at)
+            VALUES (:id, :user_id, :conversation_id, :prompt, :status, :created_at)
+            """,
+            job,
+        )
+
+def db_mark_image_jobs_running(job_ids: list, started_at: str):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            UPDATE image_jobs SET status = 'running', started_at = ?
+            WHERE status = 'queued' AND id IN (SELECT value FROM json_each(?))
+            """,
+            (started_at, id_list_param(job_ids)),
+        )
+
+def db_finish_image_job(job: dict):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            UPDATE image_jobs
+            SET status = :status, coalesced = :coalesced, message_id = :message_id,
+                error = :error, finished_at = :finished_at
+            WHERE id = :id
+            """,
+            job,
+        )
+
+def api_call_conditions(filters: dict) -> tuple:
+    conditions = ["started_at >= ?", "started_at < ?"]
+    params = [filters["start_day"], filters["end_bound"]]
+    if filters.get("models"):
+        conditions.append("model IN (SELECT value FROM json_each(?))")
+        params.append(id_list_param(filters["models"]))
+    if filters.get("user_id"):
+        conditions.append("user_id = ?")
+        params.append(filters["user_id"])
+    if filters.get("failed") is not None:
+        conditions.append("error_class IS NOT NULL" if filters["failed"] else "error_class IS NULL")
+    return " AND ".join(conditions), params
+
+# Newest first, keyset-paged on (started_at, id) like db_load_recent_messages.
+def db_load_api_calls(filters: dict, limit: int, before: tuple | None = None) -> list:
+    conn = get_db()
+    where, params = api_call_conditions(filters)
+    if before is not None:
+        where += " AND (started_at, id) < (?, ?)"
+        params.extend(before)
+    return [
+        dict(row)
+        for row in conn.execute(
+            f"""
+            SELECT * FROM api_calls
+            WHERE {where}
+            ORDER BY started_at DESC, id DESC
+            LIMIT ?
+            """,
+            (*params, limit),
+        )
+    ]
+
+# Nearest-rank percentiles: the p-th percentile is the first value whose rank
+# reaches p * n.
+def db_load_api_latency_by_model(filters: dict) -> list:
+    conn = get_db()
+    where, params = api_call_conditions(filters)
+    return [
+        dict(row)
+        for row in conn.execute(
+            f"""
+            WITH ranked AS (
+                SELECT model, latency_ms, ttft_ms, error_class,
+                       ROW_NUMBER() OVER (PARTITION BY model ORDER BY latency_ms) AS position,
+                       COUNT(*) OVER (PARTITION BY model) AS calls
+                FROM api_calls
+                WHERE {where}
+            )
+            SELECT model,
+                   COUNT(*) AS calls,
+                   SUM(CASE WHEN error_class IS NOT NULL THEN 1 ELSE 0 END) AS errors,
+                   MIN(CASE WHEN position >= 0.50 * calls THEN latency_ms END) AS p50_ms,
+                   MIN(CASE WHEN position >= 0.95 * calls THEN latency_ms END) AS p95_ms,
+                   MIN(CASE WHEN position >= 0.99 * calls THEN latency_ms END) AS p99_ms,
+                   AVG(ttft_ms) AS avg_ttft_ms
+            FROM ranked
+            GROUP BY model
+            ORDER BY calls DESC
+            """,
+            params,
+        )
+    ]
+
+# Per route, with the same nearest-rank percentiles. Cost uses the current
+# model prices.
+def db_load_api_stats_by_route(filters: dict) -> list:
+    conn = get_db()
+    where, params = api_call_conditions(filters)
+    return [
+        dict(row)
+        for row in conn.execute(
+            f"""
+            WITH ranked AS (
+                SELECT COALESCE(route, 'manual') AS route, model, latency_ms, ttft_ms, error_class,
+                       prompt_tokens, completion_tokens,
+                       ROW_NUMBER() OVER (PARTITION BY COALESCE(route, 'manual') ORDER BY latency_ms)
+                           AS position,
+                       COUNT(*) OVER (PARTITION BY COALESCE(route, 'manual')) AS calls
+                FROM api_calls
+                WHERE {where}
+            )
+            SELECT r.route,
+                   COUNT(*) AS calls,
+                   SUM(CASE WHEN r.error_class IS NOT NULL THEN 1 ELSE 0 END) AS errors,
+                   MIN(CASE WHEN r.position >= 0.50 * r.calls THEN r.latency_ms END) AS p50_ms,
+                   MIN(CASE WHEN r.position >= 0.95 * r.calls THEN r.latency_ms END) AS p95_ms,
+                   AVG(r.ttft_ms) AS avg_ttft_ms,
+                   AVG(r.completion_tokens) AS avg_completion_tokens,
+                   SUM(COALESCE(r.prompt_tokens, 0) * COALESCE(p.input_per_million, 0)
+                       + COALESCE(r.completion_tokens, 0) * COALESCE(p.output_per_million, 0)) / 1000000.0
+                       AS cost
+            FROM ranked r
+            LEFT JOIN model_prices p ON p.model = r.model
+            GROUP BY r.route
+            ORDER BY calls DESC
+            """,
+            params,
+        )
+    ]
+
+def db_load_api_route_models(filters: dict) -> list:
+    conn = get_db()
+    where, params = api_call_conditions(filters)
+    return [
+        dict(row)
+        for row in conn.execute(
+            f"""
+            SELECT COALESCE(route, 'manual') AS route, model, COUNT(*) AS calls
+            FROM api_calls
+            WHERE {where}
+            GROUP BY COALESCE(route, 'manual'), model
+            ORDER BY calls DESC
+            """,
+            params,
+        )
+    ]
+
+# Recent chat calls per model, for the router's health check.
+def db_load_model_health(since: str) -> list:
+    conn = get_db()
+    return [
+        dict(row)
+        for row in conn.execute(
+            """
+            SELECT model,
+                   COUNT(*) AS calls,
+                   SUM(CASE WHEN error_class IS NOT NULL THEN 1 ELSE 0 END) AS errors,
+                   AVG(ttft_ms) AS avg_ttft_ms
+            FROM api_calls
+            WHERE kind = 'chat' AND started_at >= ?
+            GROUP BY model
+            """,
+            (since,),
+        )
+    ]
+
+def db_load_api_call_models() -> list:
+    conn = get_db()
+    return [row["model"] for row in conn.execute("SELECT DISTINCT model FROM api_calls ORDER BY model")]
+
+def db_load_usage_by_model() -> list:
+    conn = get_db()
+    return [
+        dict(row)
+        for row in conn.execute(
+            """
+            SELECT u.kind,
+                   u.model,
+                   u.calls,
+                   u.prompt_tokens,
+                   u.completion_tokens,
+                   (u.prompt_tokens * COALESCE(p.input_per_million, 0)
+                    + u.completion_tokens * COALESCE(p.output_per_million, 0)) / 1000000.0
+                       AS cost
+            FROM usage_by_model u
+            LEFT JOIN model_prices p ON p.model = u.model
+            ORDER BY cost DESC
+            """
+        )
+    ]
+
+def db_load_daily_token_usage(start_day: str, end_day: str) -> dict:
+    conn = get_db()
+    return {
+        row["day"]: row["tokens"]
+        for row in conn.execute(
+            """
+            SELECT day, SUM(prompt_tokens + completion_tokens) AS tokens
+            FROM usage_by_day
+            WHERE day >= ? AND day <= ?
+            GROUP BY day
+            """,
+            (start_day, end_day),
+        )
+    }
+
+def db_load_model_prices() -> list:
+    conn = get_db()
+    return [dict(row) for row in conn.execute("SELECT * FROM model_prices ORDER BY model")]
+
+def db_save_model_prices(prices: list):
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO model_prices (model, input_per_million, output_per_million)
+            VALUES (:model, :input_per_million, :output_per_million)
+            ON CONFLICT(model) DO UPDATE SET
+                input_per_million = excluded.input_per_million,
+                output_per_million = excluded.output_per_million
+            """,
+            prices,
+        )
+
+# Settings are stored as JSON so callers get back the type they saved.
+def db_load_settings(defaults: dict) -> dict:
+    conn = get_db()
+    settings = dict(defaults)
+    for row in conn.execute(
+        "SELECT key, value FROM app_settings WHERE key IN (SELECT value FROM json_each(?))",
+        (id_list_param(defaults),),
+    ):
+        settings[row["key"]] = json.loads(row["value"])
+    return settings
+
+def db_save_settings(settings: dict):
+    with write_transaction() as conn:
+        conn.executemany(
+            """
+            INSERT INTO app_settings (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """,
+            [(key, json.dumps(value)) for key, value in settings.items()],
+        )
+
+# The first caller's value wins, so instances starting together agree on it.
+def db_get_or_create_setting(key: str, value):
+    with write_transaction() as conn:
+        conn.execute(
+            "INSERT INTO app_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO NOTHING",
+            (key, json.dumps(value)),
+        )
+        row = conn.execute("SELECT value FROM app_settings WHERE key = ?", (key,)).fetchone()
+    return json.loads(row["value"])
+
+def db_increment_counter(name: str, amount: int = 1):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO app_counters (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = app_counters.value + excluded.value
+            """,
+            (name, amount),
+        )
+
+def db_load_counters(names: list) -> dict:
+    conn = get_db()
+    counters = {name: 0 for name in names}
+    for row in conn.execute(
+        "SELECT name, value FROM app_counters WHERE name IN (SELECT value FROM json_each(?))",
+        (id_list_param(names),),
+    ):
+        counters[row["name"]] = row["value"]
+    return counters
+
+def db_response_cache_get(key: str, min_created_at: str):
+    conn = get_db()
+    row = conn.execute(
+        "SELECT response FROM response_cache WHERE key = ? AND created_at >= ?",
+        (key, min_created_at),
+    ).fetchone()
+    return row["response"] if row else None
+
+def db_response_cache_touch(key: str, used_at: str):
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE response_cache SET hits = hits + 1, last_used_at = ? WHERE key = ?",
+            (used_at, key),
+        )
+
+# Expired entries go first, then least recently used ones until the cache
+# fits in max_bytes.
+def db_response_cache_put(
+    key: str, model: str, response: str, created_at: str, min_created_at: str, max_bytes: int
+):
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO response_cache (key, model, response, size, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                response = excluded.response,
+                size = excluded.size,
+                created_at = excluded.created_at,
+                last_used_at = excluded.last_used_at
+            """,
+            (key, model, response, len(response.encode("utf-8")), created_at, created_at),
+        )
+        conn.execute("DELETE FROM response_cache WHERE created_at < ?", (min_created_at,))
+        conn.execute(
+            """
+            DELETE FROM response_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (
+                        ORDER BY last_used_at DESC, key
+                    ) AS running_size
+                    FROM response_cache
+                ) AS sized
+                WHERE running_size > ?
+            )
+            """,
+            (max_bytes,),
+        )
+
+def db_response_cache_stats() -> dict:
+    conn = get_db()
+    row = conn.execute(
+        "SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS size FROM response_cache"
+    ).fetchone()
+    return dict(row)
+
+def db_load_usage_by_user() -> dict:
+    conn = get_db()
+    return {row["user_id"]: dict(row) for row in conn.execute("SELECT * FROM usage_by_user")}
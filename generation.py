@@ -0,0 +1,604 @@
+import base64
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from db import (
+    db_add_message,
+    db_finish_image_job,
+    db_increment_counter,
+    db_insert_image_job,
+    db_mark_image_jobs_running,
+    db_record_api_usage,
+    db_response_cache_put,
+    db_update_message_content,
+    log_api_call,
+    now_timestamp,
+    unit_of_work,
+)
+from image_store import store_image
+from metrics import observe
+from storage import DATABASE_ERRORS
+
+GENERATION_WORKERS = int(os.environ.get("CHATBOT_GENERATION_WORKERS", "8"))
+# Finished jobs stay attachable for a while so a session that reran during the
+# reply can still pick up its final state.
+JOB_RETENTION_SECONDS = 300
+# A streaming reply is checkpointed to its row every this many chunks (roughly
+# one token each) or this many seconds, whichever comes first, so a crash or
+# restart loses at most that much of the answer.
+CHECKPOINT_CHUNKS = int(os.environ.get("CHATBOT_CHECKPOINT_CHUNKS", "32"))
+CHECKPOINT_SECONDS = float(os.environ.get("CHATBOT_CHECKPOINT_SECONDS", "1.0"))
+# Image calls hold a worker for 10-30 s, so only a few run at once across all
+# sessions and the rest wait in a bounded queue.
+IMAGE_WORKERS = int(os.environ.get("CHATBOT_IMAGE_WORKERS", "2"))
+IMAGE_QUEUE_LIMIT = int(os.environ.get("CHATBOT_IMAGE_QUEUE_LIMIT", "32"))
+IMAGE_QUEUE_LIMIT_PER_USER = int(os.environ.get("CHATBOT_IMAGE_QUEUE_LIMIT_PER_USER", "3"))
+IMAGE_MODEL = "gpt-image-1"
+IMAGE_SIZE = "1024x1024"
+# Typical duration of one image call, used only to draw the progress bar.
+IMAGE_EXPECTED_SECONDS = 20
+# Stored, with status "failed", as the reply to an image request that failed.
+IMAGE_FAILED_REPLY = "[image generation failed]"
+
+# Statuses the OpenAI client retries on its own before giving up.
+RETRIED_STATUSES = (408, 409, 429)
+
+# Timing and outcome of one OpenAI request, handed to the buffered API call
+# log when it ends.
+class ApiCall:
+    def __init__(
+        self, client, kind: str, model: str, user_id: str, conversation_id: str, route: str | None = None
+    ):
+        self.client = client
+        self.record = {
+            "kind": kind,
+            "model": model,
+            "route": route,
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "started_at": now_timestamp(),
+            "ttft_ms": None,
+            "latency_ms": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "retries": 0,
+            "http_status": None,
+            "error_class": None,
+        }
+        self._start = time.monotonic()
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self._start) * 1000
+
+    def responded(self, raw_response):
+        self.record["http_status"] = raw_response.status_code
+        self.record["retries"] = raw_response.retries_taken
+
+    def first_token(self):
+        if self.record["ttft_ms"] is None:
+            self.record["ttft_ms"] = self.elapsed_ms()
+            observe("openai_ttft", self.record["ttft_ms"] / 1000, model=self.record["model"])
+
+    def finish(self, usage: dict | None = None, error: Exception | None = None):
+        if self.record["latency_ms"] is not None:
+            return
+        self.record["latency_ms"] = self.elapsed_ms()
+        observe(
+            "openai_request",
+            self.record["latency_ms"] / 1000,
+            kind=self.record["kind"],
+            model=self.record["model"],
+            outcome="error" if error is not None else "ok",
+        )
+        if usage:
+            self.record["prompt_tokens"] = usage.get("prompt_tokens")
+            self.record["completion_tokens"] = usage.get("completion_tokens")
+        if error is not None:
+            self.record["error_class"] = type(error).__name__
+            status = getattr(error, "status_code", None)
+            if status is not None:
+                self.record["http_status"] = status
+            # A failed request carries no retry count; one that failed in a
+            # way the client retries has used all of its attempts.
+            if isinstance(error, openai.APIConnectionError) or (
+                status is not None and (status in RETRIED_STATUSES or status >= 500)
+            ):
+                self.record["retries"] = getattr(self.client, "max_retries", 0)
+        log_api_call(self.record)
+
+# A completion owned by a worker thread. Text is appended as it streams in and
+# any number of script runs can follow it with stream(); a rerun only drops
+# the viewer, never the job. message_id and prefix are set when the job
+# regenerates or continues an existing reply instead of writing a new one;
+# route names the routing rule that picked the model, if one did.
+class GenerationJob:
+    def __init__(
+        self,
+        conversation_id: str,
+        user_id: str,
+        model: str,
+        messages: list,
+        cache: dict | None = None,
+        message_id: int | None = None,
+        prefix: str = "",
+        route: str | None = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.model = model
+        self.route = route
+        self.messages = messages
+        self.cache = cache
+        self.message_id = message_id
+        self.started = False
+        self.status = "queued"
+        self.error = None
+        self.usage = {}
+        self.message = None
+        self.finished_at = None
+        self._parts = [prefix] if prefix else []
+        self._changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("complete", "failed")
+
+    @property
+    def text(self) -> str:
+        with self._changed:
+            return "".join(self._parts)
+
+    def set_status(self, status: str):
+        with self._changed:
+            self.status = status
+            if self.done:
+                self.finished_at = time.monotonic()
+            self._changed.notify_all()
+
+    def append(self, text: str):
+        with self._changed:
+            self._parts.append(text)
+            self._changed.notify_all()
+
+    def stream(self, poll_seconds: float = 0.5):
+        position = 0
+        while True:
+            with self._changed:
+                while position == len(self._parts) and not self.done:
+                    self._changed.wait(poll_seconds)
+                parts = self._parts[position:]
+                position += len(parts)
+                finished = self.done and position == len(self._parts)
+            yield from parts
+            if finished:
+                return
+
+# Called at the first token: the reply gets its row (or takes over the one it
+# regenerates) before the answer is complete.
+def start_reply(job: GenerationJob):
+    if job.message_id is None:
+        job.message_id = db_add_message(
+            job.conversation_id, "assistant", job.text, now_timestamp(), status="streaming"
+        )
+    else:
+        db_update_message_content(job.message_id, job.text, "streaming")
+    job.started = True
+
+def finish_reply(job: GenerationJob, status: str):
+    text = job.text
+    created_at = now_timestamp()
+    message = {
+        "id": job.message_id,
+        "role": "assistant",
+        "content": text,
+        "created_at": created_at,
+        "status": status,
+    }
+    with unit_of_work() as unit:
+        if job.message_id is None:
+            unit.add(
+                db_add_message,
+                job.conversation_id,
+                "assistant",
+                text,
+                created_at,
+                status,
+                on_done=lambda message_id: message.update(id=message_id),
+            )
+        else:
+            unit.add(db_update_message_content, job.message_id, text, status)
+        if job.usage:
+            unit.add(
+                lambda: db_record_api_usage(
+                    {
+                        "message_id": message["id"],
+                        "user_id": job.user_id,
+                        "conversation_id": job.conversation_id,
+                        "kind": "chat",
+                        "model": job.model,
+                        "prompt_tokens": job.usage.get("prompt_tokens", 0),
+                        "completion_tokens": job.usage.get("completion_tokens", 0),
+                        "created_at": created_at,
+                    }
+                )
+            )
+        if job.cache is not None:
+            unit.add(db_increment_counter, "response_cache_misses")
+            if text and status == "complete":
+                unit.add(
+                    db_response_cache_put,
+                    job.cache["key"],
+                    job.model,
+                    text,
+                    created_at,
+                    job.cache["cutoff"],
+                    job.cache["max_bytes"],
+                )
+    job.message_id = message["id"]
+    return message
+
+def run_chat_job(job: GenerationJob, client):
+    job.set_status("running")
+    call = ApiCall(client, "chat", job.model, job.user_id, job.conversation_id, job.route)
+    try:
+        raw_response = client.chat.completions.with_raw_response.create(
+            model=job.model,
+            messages=job.messages,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        call.responded(raw_response)
+        stream = raw_response.parse()
+        pending_chunks = 0
+        checkpoint_at = 0.0
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                job.usage = {
+                    "prompt_tokens": chunk.usage.prompt_tokens,
+                    "completion_tokens": chunk.usage.completion_tokens,
+                }
+            if not (chunk.choices and chunk.choices[0].delta.content):
+                continue
+            call.first_token()
+            job.append(chunk.choices[0].delta.content)
+            pending_chunks += 1
+            if not job.started:
+                start_reply(job)
+            elif pending_chunks >= CHECKPOINT_CHUNKS or time.monotonic() >= checkpoint_at:
+                db_update_message_content(job.message_id, job.text, "streaming")
+            else:
+                continue
+            pending_chunks = 0
+            checkpoint_at = time.monotonic() + CHECKPOINT_SECONDS
+        call.finish(job.usage)
+        job.message = finish_reply(job, "complete")
+    except Exception as exc:
+        call.finish(job.usage, exc)
+        job.error = exc
+        try:
+            # Keep whatever arrived so the reply can be continued or regenerated.
+            job.message = finish_reply(job, "failed")
+        except Exception:
+            pass
+        job.set_status("failed")
+        return
+    job.set_status("complete")
+
+class GenerationManager:
+    def __init__(self, max_workers: int = GENERATION_WORKERS):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="generation"
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job: GenerationJob, client):
+        with self._lock:
+            self._prune()
+            self._jobs[job.conversation_id] = job
+        self._executor.submit(run_chat_job, job, client)
+        return job
+
+    def job_for_conversation(self, conversation_id: str):
+        with self._lock:
+            return self._jobs.get(conversation_id)
+
+    def _prune(self):
+        expires_before = time.monotonic() - JOB_RETENTION_SECONDS
+        for conversation_id, job in list(self._jobs.items()):
+            if job.done and job.finished_at < expires_before:
+                del self._jobs[conversation_id]
+
+generation_manager = GenerationManager()
+
+class ImageQueueFull(Exception):
+    pass
+
+# One image request from one chat. Requests for the same prompt that are in
+# flight together share a single ImageTask (and a single API call), but each
+# gets its own reply message.
+class ImageJob:
+    def __init__(self, conversation_id: str, user_id: str, prompt: str, route: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.route = route
+        self.message_id = None
+        self.task = None
+        self.coalesced = False
+        self.status = "queued"
+        self.error = None
+        self.message = None
+        self.finished_at = None
+        self._finished = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("complete", "failed")
+
+    @property
+    def elapsed(self) -> float:
+        if self.task is None or self.task.started_at is None:
+            return 0.0
+        return time.monotonic() - self.task.started_at
+
+    def finish(self, status: str, message: dict | None, error=None):
+        self.message = message
+        self.message_id = message["id"] if message else None
+        self.error = error
+        self.status = status
+        self.finished_at = time.monotonic()
+        self._finished.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._finished.wait(timeout)
+
+class ImageTask:
+    def __init__(self, key: tuple, prompt: str, user_id: str, client):
+        self.key = key
+        self.prompt = prompt
+        self.user_id = user_id
+        self.client = client
+        self.jobs = []
+        self.status = "queued"
+        self.started_at = None
+
+def image_request_key(prompt: str) -> tuple:
+    return (IMAGE_MODEL, IMAGE_SIZE, " ".join(prompt.split()).lower())
+
+def persist_image_replies(jobs: list, image_sha256: str | None, usage):
+    created_at = now_timestamp()
+    content = "[image]" if image_sha256 else IMAGE_FAILED_REPLY
+    status = "complete" if image_sha256 else "failed"
+    messages = []
+    with unit_of_work() as unit:
+        for job in jobs:
+            message = {
+                "id": None,
+                "role": "assistant",
+                "content": content,
+                "created_at": created_at,
+                "status": status,
+                "image_sha256": image_sha256,
+            }
+            messages.append(message)
+            unit.add(
+                db_add_message,
+                job.conversation_id,
+                "assistant",
+                content,
+                created_at,
+                status,
+                image_sha256,
+                on_done=lambda message_id, message=message: message.update(id=message_id),
+            )
+            unit.add(
+                lambda job=job, message=message: db_finish_image_job(
+                    {
+                        "id": job.id,
+                        "status": status,
+                        "coalesced": int(job.coalesced),
+                        "message_id": message["id"],
+                        "error": str(job.error) if job.error else None,
+                        "finished_at": created_at,
+                    }
+                )
+            )
+        # The API call is paid once, by the request that made it.
+        if usage is not None:
+            unit.add(
+                lambda: db_record_api_usage(
+                    {
+                        "message_id": messages[0]["id"],
+                        "user_id": jobs[0].user_id,
+                        "conversation_id": jobs[0].conversation_id,
+                        "kind": "image",
+                        "model": IMAGE_MODEL,
+                        "prompt_tokens": usage.input_tokens,
+                        "completion_tokens": usage.output_tokens,
+                        "created_at": created_at,
+                    }
+                )
+            )
+    return messages
+
+def generate_image(task: ImageTask):
+    first = task.jobs[0]
+    call = ApiCall(task.client, "image", IMAGE_MODEL, task.user_id, first.conversation_id, first.route)
+    try:
+        raw_response = task.client.images.with_raw_response.generate(
+            model=IMAGE_MODEL, prompt=task.prompt, size=IMAGE_SIZE
+        )
+        call.responded(raw_response)
+        image = raw_response.parse()
+        image_sha256 = store_image(base64.b64decode(image.data[0].b64_json))
+    except Exception as exc:
+        call.finish(error=exc)
+        return None, None, exc
+    usage = getattr(image, "usage", None)
+    call.finish(
+        {"prompt_tokens": usage.input_tokens, "completion_tokens": usage.output_tokens}
+        if usage is not None
+        else None
+    )
+    return image_sha256, usage, None
+
+def finish_image_jobs(jobs: list, image_sha256: str | None, usage, error):
+    for job in jobs:
+        job.error = error
+    try:
+        messages = persist_image_replies(jobs, image_sha256, usage)
+    except Exception as exc:
+        messages = [None] * len(jobs)
+        error = error or exc
+    for job, message in zip(jobs, messages):
+        job.finish("failed" if error else "complete", message, error)
+
+# Runs image requests on a fixed number of workers. Waiting requests are kept
+# per user and served round-robin, so one user queueing several images does
+# not hold everyone else back; a prompt already queued or running is joined
+# rather than generated again.
+class ImageQueue:
+    def __init__(
+        self,
+        workers: int = IMAGE_WORKERS,
+        limit: int = IMAGE_QUEUE_LIMIT,
+        limit_per_user: int = IMAGE_QUEUE_LIMIT_PER_USER,
+    ):
+        self.workers = workers
+        self.limit = limit
+        self.limit_per_user = limit_per_user
+        self._waiting = {}
+        self._tasks = {}
+        self._jobs = {}
+        self._threads = []
+        self._changed = threading.Condition()
+
+    def submit(self, job: ImageJob, client) -> ImageJob:
+        db_insert_image_job(
+            {
+                "id": job.id,
+                "user_id": job.user_id,
+                "conversation_id": job.conversation_id,
+                "prompt": job.prompt,
+                "status": "queued",
+                "created_at": now_timestamp(),
+            }
+        )
+        key = image_request_key(job.prompt)
+        with self._changed:
+            self._prune()
+            task = self._tasks.get(key)
+            if task is None:
+                waiting = sum(len(tasks) for tasks in self._waiting.values())
+                if waiting >= self.limit:
+                    error = ImageQueueFull("The image queue is full. Try again in a minute.")
+                elif len(self._waiting.get(job.user_id, ())) >= self.limit_per_user:
+                    error = ImageQueueFull(
+                        f"You already have {self.limit_per_user} images waiting. "
+                        "Try again when one of them is done."
+                    )
+                else:
+                    error = None
+                if error is not None:
+                    job.finish("failed", None, error)
+                else:
+                    task = ImageTask(key, job.prompt, job.user_id, client)
+                    self._tasks[key] = task
+                    self._waiting.setdefault(job.user_id, deque()).append(task)
+                    self._start_workers()
+                    self._changed.notify()
+            else:
+                job.coalesced = True
+                job.status = task.status
+            if task is not None:
+                job.task = task
+                task.jobs.append(job)
+                self._jobs[job.conversation_id] = job
+        if job.done:
+            db_finish_image_job(
+                {
+                    "id": job.id,
+                    "status": "failed",
+                    "coalesced": 0,
+                    "message_id": None,
+                    "error": str(job.error),
+                    "finished_at": now_timestamp(),
+                }
+            )
+            raise job.error
+        return job
+
+    def job_for_conversation(self, conversation_id: str):
+        with self._changed:
+            return self._jobs.get(conversation_id)
+
+    # 1-based place of the job's request in the order the workers will take
+    # them, or 0 once it is running.
+    def position(self, job: ImageJob) -> int:
+        with self._changed:
+            queues = [list(tasks) for tasks in self._waiting.values()]
+            position = 0
+            for round_index in range(max(map(len, queues), default=0)):
+                for tasks in queues:
+                    if round_index < len(tasks):
+                        position += 1
+                        if tasks[round_index] is job.task:
+                            return position
+            return 0
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._run, name=f"image-{len(self._threads)}", daemon=True
+            )
+            self._threads.append(thread)
+            thread.start()
+
+    def _next_task(self) -> ImageTask:
+        # The user served goes to the back of the rotation.
+        user_id = next(iter(self._waiting))
+        tasks = self._waiting.pop(user_id)
+        task = tasks.popleft()
+        if tasks:
+            self._waiting[user_id] = tasks
+        return task
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._waiting:
+                    self._changed.wait()
+                task = self._next_task()
+                task.status = "running"
+                task.started_at = time.monotonic()
+                for job in task.jobs:
+                    job.status = "running"
+                job_ids = [job.id for job in task.jobs]
+            try:
+                db_mark_image_jobs_running(job_ids, now_timestamp())
+            except DATABASE_ERRORS:
+                pass
+            result = generate_image(task)
+            with self._changed:
+                # Closed to new requests before the replies are written, so
+                # every job that joined gets one.
+                del self._tasks[task.key]
+                jobs = list(task.jobs)
+            finish_image_jobs(jobs, *result)
+
+    def _prune(self):
+        expires_before = time.monotonic() - JOB_RETENTION_SECONDS
+        for conversation_id, job in list(self._jobs.items()):
+            if job.done and job.finished_at < expires_before:
+                del self._jobs[conversation_id]
+
+image_queue = ImageQueue()
@@ -0,0 +1,75 @@
+import hashlib
+import io
+import os
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from db import get_db_path
+
+# Longest side of the thumbnails shown in chat history.
+THUMBNAIL_SIZE = int(os.environ.get("CHATBOT_THUMBNAIL_SIZE", "320"))
+
+def get_image_dir() -> str:
+    image_dir = os.path.join(os.path.dirname(get_db_path()), "images")
+    os.makedirs(image_dir, exist_ok=True)
+    return image_dir
+
+# Files are sharded by the first two hex digits so no directory grows to
+# hold every image.
+def blob_path(sha256: str, suffix: str) -> str:
+    return os.path.join(get_image_dir(), sha256[:2], f"{sha256}{suffix}")
+
+def image_path(sha256: str) -> str:
+    return blob_path(sha256, ".png")
+
+def thumbnail_path(sha256: str) -> str:
+    path = blob_path(sha256, ".thumb.jpg")
+    if os.path.exists(path):
+        return path
+    # Without Pillow no thumbnail was written; the original stands in.
+    return image_path(sha256)
+
+def write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under a temporary name and renamed, so a reader never sees a
+    # partial file and concurrent writers of the same image simply race to an
+    # identical result.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def make_thumbnail(data: bytes) -> bytes | None:
+    if Image is None:
+        return None
+    output = io.BytesIO()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            image.convert("RGB").save(output, format="JPEG", quality=85)
+    except OSError:
+        # A format Pillow cannot read is still stored; it just has no thumbnail.
+        return None
+    return output.getvalue()
+
+# Stores an image under the SHA-256 of its bytes and returns the hash. An
+# image that is already stored is not written again.
+def store_image(data: bytes) -> str:
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = image_path(sha256)
+    if not os.path.exists(path):
+        write_file(path, data)
+    thumb = blob_path(sha256, ".thumb.jpg")
+    if not os.path.exists(thumb):
+        thumbnail = make_thumbnail(data)
+        if thumbnail is not None:
+            write_file(thumb, thumbnail)
+    return sha256
@@ -0,0 +1,172 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from db import get_db_path
+
+ENABLED = os.environ.get("CHATBOT_METRICS", "1") not in ("0", "false", "no")
+# Snapshots are written next to the database this often, for a Prometheus
+# textfile collector or anything else that reads JSON. 0 turns files off.
+EXPORT_SECONDS = float(os.environ.get("CHATBOT_METRICS_EXPORT_SECONDS", "15"))
+# Upper bounds in seconds, from a fast index lookup to a slow image call.
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"counts": list(self.counts), "count": self.count, "sum": self.total}
+
+# Estimated from the buckets by linear interpolation, as Prometheus'
+# histogram_quantile does; observations past the last bucket report its bound.
+def quantile(snapshot: dict, q: float) -> float | None:
+    if not snapshot["count"]:
+        return None
+    rank = q * snapshot["count"]
+    seen = 0
+    for index, count in enumerate(snapshot["counts"]):
+        if count and seen + count >= rank:
+            if index == len(BUCKETS):
+                return BUCKETS[-1]
+            lower = BUCKETS[index - 1] if index else 0.0
+            return lower + (BUCKETS[index] - lower) * (rank - seen) / count
+        seen += count
+    return BUCKETS[-1]
+
+class Registry:
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, labels: tuple) -> Histogram:
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot(self) -> list:
+        with self._lock:
+            items = list(self._histograms.items())
+        return [
+            {"name": name, "labels": dict(labels), **histogram.snapshot()}
+            for (name, labels), histogram in sorted(items)
+        ]
+
+registry = Registry()
+
+class Span:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: tuple):
+        self.name = name
+        self.labels = labels
+        self.start = time.perf_counter()
+
+    def end(self):
+        registry.histogram(self.name, self.labels).observe(time.perf_counter() - self.start)
+
+class NoopSpan:
+    __slots__ = ()
+
+    def end(self):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+def start_span(name: str, **labels) -> Span | NoopSpan:
+    if not ENABLED:
+        return NOOP_SPAN
+    return Span(name, tuple(sorted(labels.items())))
+
+@contextmanager
+def span(name: str, **labels):
+    current = start_span(name, **labels)
+    try:
+        yield
+    finally:
+        current.end()
+
+def observe(name: str, seconds: float, **labels):
+    if ENABLED:
+        registry.histogram(name, tuple(sorted(labels.items()))).observe(seconds)
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+def prometheus_text() -> str:
+    lines = []
+    described = set()
+    for item in registry.snapshot():
+        metric = f"chatbot_{item['name']}_seconds"
+        if metric not in described:
+            lines.append(f"# TYPE {metric} histogram")
+            described.add(metric)
+        cumulative = 0
+        for bound, count in zip((*BUCKETS, "+Inf"), item["counts"]):
+            cumulative += count
+            labels = prometheus_labels({**item["labels"], "le": bound})
+            lines.append(f"{metric}_bucket{labels} {cumulative}")
+        labels = prometheus_labels(item["labels"])
+        lines.append(f"{metric}_sum{labels} {item['sum']}")
+        lines.append(f"{metric}_count{labels} {item['count']}")
+    return "\n".join(lines) + "\n"
+
+def json_text() -> str:
+    return json.dumps({"buckets": BUCKETS, "histograms": registry.snapshot()})
+
+def write_exports():
+    data_dir = os.path.dirname(get_db_path())
+    for filename, text in (("metrics.prom", prometheus_text()), ("metrics.json", json_text())):
+        path = os.path.join(data_dir, filename)
+        # Renamed into place so a collector never reads half a file.
+        with open(f"{path}.tmp", "w", encoding="utf-8") as handle:
+            handle.write(text)
+        os.replace(f"{path}.tmp", path)
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+def _export_loop():
+    while True:
+        time.sleep(EXPORT_SECONDS)
+        try:
+            write_exports()
+        except OSError:
+            continue
+
+def start_exporter():
+    global _exporter
+    if not ENABLED or EXPORT_SECONDS <= 0 or _exporter is not None:
+        return
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = threading.Thread(target=_export_loop, name="metrics-exporter", daemon=True)
+            _exporter.start()
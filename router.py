@@ -0,0 +1,190 @@
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from db import db_load_model_health
+from tokens import count_tokens
+
+CHAT_MODELS = ["gpt-4o", "gpt-4o-mini"]
+AUTO_MODEL = "Auto"
+IMAGE_ROUTE = "image"
+# Used when a rule's model is unhealthy and the rule names no fallback.
+FALLBACK_MODELS = {"gpt-4o": "gpt-4o-mini", "gpt-4o-mini": "gpt-4o"}
+
+# Live health comes from the API call log, read at most this often and over
+# this many recent minutes. A model is avoided while its chat calls fail or
+# start slowly this much, once it has enough calls to judge by.
+HEALTH_REFRESH_SECONDS = float(os.environ.get("CHATBOT_ROUTER_HEALTH_SECONDS", "30"))
+HEALTH_WINDOW_MINUTES = int(os.environ.get("CHATBOT_ROUTER_HEALTH_WINDOW_MINUTES", "15"))
+HEALTH_MIN_CALLS = int(os.environ.get("CHATBOT_ROUTER_HEALTH_MIN_CALLS", "5"))
+UNHEALTHY_ERROR_RATE = float(os.environ.get("CHATBOT_ROUTER_UNHEALTHY_ERROR_RATE", "0.25"))
+UNHEALTHY_TTFT_MS = float(os.environ.get("CHATBOT_ROUTER_UNHEALTHY_TTFT_MS", "8000"))
+
+IMAGE_KEYWORDS = [
+    "image",
+    "picture",
+    "photo",
+    "draw",
+    "illustration",
+    "logo",
+    "generate an image",
+    "create an image",
+    "make an image",
+]
+
+# Checked in order; a prompt gets the first intent with a phrase matching
+# whole words, or "chat" when none match.
+INTENTS = {
+    "code": ["code", "python", "javascript", "sql", "regex", "function", "script", "stack trace"],
+    "analysis": [
+        "analyze", "analyse", "compare", "evaluate", "pros and cons", "why", "strategy", "plan",
+        "research", "audit",
+    ],
+    "edit": [
+        "rewrite", "rephrase", "shorten", "proofread", "polish", "tweak", "fix", "make it",
+        "tone", "typo", "translate", "summarize", "summarise", "shorter", "longer",
+    ],
+}
+
+# Rules are tried in order and the first whose conditions all hold picks the
+# route. A rule without conditions matches everything, so the last one is the
+# default. Admins edit this list in the Routing section.
+DEFAULT_RULES = [
+    {"name": "image", "route": IMAGE_ROUTE, "keywords": IMAGE_KEYWORDS},
+    {"name": "complex", "route": "gpt-4o", "intents": ["code", "analysis"]},
+    {"name": "long-prompt", "route": "gpt-4o", "min_prompt_tokens": 400},
+    {"name": "long-history", "route": "gpt-4o", "min_history_tokens": 8000},
+    {"name": "default", "route": "gpt-4o-mini"},
+]
+ROUTER_DEFAULTS = {"router_rules": DEFAULT_RULES}
+
+RULE_CONDITIONS = {
+    "keywords": list,
+    "intents": list,
+    "min_prompt_tokens": int,
+    "max_prompt_tokens": int,
+    "min_history_tokens": int,
+    "max_history_tokens": int,
+}
+
+INTENT_PATTERNS = {
+    intent: re.compile(r"\b(?:" + "|".join(map(re.escape, phrases)) + r")\b")
+    for intent, phrases in INTENTS.items()
+}
+
+def detect_intent(text: str) -> str:
+    lowered = text.lower()
+    for intent, pattern in INTENT_PATTERNS.items():
+        if pattern.search(lowered):
+            return intent
+    return "chat"
+
+# Returns a list of problems; an empty list means the rules can be saved.
+def validate_rules(rules) -> list:
+    if not isinstance(rules, list) or not rules:
+        return ["Rules must be a non-empty list."]
+    problems = []
+    routes = CHAT_MODELS + [IMAGE_ROUTE]
+    for index, rule in enumerate(rules, start=1):
+        if not isinstance(rule, dict):
+            problems.append(f"Rule {index} is not an object.")
+            continue
+        label = rule.get("name") or f"Rule {index}"
+        if not isinstance(rule.get("name"), str) or not rule["name"].strip():
+            problems.append(f"{label}: needs a name.")
+        if rule.get("route") not in routes:
+            problems.append(f"{label}: route must be one of {', '.join(routes)}.")
+        if "fallback" in rule and rule["fallback"] not in CHAT_MODELS:
+            problems.append(f"{label}: fallback must be one of {', '.join(CHAT_MODELS)}.")
+        for key, value in rule.items():
+            if key in ("name", "route", "fallback"):
+                continue
+            expected = RULE_CONDITIONS.get(key)
+            if expected is None:
+                problems.append(f"{label}: unknown condition {key!r}.")
+            elif not isinstance(value, expected) or isinstance(value, bool):
+                problems.append(f"{label}: {key} must be a {expected.__name__}.")
+            elif expected is list and not all(isinstance(item, str) for item in value):
+                problems.append(f"{label}: {key} must list strings.")
+    return problems
+
+def rule_matches(rule: dict, facts: dict) -> bool:
+    if "keywords" in rule and not any(
+        keyword.lower() in facts["lowered"] for keyword in rule["keywords"]
+    ):
+        return False
+    if "intents" in rule and facts["intent"] not in rule["intents"]:
+        return False
+    for fact in ("prompt_tokens", "history_tokens"):
+        if facts[fact] < rule.get(f"min_{fact}", 0):
+            return False
+        if f"max_{fact}" in rule and facts[fact] > rule[f"max_{fact}"]:
+            return False
+    return True
+
+class ModelHealth:
+    def __init__(self, refresh_seconds: float = HEALTH_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._stats = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_seconds:
+                since = datetime.now() - timedelta(minutes=HEALTH_WINDOW_MINUTES)
+                self._stats = {
+                    row["model"]: row
+                    for row in db_load_model_health(since.strftime("%Y-%m-%d %H:%M:%S"))
+                }
+                self._loaded_at = time.monotonic()
+            return self._stats
+
+    # Returns why the model should be avoided, or None while it looks fine.
+    def problem(self, model: str) -> str | None:
+        row = self.stats().get(model)
+        if row is None or row["calls"] < HEALTH_MIN_CALLS:
+            return None
+        if row["errors"] / row["calls"] >= UNHEALTHY_ERROR_RATE:
+            return f"{row['errors']} of {row['calls']} recent calls failed"
+        if row["avg_ttft_ms"] is not None and row["avg_ttft_ms"] >= UNHEALTHY_TTFT_MS:
+            return f"first tokens take {row['avg_ttft_ms'] / 1000:.1f} s"
+        return None
+
+model_health = ModelHealth()
+
+# Picks how a prompt is answered. With a model picked by hand only image rules
+# apply and route is None; in Auto mode every rule applies, and a model that
+# is failing or slow right now is swapped for its fallback if that one is
+# healthy. history_tokens is the size of the conversation so far.
+def route_prompt(prompt: str, history_tokens: int, selected_model: str, rules: list) -> dict:
+    facts = {
+        "lowered": prompt.strip().lower(),
+        "intent": detect_intent(prompt),
+        "prompt_tokens": count_tokens(prompt),
+        "history_tokens": history_tokens,
+    }
+    auto = selected_model == AUTO_MODEL
+    route = {"route": None, "model": selected_model, "image": False, "intent": facts["intent"], "note": None}
+    for rule in rules:
+        if not auto and rule["route"] != IMAGE_ROUTE:
+            continue
+        if not rule_matches(rule, facts):
+            continue
+        route["route"] = rule["name"]
+        if rule["route"] == IMAGE_ROUTE:
+            route.update(model=None, image=True)
+            return route
+        model = rule["route"]
+        problem = model_health.problem(model)
+        fallback = rule.get("fallback") or FALLBACK_MODELS.get(model)
+        if problem and fallback and model_health.problem(fallback) is None:
+            route["note"] = f"{model} skipped: {problem}"
+            model = fallback
+        route["model"] = model
+        return route
+    if auto:
+        route.update(route="unmatched", model=CHAT_MODELS[-1])
+    return route
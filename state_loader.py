@@ -0,0 +1,159 @@
+from types import SimpleNamespace
+
+from archive import restore_conversation
+from db import (
+    db_load_conversation_headers,
+    db_load_conversations_for_users,
+    db_load_messages_before,
+    db_load_messages_by_ids,
+    db_load_messages_since,
+    db_load_users,
+    db_max_message_id,
+)
+
+# Loads users, conversations and messages into a session's state: either
+# st.session_state or, outside Streamlit (benchmarks), the namespace returned
+# by empty_state(). Repeat loads only read what changed since the last one.
+
+def empty_state():
+    return SimpleNamespace(
+        users={},
+        user_conversations={},
+        message_watermarks={},
+        windowed_user_ids=set(),
+    )
+
+def load_users_from_db(state, user_ids: list | None = None):
+    state.users.update(db_load_users(user_ids))
+
+def sync_conversations(state, user_ids: list):
+    watermarks = state.message_watermarks
+    conversations_by_user = {user_id: [] for user_id in user_ids}
+    for header in db_load_conversation_headers(user_ids):
+        conversations_by_user[header["user_id"]].append(header)
+
+    for user_id, headers in conversations_by_user.items():
+        conversations = state.user_conversations.setdefault(user_id, [])
+        loaded = {conversation["id"]: conversation for conversation in conversations}
+        conversations[:] = []
+        for header in headers:
+            conversation = loaded.get(header["id"])
+            if conversation is None:
+                conversation = {
+                    "id": header["id"],
+                    "title": header["title"],
+                    "messages": [],
+                    "has_earlier": False,
+                    "created_at": header["created_at"],
+                    "archived_at": header["archived_at"],
+                }
+            else:
+                # Renames made in another session replace the cached title.
+                conversation.update(title=header["title"], created_at=header["created_at"])
+                # A chat archived since it was loaded has lost its messages; it
+                # is read back when it is opened. The flag is only cleared by
+                # opening it, even if another session restored it first.
+                if header["archived_at"] and not conversation.get("archived_at"):
+                    conversation.update(
+                        archived_at=header["archived_at"], messages=[], has_earlier=False
+                    )
+            conversations.append(conversation)
+
+    # A reply that was still streaming when it was loaded keeps changing in
+    # place, below the watermark; only the last message of a chat can be one.
+    unfinished = {}
+    for user_id in user_ids:
+        for conversation in state.user_conversations[user_id]:
+            messages = conversation["messages"]
+            if messages and messages[-1].get("status", "complete") == "streaming":
+                unfinished[messages[-1]["id"]] = messages[-1]
+    if unfinished:
+        for row in db_load_messages_by_ids(list(unfinished)):
+            unfinished[row["id"]].update(content=row["content"], status=row["status"])
+
+    since = min(watermarks[user_id] for user_id in user_ids)
+    changed = {}
+    for row in db_load_messages_since(since, user_ids):
+        changed.setdefault(row["conversation_id"], []).append(row)
+    if not changed:
+        return
+    for user_id in user_ids:
+        for conversation in state.user_conversations[user_id]:
+            rows = changed.get(conversation["id"])
+            if not rows:
+                continue
+            messages = conversation["messages"]
+            known_ids = {message.get("id") for message in messages}
+            for row in rows:
+                if row["id"] > watermarks[user_id] and row["id"] not in known_ids:
+                    messages.append(
+                        {
+                            "id": row["id"],
+                            "role": row["role"],
+                            "content": row["content"],
+                            "created_at": row["created_at"],
+                            "status": row["status"],
+                            "image_sha256": row["image_sha256"],
+                        }
+                    )
+            messages.sort(key=lambda message: message.get("id") or 0)
+
+# Chat views load a window of recent messages per conversation; admin
+# aggregates pass window=None and need the complete history.
+def load_state_from_db(state, user_ids: list | None = None, window: int | None = None):
+    if user_ids is None:
+        load_users_from_db(state)
+        user_ids = list(state.users.keys())
+    else:
+        load_users_from_db(state, user_ids)
+    user_ids = [user_id for user_id in user_ids if user_id in state.users]
+    if not user_ids:
+        return
+
+    watermarks = state.message_watermarks
+    windowed_ids = state.windowed_user_ids
+    watermark = db_max_message_id()
+    new_ids = [
+        user_id
+        for user_id in user_ids
+        if user_id not in watermarks or (window is None and user_id in windowed_ids)
+    ]
+    known_ids = [user_id for user_id in user_ids if user_id not in new_ids]
+    if new_ids:
+        state.user_conversations.update(
+            db_load_conversations_for_users(new_ids, window)
+        )
+        if window is None:
+            windowed_ids.difference_update(new_ids)
+        else:
+            windowed_ids.update(new_ids)
+    if known_ids:
+        sync_conversations(state, known_ids)
+    for user_id in user_ids:
+        watermarks[user_id] = watermark
+
+def load_earlier_messages(conversation: dict, count: int):
+    messages = conversation["messages"]
+    if not conversation.get("has_earlier") or not messages or not messages[0].get("id"):
+        return
+    older = db_load_messages_before(conversation["id"], messages[0]["id"], count + 1)
+    conversation["has_earlier"] = len(older) > count
+    messages[:0] = older[-count:]
+
+# Drops the oldest loaded messages past keep; load_earlier_messages reads them
+# back when the user scrolls up.
+def trim_messages(conversation: dict, keep: int):
+    messages = conversation["messages"]
+    if len(messages) <= keep or not messages[-keep].get("id"):
+        return
+    del messages[:-keep]
+    conversation["has_earlier"] = True
+
+# Brings an archived chat back into the messages table and loads its newest
+# count messages in place of the ones it had when it was archived.
+def rehydrate_conversation(conversation: dict, count: int):
+    if not conversation.get("archived_at"):
+        return
+    restore_conversation(conversation["id"])
+    rows = db_load_messages_before(conversation["id"], db_max_message_id() + 1, count + 1)
+    conversation.update(archived_at=None, has_earlier=len(rows) > count, messages=rows[-count:])
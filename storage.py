@@ -0,0 +1,367 @@
+import queue
+import re
+import sqlite3
+
+try:
+    import psycopg
+    import psycopg_pool
+    from psycopg.adapt import Loader
+    from psycopg.rows import dict_row
+except ImportError:
+    psycopg = None
+
+# Raised by either backend; the background writers catch these and retry.
+DATABASE_ERRORS = (sqlite3.Error,) if psycopg is None else (sqlite3.Error, psycopg.Error)
+
+class SQLiteBackend:
+    dialect = "sqlite"
+
+    def __init__(self, path: str, max_idle: int, pragmas: dict, busy_timeout_ms: int):
+        self.key = path
+        self.path = path
+        self.max_idle = max_idle
+        self.pragmas = pragmas
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle = queue.LifoQueue()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.max_idle:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    # IMMEDIATE takes the write lock up front, so a transaction that reads
+    # before it writes cannot be overtaken by another writer.
+    def begin(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+
+    def table_exists(self, conn, name: str) -> bool:
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).fetchone() is not None
+
+    def columns(self, conn, table: str) -> set:
+        return {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+    # Monday of the week a 'YYYY-MM-DD' value falls in.
+    def week_start(self, column: str) -> str:
+        return f"date({column}, '-6 days', 'weekday 1')"
+
+    # External-content FTS5 tables: the text stays in messages and conversations
+    # and the triggers keep the index in step with every write. Replies still
+    # streaming are left out until they are finished.
+    def create_search_index(self, conn):
+        has_search_index = self.table_exists(conn, "messages_fts")
+        conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, content='messages', content_rowid='id',
+                tokenize='porter unicode61 remove_diacritics 2'
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+                title, content='conversations', content_rowid='rowid',
+                tokenize='porter unicode61 remove_diacritics 2'
+            )
+            """
+        )
+        # executescript() would commit the surrounding transaction.
+        for statement in (
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            WHEN new.status != 'streaming' BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            WHEN old.status != 'streaming' BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, status ON messages
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                SELECT 'delete', old.id, old.content WHERE old.status != 'streaming';
+                INSERT INTO messages_fts (rowid, content)
+                SELECT new.id, new.content WHERE new.status != 'streaming';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations
+            BEGIN
+                INSERT INTO conversations_fts (rowid, title) VALUES (new.rowid, new.title);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations
+            BEGIN
+                INSERT INTO conversations_fts (conversations_fts, rowid, title)
+                VALUES ('delete', old.rowid, old.title);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF title ON conversations
+            BEGIN
+                INSERT INTO conversations_fts (conversations_fts, rowid, title)
+                VALUES ('delete', old.rowid, old.title);
+                INSERT INTO conversations_fts (rowid, title) VALUES (new.rowid, new.title);
+            END
+            """,
+        ):
+            conn.execute(statement)
+        if not has_search_index:
+            conn.execute(
+                """
+                INSERT INTO messages_fts (rowid, content)
+                SELECT id, content FROM messages WHERE status != 'streaming'
+                """
+            )
+            conn.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('rebuild')")
+
+    # Free text becomes a query of quoted terms, so FTS5 operators typed by a
+    # user are searched for literally; the last term also matches as a prefix.
+    def search_query(self, text: str) -> str | None:
+        terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+        if not terms:
+            return None
+        return " ".join(terms) + "*"
+
+    # Lower rank is a better match, as bm25() reports it.
+    def search_sql(self, user_filter: str) -> str:
+        return f"""
+            SELECT m.id AS message_id, m.conversation_id, c.title, c.user_id, m.role,
+                   m.created_at, snippet(messages_fts, 0, '**', '**', '…', 16) AS snippet,
+                   bm25(messages_fts) AS rank
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE messages_fts MATCH :query {user_filter}
+            UNION ALL
+            SELECT NULL, c.id, c.title, c.user_id, NULL, c.created_at,
+                   highlight(conversations_fts, 0, '**', '**'), bm25(conversations_fts)
+            FROM conversations_fts
+            JOIN conversations c ON c.rowid = conversations_fts.rowid
+            WHERE conversations_fts MATCH :query {user_filter}
+            ORDER BY rank, created_at DESC, message_id DESC, conversation_id
+            LIMIT :limit OFFSET :offset
+        """
+
+if psycopg is not None:
+    # SUM() and AVG() return numeric; integral results come back as int and
+    # the rest as float, the types the SQLite backend returns.
+    class NumberLoader(Loader):
+        def load(self, data):
+            text = bytes(data).decode("ascii")
+            if "." in text or "e" in text.lower() or text in ("NaN", "Infinity", "-Infinity"):
+                return float(text)
+            return int(text)
+
+PLACEHOLDER = re.compile(r"'(?:[^']|'')*'|\?|(?<![:\w]):([A-Za-z_]\w*)|%")
+
+# Lets the db_* helpers keep SQLite's paramstyles and row access on a psycopg
+# connection: `?` and `:name` placeholders, dict rows, conn.execute().
+class PostgresConnection:
+    _translated = {}
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @classmethod
+    def translate(cls, sql: str) -> str:
+        translated = cls._translated.get(sql)
+        if translated is None:
+            translated = re.sub(r"json_each\((\?|:\w+)\)", r"json_array_elements_text(\1::json)", sql)
+            translated = re.sub(
+                r"INTEGER PRIMARY KEY AUTOINCREMENT",
+                "BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY",
+                translated,
+            )
+            translated = re.sub(r"\bINTEGER\b", "BIGINT", translated)
+            translated = re.sub(r"\bREAL\b", "DOUBLE PRECISION", translated)
+
+            def placeholder(match):
+                token = match.group(0)
+                if token == "?":
+                    return "%s"
+                if token == "%":
+                    return "%%"
+                if match.group(1):
+                    return f"%({match.group(1)})s"
+                return token.replace("%", "%%")
+
+            translated = PLACEHOLDER.sub(placeholder, translated)
+            cls._translated[sql] = translated
+        return translated
+
+    def execute(self, sql: str, params=()):
+        cursor = self.raw.cursor()
+        cursor.execute(self.translate(sql), params if params else None)
+        return cursor
+
+    def executemany(self, sql: str, seq_of_params):
+        cursor = self.raw.cursor()
+        params = list(seq_of_params)
+        if params:
+            cursor.executemany(self.translate(sql), params)
+        return cursor
+
+    def commit(self):
+        self.raw.execute("COMMIT")
+
+    def rollback(self):
+        self.raw.execute("ROLLBACK")
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.raw.info.transaction_status != psycopg.pq.TransactionStatus.IDLE
+
+# Used outside write transactions in place of a connection of the thread's
+# own: each statement runs on a connection taken from the pool for just that
+# statement. Statements commit on their own, and a cursor's rows arrive with
+# the statement, so they can still be read once the connection is back.
+class PostgresPooledConnection:
+    in_transaction = False
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def execute(self, sql: str, params=()):
+        with self.pool.connection() as raw:
+            return PostgresConnection(raw).execute(sql, params)
+
+    def executemany(self, sql: str, seq_of_params):
+        with self.pool.connection() as raw:
+            return PostgresConnection(raw).executemany(sql, seq_of_params)
+
+class PostgresBackend:
+    dialect = "postgres"
+    # Any constant works; every replica must use the same one.
+    WRITE_LOCK_ID = 0x63686174
+
+    def __init__(self, url: str, min_size: int, max_size: int, timeout: float):
+        if psycopg is None:
+            raise RuntimeError(
+                "CHATBOT_DATABASE_URL needs the psycopg and psycopg_pool packages: "
+                "pip install 'psycopg[binary]' psycopg_pool"
+            )
+        self.key = url
+        self.pool = psycopg_pool.ConnectionPool(
+            url,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            kwargs={"autocommit": True, "row_factory": dict_row},
+            configure=self.configure,
+            open=True,
+        )
+        self.pooled = PostgresPooledConnection(self.pool)
+
+    @staticmethod
+    def configure(raw):
+        raw.adapters.register_loader("numeric", NumberLoader)
+
+    def acquire(self) -> PostgresConnection:
+        return PostgresConnection(self.pool.getconn())
+
+    def release(self, conn: PostgresConnection):
+        if conn.in_transaction:
+            conn.rollback()
+        self.pool.putconn(conn.raw)
+
+    # Writers from every replica queue on one advisory lock, as SQLite's
+    # writers do on its file lock. The helpers' read-then-write steps stay
+    # atomic, and ids are assigned in commit order, which the incremental
+    # session sync relies on.
+    def begin(self, conn: PostgresConnection):
+        conn.raw.execute("BEGIN")
+        conn.raw.execute("SELECT pg_advisory_xact_lock(%s)", (self.WRITE_LOCK_ID,))
+
+    def table_exists(self, conn, name: str) -> bool:
+        return conn.execute("SELECT to_regclass(?) IS NOT NULL AS found", (name,)).fetchone()["found"]
+
+    def columns(self, conn, table: str) -> set:
+        return {
+            row["column_name"]
+            for row in conn.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = ?",
+                (table,),
+            )
+        }
+
+    def week_start(self, column: str) -> str:
+        return f"to_char(date_trunc('week', CAST({column} AS date)), 'YYYY-MM-DD')"
+
+    # Expression indexes over the same text FTS5 indexes; partial, so replies
+    # still streaming are left out until they are finished.
+    def create_search_index(self, conn):
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_messages_search ON messages
+            USING GIN (to_tsvector('english', content)) WHERE status != 'streaming'
+            """
+        )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_conversations_search ON conversations
+            USING GIN (to_tsvector('english', title))
+            """
+        )
+
+    # Words only, so nothing a user types is read as a tsquery operator; the
+    # last word also matches as a prefix.
+    def search_query(self, text: str) -> str | None:
+        terms = re.findall(r"\w+", text)
+        if not terms:
+            return None
+        return " & ".join(f"'{term}'" for term in terms) + ":*"
+
+    # ts_rank is higher for better matches; negated so ORDER BY rank works as
+    # it does with bm25().
+    # ts_rank ties far more often than bm25, so ties are broken explicitly to
+    # keep OFFSET pages from repeating or skipping results.
+    def search_sql(self, user_filter: str) -> str:
+        return f"""
+            WITH q AS (SELECT to_tsquery('english', :query) AS query)
+            SELECT m.id AS message_id, m.conversation_id, c.title, c.user_id, m.role,
+                   m.created_at,
+                   ts_headline('english', m.content, q.query,
+                               'StartSel=**, StopSel=**, MaxWords=16, MinWords=8') AS snippet,
+                   -ts_rank(to_tsvector('english', m.content), q.query) AS rank
+            FROM q, messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE to_tsvector('english', m.content) @@ q.query AND m.status != 'streaming'
+              {user_filter}
+            UNION ALL
+            SELECT NULL, c.id, c.title, c.user_id, NULL, c.created_at,
+                   ts_headline('english', c.title, q.query, 'StartSel=**, StopSel=**, HighlightAll=true'),
+                   -ts_rank(to_tsvector('english', c.title), q.query)
+            FROM q, conversations c
+            WHERE to_tsvector('english', c.title) @@ q.query {user_filter}
+            ORDER BY rank, created_at DESC, message_id DESC, conversation_id
+            LIMIT :limit OFFSET :offset
+        """
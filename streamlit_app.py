@@ -1,14 +1,100 @@
-from datetime import datetime
-import base64
+from datetime import date, datetime, timedelta
 import hashlib
+import html
+import json
 import os
-import secrets
-import sqlite3
 import uuid
 
 import streamlit as st
 from openai import OpenAI
 
+from archive import ARCHIVE_DEFAULTS, ArchiveError, archive_disk_bytes, archiver
+from auth import (
+    SESSION_TTL_HOURS,
+    SignInBusy,
+    SignInThrottled,
+    authenticator,
+    end_session,
+    hash_password,
+    issue_session_token,
+    parse_session_token,
+    verify_session_token,
+)
+from db import (
+    db_add_message,
+    db_count_messages_from,
+    db_create_conversation,
+    db_delete_conversation,
+    db_end_user_sessions,
+    db_get_conversation_summary,
+    db_get_user,
+    db_increment_counter,
+    db_load_archive_stats,
+    db_insert_user,
+    db_load_api_call_models,
+    db_load_api_calls,
+    db_load_api_latency_by_model,
+    db_load_api_route_models,
+    db_load_api_stats_by_route,
+    db_load_conversations,
+    db_load_counters,
+    db_load_daily_activity,
+    db_load_daily_token_usage,
+    db_iter_message_history_desc,
+    db_load_messages_after,
+    db_load_messages_before,
+    db_load_model_prices,
+    db_load_recent_messages,
+    db_load_settings,
+    db_load_usage_by_model,
+    db_load_usage_by_user,
+    db_load_weekly_active_users,
+    db_message_tokens_after,
+    db_response_cache_get,
+    db_response_cache_stats,
+    db_response_cache_touch,
+    db_save_model_prices,
+    db_save_settings,
+    db_search,
+    db_set_message_token_counts,
+    db_update_conversation_title,
+    init_db,
+    now_timestamp,
+    touch_user_activity,
+    unit_of_work,
+    write_transaction,
+)
+from compaction import COMPACTION_DEFAULTS, compactor
+from generation import (
+    IMAGE_EXPECTED_SECONDS,
+    IMAGE_FAILED_REPLY,
+    GenerationJob,
+    ImageJob,
+    ImageQueueFull,
+    generation_manager,
+    image_queue,
+)
+from image_store import image_path, thumbnail_path
+from metrics import ENABLED as METRICS_ENABLED
+from metrics import json_text, prometheus_text, quantile, registry, span, start_exporter, start_span
+from router import (
+    AUTO_MODEL,
+    CHAT_MODELS,
+    DEFAULT_RULES,
+    ROUTER_DEFAULTS,
+    model_health,
+    route_prompt,
+    validate_rules,
+)
+from state_loader import (
+    load_earlier_messages,
+    load_state_from_db,
+    load_users_from_db,
+    rehydrate_conversation,
+    trim_messages,
+)
+from tokens import build_context
+
 # Show title and description.
 st.set_page_config(page_title="Chatbot", page_icon="💬", layout="wide")
 st.markdown(
@@ -151,246 +237,105 @@ section[data-testid="stSidebar"] .stButton button:active {
 )
 st.markdown('<div class="app-title">Branding Marketing Agency ChatGPT</div>', unsafe_allow_html=True)
 
-def hash_password(password: str) -> str:
-    salt = secrets.token_bytes(16)
-    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 120000)
-    return f"pbkdf2${base64.b64encode(salt).decode('utf-8')}${base64.b64encode(digest).decode('utf-8')}"
-
-def verify_password(password: str, password_hash: str) -> bool:
-    if not password_hash:
-        return False
-    if not password_hash.startswith("pbkdf2$"):
-        return hashlib.sha256(password.encode("utf-8")).hexdigest() == password_hash
-    try:
-        _, salt_b64, digest_b64 = password_hash.split("$", 2)
-    except ValueError:
-        return False
-    salt = base64.b64decode(salt_b64)
-    expected = base64.b64decode(digest_b64)
-    candidate = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 120000)
-    return secrets.compare_digest(candidate, expected)
-
-def now_timestamp() -> str:
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-def get_db_path() -> str:
-    root = os.path.dirname(os.path.abspath(__file__))
-    data_dir = os.path.join(root, "data")
-    os.makedirs(data_dir, exist_ok=True)
-    return os.path.join(data_dir, "chatbot.db")
-
-@st.cache_resource
-def get_db():
-    conn = sqlite3.connect(get_db_path(), check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
-
-def init_db():
-    conn = get_db()
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            email TEXT NOT NULL,
-            role TEXT NOT NULL,
-            status TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            last_active TEXT NOT NULL,
-            password_hash TEXT NOT NULL
-        )
-        """
-    )
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS conversations (
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            title TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-        """
-    )
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
-        )
-        """
-    )
-    conn.execute(
-        "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id)"
-    )
-    conn.execute(
-        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id)"
-    )
-    conn.commit()
-
-def db_get_user(user_id: str):
-    conn = get_db()
-    row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    return dict(row) if row else None
-
-def db_insert_user(user: dict):
-    conn = get_db()
-    conn.execute(
-        """
-        INSERT INTO users (id, name, email, role, status, created_at, last_active, password_hash)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            user["id"],
-            user["name"],
-            user["email"],
-            user["role"],
-            user["status"],
-            user["created_at"],
-            user["last_active"],
-            user["password_hash"],
-        ),
-    )
-    conn.commit()
-
-def db_update_user_activity(user_id: str, last_active: str, message_count: int | None = None):
-    conn = get_db()
-    conn.execute(
-        "UPDATE users SET last_active = ? WHERE id = ?",
-        (last_active, user_id),
-    )
-    conn.commit()
-
-def db_load_users() -> dict:
-    conn = get_db()
-    users = {}
-    for row in conn.execute("SELECT * FROM users"):
-        users[row["id"]] = dict(row)
-    return users
-
-def db_load_conversations(user_id: str) -> list:
-    conn = get_db()
-    conversations = []
-    for row in conn.execute(
-        "SELECT * FROM conversations WHERE user_id = ? ORDER BY created_at DESC",
-        (user_id,),
-    ):
-        convo = dict(row)
-        messages = [
-            {
-                "role": msg["role"],
-                "content": msg["content"],
-                "created_at": msg["created_at"],
-            }
-            for msg in conn.execute(
-                "SELECT role, content, created_at FROM messages WHERE conversation_id = ? ORDER BY id",
-                (row["id"],),
-            )
-        ]
-        convo["messages"] = messages
-        conversations.append(convo)
-    return conversations
-
-def db_create_conversation(user_id: str, title: str, created_at: str) -> str:
-    conn = get_db()
-    conversation_id = str(uuid.uuid4())[:8]
-    conn.execute(
-        "INSERT INTO conversations (id, user_id, title, created_at) VALUES (?, ?, ?, ?)",
-        (conversation_id, user_id, title, created_at),
-    )
-    conn.commit()
-    return conversation_id
-
-def db_delete_conversation(conversation_id: str):
-    conn = get_db()
-    conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
-    conn.commit()
-
-def db_update_conversation_title(conversation_id: str, title: str):
-    conn = get_db()
-    conn.execute(
-        "UPDATE conversations SET title = ? WHERE id = ?",
-        (title, conversation_id),
-    )
-    conn.commit()
-
-def db_add_message(conversation_id: str, role: str, content: str, created_at: str):
-    conn = get_db()
-    conn.execute(
-        "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
-        (conversation_id, role, content, created_at),
-    )
-    conn.commit()
-
 try:
     openai_api_key = st.secrets.get("OPENAI_API_KEY", "")
+    # Points the client at any compatible server, such as the local stand-in
+    # in benchmarks/fake_openai.py.
+    openai_base_url = st.secrets.get("OPENAI_BASE_URL", "")
 except st.errors.StreamlitSecretNotFoundError:
     openai_api_key = ""
+    openai_base_url = ""
+openai_api_key = openai_api_key or os.environ.get("OPENAI_API_KEY", "")
+openai_base_url = openai_base_url or os.environ.get("OPENAI_BASE_URL") or None
 
 client = None
 if openai_api_key:
     try:
-        client = OpenAI(api_key=openai_api_key)
+        client = OpenAI(api_key=openai_api_key, base_url=openai_base_url)
     except Exception:
         st.error("Could not initialize OpenAI client. Check your API key.")
         st.stop()
 else:
-    st.error("OpenAI API key is required. Add it to `.streamlit/secrets.toml`.")
+    st.error("OpenAI API key is required. Add it to `.streamlit/secrets.toml` or set `OPENAI_API_KEY`.")
     st.stop()
 
-CHAT_MODELS = ["gpt-4o", "gpt-4o-mini"]
-
-IMAGE_KEYWORDS = (
-    "image",
-    "picture",
-    "photo",
-    "draw",
-    "illustration",
-    "logo",
-    "generate an image",
-    "create an image",
-    "make an image",
-)
-
-def is_image_prompt(text: str) -> bool:
-    lowered = text.strip().lower()
-    if lowered.startswith("/image"):
-        return True
-    return any(keyword in lowered for keyword in IMAGE_KEYWORDS)
+HISTORY_PAGE_SIZE = 30
+SEARCH_PAGE_SIZE = 8
+API_LOG_PAGE_SIZE = 25
+# Messages shown around a search match in the admin conversation viewer.
+SEARCH_CONTEXT_BEFORE = 4
+SEARCH_CONTEXT_AFTER = 10
+# Sent after an interrupted reply to have the model pick up where it stopped.
+CONTINUE_PROMPT = "Continue exactly where your previous reply stopped, without repeating any of it."
+
+RESPONSE_CACHE_DEFAULTS = {
+    "response_cache_enabled": False,
+    "response_cache_ttl_hours": 24,
+    "response_cache_max_mb": 50,
+}
 
 def ensure_admin_user() -> str:
     admin_id = "admin@company.local"
-    if not db_get_user(admin_id):
-        created_at = now_timestamp()
-        admin_user = {
-            "id": admin_id,
-            "name": "Admin",
-            "email": admin_id,
-            "role": "Admin",
-            "status": "Active",
-            "created_at": created_at,
-            "last_active": created_at,
-            "password_hash": hash_password("admin123"),
-        }
-        db_insert_user(admin_user)
-        db_create_conversation(admin_id, "Welcome", created_at)
-    return admin_id
-
-def load_state_from_db():
-    st.session_state.users = db_load_users()
-    st.session_state.user_conversations = {
-        user_id: db_load_conversations(user_id)
-        for user_id in st.session_state.users.keys()
+    if db_get_user(admin_id):
+        return admin_id
+    created_at = now_timestamp()
+    admin_user = {
+        "id": admin_id,
+        "name": "Admin",
+        "email": admin_id,
+        "role": "Admin",
+        "status": "Active",
+        "created_at": created_at,
+        "last_active": created_at,
+        "password_hash": hash_password("admin123"),
     }
+    # Checked again under the write lock: sessions starting together on a new
+    # database would otherwise all try to insert the admin.
+    with write_transaction():
+        if not db_get_user(admin_id):
+            db_insert_user(admin_user)
+            db_create_conversation(admin_id, "Welcome", created_at)
+    return admin_id
 
+# Session state only holds the users a view needs. The first load of a user
+# reads their full history; later reruns apply new or deleted conversations and
+# messages with an id above the per-user watermark.
 init_db()
+start_exporter()
+archiver.start()
 admin_id = ensure_admin_user()
-load_state_from_db()
+
+if "users" not in st.session_state:
+    st.session_state.users = {}
+
+if "user_conversations" not in st.session_state:
+    st.session_state.user_conversations = {}
+
+if "message_watermarks" not in st.session_state:
+    st.session_state.message_watermarks = {}
+
+if "windowed_user_ids" not in st.session_state:
+    st.session_state.windowed_user_ids = set()
+
+if "history_window_by_conversation" not in st.session_state:
+    st.session_state.history_window_by_conversation = {}
+
+if "feed_cursors" not in st.session_state:
+    st.session_state.feed_cursors = {}
+
+if "search_pages" not in st.session_state:
+    st.session_state.search_pages = {}
+
+if "search_focus_message_id" not in st.session_state:
+    st.session_state.search_focus_message_id = None
+
+# Messages sent while a reply was still being generated, per conversation;
+# each is sent once the reply before it has finished.
+if "queued_prompts" not in st.session_state:
+    st.session_state.queued_prompts = {}
+
+if "admin_search_result" not in st.session_state:
+    st.session_state.admin_search_result = None
 
 if "active_user_id" not in st.session_state:
     st.session_state.active_user_id = None
@@ -398,6 +343,19 @@ if "active_user_id" not in st.session_state:
 if "logged_in_user_id" not in st.session_state:
     st.session_state.logged_in_user_id = None
 
+# The session cookie is read once, when the session starts; after that the
+# browser's copy is only written to.
+if "session_cookie_checked" not in st.session_state:
+    st.session_state.session_cookie_checked = False
+
+# A token to store in the session cookie on the next run, or "" to clear it.
+if "pending_session_cookie" not in st.session_state:
+    st.session_state.pending_session_cookie = None
+
+# The token of the signed-in session, ended on sign-out.
+if "session_token" not in st.session_state:
+    st.session_state.session_token = None
+
 if "view_mode" not in st.session_state:
     st.session_state.view_mode = "chat"
 
@@ -413,11 +371,55 @@ if "admin_user_id" not in st.session_state:
 if "active_conversation_by_user" not in st.session_state:
     st.session_state.active_conversation_by_user = {}
 
-def authenticate(user_id: str, password: str) -> bool:
-    user = st.session_state.users.get(user_id)
-    if not user:
-        return False
-    return verify_password(password, user.get("password_hash"))
+def authenticate(user_id: str, password: str) -> dict | None:
+    with span("auth", method="password"):
+        return authenticator.authenticate(user_id, password)
+
+SESSION_COOKIE = "chatbot_session"
+
+# The session token is kept in a cookie, so a reload or a new tab restores the
+# session from it instead of asking for the password again. Streamlit has no
+# way to set one from Python, so a script in the page writes it.
+def write_session_cookie():
+    token = st.session_state.pending_session_cookie
+    if token is None:
+        return
+    st.session_state.pending_session_cookie = None
+    max_age = int(SESSION_TTL_HOURS * 3600) if token else 0
+    st.html(
+        f"""
+        <script>
+        document.cookie = {json.dumps(f"{SESSION_COOKIE}={token}; Path=/; Max-Age={max_age}; SameSite=Strict")}
+            + (location.protocol === "https:" ? "; Secure" : "");
+        </script>
+        """,
+        unsafe_allow_javascript=True,
+    )
+
+# Every sign-in, including one restored from the cookie, replaces the token;
+# a restored session keeps its session id.
+def start_session(user: dict, restored_token: str | None = None):
+    user_id = user["id"]
+    st.session_state.logged_in_user_id = user_id
+    st.session_state.active_user_id = user_id
+    load_state_from_db(st.session_state, [user_id], window=HISTORY_PAGE_SIZE)
+    ensure_user_conversations(user_id)
+    st.session_state.users[user_id]["last_active"] = now_timestamp()
+    touch_user_activity(user_id, st.session_state.users[user_id]["last_active"])
+    session_id = parse_session_token(restored_token)[2] if restored_token else None
+    st.session_state.session_token = issue_session_token(user, session_id)
+    st.session_state.pending_session_cookie = st.session_state.session_token
+
+# Signing out ends this browser's session only; the user stays signed in
+# elsewhere.
+def sign_out():
+    if st.session_state.session_token:
+        end_session(st.session_state.session_token)
+    st.session_state.session_token = None
+    st.session_state.pending_session_cookie = ""
+    st.session_state.logged_in_user_id = None
+    st.session_state.active_user_id = None
+    st.rerun()
 
 def current_user():
     return st.session_state.users.get(st.session_state.logged_in_user_id)
@@ -450,41 +452,290 @@ def get_active_conversation(user_id: str):
             return conversation
     return conversations[0] if conversations else None
 
-def user_message_count(user_id: str) -> int:
-    return sum(
-        len(conversation["messages"])
-        for conversation in st.session_state.user_conversations.get(user_id, [])
-    )
-
-def add_message(conversation: dict, role: str, content: str):
+def add_message(
+    conversation: dict,
+    role: str,
+    content: str,
+    unit=None,
+    image_sha256: str | None = None,
+    status: str = "complete",
+):
     created_at = now_timestamp()
-    db_add_message(conversation["id"], role, content, created_at)
-    conversation["messages"].append(
-        {"role": role, "content": content, "created_at": created_at}
+    message = {
+        "id": None,
+        "role": role,
+        "content": content,
+        "created_at": created_at,
+        "status": status,
+        "image_sha256": image_sha256,
+    }
+    conversation["messages"].append(message)
+    if unit is None:
+        message["id"] = db_add_message(
+            conversation["id"], role, content, created_at, status, image_sha256
+        )
+    else:
+        unit.add(
+            db_add_message,
+            conversation["id"],
+            role,
+            content,
+            created_at,
+            status,
+            image_sha256,
+            on_done=lambda message_id: message.update(id=message_id),
+        )
+    return message
+
+# History shows the stored thumbnail; the full-size file is only sent to the
+# browser when asked for.
+def show_stored_image(message: dict):
+    sha256 = message["image_sha256"]
+    if not os.path.exists(image_path(sha256)):
+        st.caption("Image file is missing.")
+        return
+    if st.toggle("Full size", key=f"full_image_{message['id']}"):
+        st.image(image_path(sha256), use_container_width=True)
+    else:
+        st.image(thumbnail_path(sha256))
+
+def show_generation_job(conversation: dict, job):
+    with st.chat_message("assistant"):
+        if job.route is not None:
+            st.caption(f"Auto · {job.model} · {job.route}")
+        st.write_stream(job.stream())
+        if job.status == "failed":
+            st.error(f"Response failed: {job.error}")
+    if job.message is None:
+        return
+    for message in conversation["messages"]:
+        if message.get("id") == job.message["id"]:
+            message.update(content=job.message["content"], status=job.message["status"])
+            return
+    conversation["messages"].append(dict(job.message))
+
+def show_image_job(conversation: dict, job: ImageJob):
+    with st.chat_message("assistant"):
+        progress = st.empty()
+        while not job.done:
+            if job.status == "queued":
+                position = image_queue.position(job)
+                progress.info(f"Waiting for an image slot · position {position} in the queue")
+            else:
+                elapsed = job.elapsed
+                progress.progress(
+                    min(elapsed / IMAGE_EXPECTED_SECONDS, 0.95),
+                    text=f"Generating image · {elapsed:.0f}s",
+                )
+            job.wait(0.5)
+        progress.empty()
+        if job.status == "failed":
+            st.error(f"Image generation failed: {job.error}")
+        else:
+            st.image(
+                image_path(job.message["image_sha256"]),
+                caption=job.prompt,
+                use_container_width=True,
+            )
+    if job.message is not None and all(
+        message.get("id") != job.message_id for message in conversation["messages"]
+    ):
+        conversation["messages"].append(dict(job.message))
+
+# Search results are paged by offset; the page resets when the query changes.
+def search_results(key: str, text: str, user_ids: list | None):
+    query, page = st.session_state.search_pages.get(key, (text, 0))
+    if query != text:
+        page = 0
+    st.session_state.search_pages[key] = (text, page)
+    results = db_search(text, user_ids, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    return results[:SEARCH_PAGE_SIZE], page, len(results) > SEARCH_PAGE_SIZE
+
+def search_pager(container, key: str, page: int, has_more: bool):
+    text = st.session_state.search_pages[key][0]
+    pager_cols = container.columns(2)
+    if page > 0 and pager_cols[0].button("Previous", key=f"{key}_previous"):
+        st.session_state.search_pages[key] = (text, page - 1)
+        st.rerun()
+    if has_more and pager_cols[1].button("Next", key=f"{key}_next"):
+        st.session_state.search_pages[key] = (text, page + 1)
+        st.rerun()
+
+# Opens a chat at a search match: the history window is widened just enough
+# to start a couple of messages above it.
+def open_search_result(user_id: str, result: dict):
+    conversation = next(
+        (
+            conversation
+            for conversation in st.session_state.user_conversations.get(user_id, [])
+            if conversation["id"] == result["conversation_id"]
+        ),
+        None,
+    )
+    if conversation is None:
+        return
+    st.session_state.active_conversation_by_user[user_id] = conversation["id"]
+    st.session_state.view_mode = "chat"
+    st.session_state.search_focus_message_id = result["message_id"]
+    if result["message_id"] is None:
+        return
+    needed = db_count_messages_from(conversation["id"], result["message_id"]) + 2
+    if len(conversation["messages"]) < needed:
+        load_earlier_messages(conversation, needed - len(conversation["messages"]))
+    window = st.session_state.history_window_by_conversation.get(
+        conversation["id"], HISTORY_PAGE_SIZE
+    )
+    st.session_state.history_window_by_conversation[conversation["id"]] = max(window, needed)
+
+# Routes a prompt given the conversation before it, using the rules saved in
+# the Routing section. The session holds only a window of the conversation,
+# so its size comes from the database; messages without a stored token count
+# are estimated.
+def choose_route(conversation: dict, prompt: str, selected_model: str, before_id: int | None = None) -> dict:
+    history_tokens = db_message_tokens_after(conversation["id"], 0, before_id)
+    rules = db_load_settings(ROUTER_DEFAULTS)["router_rules"]
+    with span("route"):
+        return route_prompt(prompt, history_tokens, selected_model, rules)
+
+# History sent with a turn: the conversation's summary, if it has been
+# compacted, then the messages after it that fit the model's budget.
+def conversation_context(conversation_id: str, model: str, pending: list, before_id: int | None = None):
+    summary = db_get_conversation_summary(conversation_id)
+    if summary is not None and before_id is not None and summary["through_message_id"] >= before_id:
+        summary = None
+    return build_context(
+        db_iter_message_history_desc(
+            conversation_id,
+            before_id=before_id,
+            after_id=summary["through_message_id"] if summary else None,
+        ),
+        model,
+        pending=pending,
+        summary=summary["summary"] if summary else None,
     )
 
-def iter_all_messages():
-    for user_id, conversations in st.session_state.user_conversations.items():
-        user_name = st.session_state.users.get(user_id, {}).get("name", user_id)
-        for conversation in conversations:
-            for message in conversation["messages"]:
-                yield {
-                    "user_id": user_id,
-                    "user_name": user_name,
-                    "role": message.get("role", ""),
-                    "content": message.get("content", ""),
-                    "created_at": message.get("created_at", ""),
-                }
+# Picks an interrupted reply back up, either by asking the model to carry on
+# from the partial text or by answering the prompt again in the same row. In
+# Auto mode the prompt that reply answers is routed again.
+def resume_reply(conversation: dict, message: dict, selected_model: str, user_id: str, mode: str):
+    model = selected_model
+    route_name = None
+    if selected_model == AUTO_MODEL:
+        index = conversation["messages"].index(message)
+        prompt_index = next(
+            (
+                position
+                for position in range(index - 1, -1, -1)
+                if conversation["messages"][position]["role"] == "user"
+            ),
+            None,
+        )
+        prompt_message = conversation["messages"][prompt_index] if prompt_index is not None else message
+        prompt = prompt_message["content"] if prompt_index is not None else ""
+        route = choose_route(conversation, prompt, selected_model, prompt_message["id"])
+        # An image rule cannot apply to a text reply; the default chat model
+        # takes it.
+        model = route["model"] or CHAT_MODELS[-1]
+        route_name = route["route"]
+    pending = []
+    prefix = ""
+    if mode == "continue" and message["content"]:
+        prefix = message["content"]
+        pending = [
+            {"role": "assistant", "content": prefix},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
+    context, counted_ids = conversation_context(conversation["id"], model, pending, message["id"])
+    if counted_ids:
+        db_set_message_token_counts(counted_ids)
+    message.update(content=prefix, status="streaming")
+    job = GenerationJob(
+        conversation["id"],
+        user_id,
+        model,
+        context,
+        message_id=message["id"],
+        prefix=prefix,
+        route=route_name,
+    )
+    return generation_manager.submit(job, client)
 
-def total_prompt_count() -> int:
-    return sum(1 for message in iter_all_messages() if message["role"] == "user")
+# Near-identical prompts share an entry: the key ignores case and whitespace
+# differences in every message of the context sent to the model.
+def response_cache_key(model: str, context: list) -> str:
+    normalized = [
+        [message["role"], " ".join(message["content"].split()).lower()] for message in context
+    ]
+    return hashlib.sha256(json.dumps([model, normalized]).encode("utf-8")).hexdigest()
+
+def response_cache_cutoff(cache_settings: dict) -> str:
+    expires_before = datetime.now() - timedelta(hours=cache_settings["response_cache_ttl_hours"])
+    return expires_before.strftime("%Y-%m-%d %H:%M:%S")
+
+def replay_text(text: str, chunk_size: int = 24):
+    for start in range(0, len(text), chunk_size):
+        yield text[start : start + chunk_size]
+
+# Newest-first feeds page by keyset; the cursor stack remembers where each
+# page started so "Newer" can step back.
+def feed_page(key: str, limit: int, role: str | None = None, user_ids: list | None = None):
+    cursors = st.session_state.feed_cursors.setdefault(key, [None])
+    rows = db_load_recent_messages(limit + 1, cursors[-1], role, user_ids)
+    return rows[:limit], len(rows) > limit
+
+def feed_pager(key: str, rows: list, has_more: bool, time_field: str = "created_at"):
+    cursors = st.session_state.feed_cursors[key]
+    pager_cols = st.columns(2)
+    if len(cursors) > 1 and pager_cols[0].button("Newer", key=f"{key}_newer"):
+        cursors.pop()
+        st.rerun()
+    if has_more and pager_cols[1].button("Older", key=f"{key}_older"):
+        cursors.append((rows[-1][time_field], rows[-1]["id"]))
+        st.rerun()
 
-def total_message_chars() -> int:
-    return sum(len(message["content"]) for message in iter_all_messages())
+def activity_series(start_day: date, end_day: date, granularity: str) -> dict:
+    daily = db_load_daily_activity(
+        start_day.isoformat(), end_day.isoformat(), date.today().isoformat()
+    )
+    daily_tokens = db_load_daily_token_usage(start_day.isoformat(), end_day.isoformat())
+    if granularity == "Day":
+        return {
+            "bucket": list(daily.keys()),
+            "prompts": [row["prompt_count"] for row in daily.values()],
+            "active_users": [row["active_users"] for row in daily.values()],
+            "tokens": [daily_tokens.get(day, 0) for day in daily],
+        }
+    weeks = {}
+    for day, row in daily.items():
+        day_value = date.fromisoformat(day)
+        week = (day_value - timedelta(days=day_value.weekday())).isoformat()
+        bucket = weeks.setdefault(week, {"prompts": 0, "tokens": 0})
+        bucket["prompts"] += row["prompt_count"]
+        bucket["tokens"] += daily_tokens.get(day, 0)
+    active_users = db_load_weekly_active_users(start_day.isoformat(), end_day.isoformat())
+    return {
+        "bucket": list(weeks.keys()),
+        "prompts": [bucket["prompts"] for bucket in weeks.values()],
+        "active_users": [active_users.get(week, 0) for week in weeks],
+        "tokens": [bucket["tokens"] for bucket in weeks.values()],
+    }
 
-def build_week_series(total: int) -> list:
-    base = max(total, 1)
-    return [max(0, int(base * 0.08) + i * 3) for i in range(7)]
+def activity_range_controls(key: str):
+    today = date.today()
+    range_cols = st.columns([2, 1])
+    selected_range = range_cols[0].date_input(
+        "Date range",
+        value=(today - timedelta(days=55), today),
+        max_value=today,
+        key=f"{key}_range",
+    )
+    granularity = range_cols[1].selectbox("Buckets", ["Week", "Day"], key=f"{key}_granularity")
+    if isinstance(selected_range, (tuple, list)):
+        start_day = selected_range[0] if selected_range else today
+        end_day = selected_range[1] if len(selected_range) > 1 else start_day
+    else:
+        start_day = end_day = selected_range
+    return start_day, end_day, granularity
 
 if "user_messages" in st.session_state:
     for user_id, messages in st.session_state.user_messages.items():
@@ -501,6 +752,23 @@ if "user_messages" in st.session_state:
             st.session_state.active_conversation_by_user[user_id] = conversation_id
     st.session_state.pop("user_messages", None)
 
+# Tokens used to be passed in the URL; one left in a bookmark is dropped
+# unused rather than kept in the address bar.
+st.query_params.pop("session", None)
+
+if st.session_state.logged_in_user_id is None and not st.session_state.session_cookie_checked:
+    st.session_state.session_cookie_checked = True
+    session_cookie = st.context.cookies.get(SESSION_COOKIE)
+    if session_cookie:
+        with span("auth", method="token"):
+            restored_user = verify_session_token(session_cookie)
+        if restored_user:
+            start_session(restored_user, session_cookie)
+        else:
+            st.session_state.pending_session_cookie = ""
+
+write_session_cookie()
+
 if st.session_state.logged_in_user_id is None:
     st.subheader("Sign in")
     with st.form("login_form"):
@@ -508,21 +776,27 @@ if st.session_state.logged_in_user_id is None:
         login_password = st.text_input("Password", type="password")
         login = st.form_submit_button("Sign in")
         if login:
-            if authenticate(login_user_id, login_password):
-                st.session_state.logged_in_user_id = login_user_id
-                st.session_state.active_user_id = login_user_id
-                ensure_user_conversations(login_user_id)
-                st.session_state.users[login_user_id]["last_active"] = now_timestamp()
-                db_update_user_activity(login_user_id, st.session_state.users[login_user_id]["last_active"])
-                st.success("Signed in.")
-                st.rerun()
+            try:
+                with st.spinner("Signing in..."):
+                    user = authenticate(login_user_id, login_password)
+            except (SignInBusy, SignInThrottled) as exc:
+                st.error(str(exc))
             else:
-                st.error("Invalid credentials.")
+                if user:
+                    start_session(user)
+                    st.success("Signed in.")
+                    st.rerun()
+                else:
+                    st.error("Invalid credentials.")
     st.info(
         "Admin default: email `admin@company.local` / password `admin123` (change after first login)."
     )
     st.stop()
 
+with span("db_load", scope="session"):
+    load_state_from_db(
+        st.session_state, [st.session_state.logged_in_user_id], window=HISTORY_PAGE_SIZE
+    )
 logged_in_user = current_user()
 is_admin = logged_in_user and logged_in_user.get("role") == "Admin"
 ensure_user_conversations(logged_in_user["id"])
@@ -532,6 +806,9 @@ if not is_admin:
 if not is_admin:
     st.session_state.active_user_id = st.session_state.logged_in_user_id
 
+sidebar_span = start_span(
+    "sidebar", view="admin" if is_admin and st.session_state.view_mode == "dashboard" else "chat"
+)
 if is_admin and st.session_state.view_mode == "dashboard":
     with st.sidebar:
         st.markdown("### Admin")
@@ -543,6 +820,9 @@ if is_admin and st.session_state.view_mode == "dashboard":
             ("Chat Usage", "💬 Chat Usage"),
             ("Tokens & Costs", "🪙 Tokens & Costs"),
             ("API Logs", "📄 API Logs"),
+            ("Routing", "🔀 Routing"),
+            ("Search", "🔎 Search"),
+            ("Performance", "⏱️ Performance"),
             ("Billing", "💳 Billing"),
             ("Settings", "⚙️ Settings"),
         ]
@@ -582,6 +862,28 @@ else:
         st.session_state.active_conversation_by_user[st.session_state.logged_in_user_id] = new_id
         st.session_state.view_mode = "chat"
 
+    search_text = st.sidebar.text_input(
+        "Search chats", key="chat_search", placeholder="Search messages and titles"
+    ).strip()
+    if search_text:
+        search_user_id = st.session_state.logged_in_user_id
+        results, page, has_more = search_results("chat_search", search_text, [search_user_id])
+        if not results:
+            st.sidebar.caption("No matches.")
+        for index, result in enumerate(results):
+            title = result["title"]
+            if len(title) > 26:
+                title = title[:26] + "…"
+            if st.sidebar.button(
+                f"🔎 {title}",
+                key=f"chat_search_result_{page}_{index}",
+                use_container_width=True,
+            ):
+                open_search_result(search_user_id, result)
+                st.rerun()
+            st.sidebar.caption(result["snippet"])
+        search_pager(st.sidebar, "chat_search", page, has_more)
+
     st.sidebar.markdown("---")
 
 
@@ -679,12 +981,18 @@ if not (is_admin and st.session_state.view_mode == "dashboard"):
         st.session_state.view_mode = "dashboard"
         st.rerun()
     if st.sidebar.button("🚪 Sign out", use_container_width=True):
-        st.session_state.logged_in_user_id = None
-        st.session_state.active_user_id = None
-        st.rerun()
+        sign_out()
     st.sidebar.markdown("</div>", unsafe_allow_html=True)
 
+sidebar_span.end()
+
+# Admin sections read aggregates and indexed queries, so only the user rows
+# are loaded here.
 if st.session_state.view_mode == "dashboard" and is_admin:
+    with span("db_load", scope="users"):
+        load_users_from_db(st.session_state)
+    section_span = start_span("admin_section", section=st.session_state.admin_section)
+
     top_left, top_right = st.columns([3, 2])
     with top_left:
         st.markdown("## Admin Dashboard")
@@ -697,9 +1005,7 @@ if st.session_state.view_mode == "dashboard" and is_admin:
                 st.rerun()
         with action_cols[1]:
             if st.button("Sign out", use_container_width=True):
-                st.session_state.logged_in_user_id = None
-                st.session_state.active_user_id = None
-                st.rerun()
+                sign_out()
 
     non_admin_ids = [
         user_id
@@ -707,12 +1013,20 @@ if st.session_state.view_mode == "dashboard" and is_admin:
         if user.get("role") != "Admin"
     ]
 
+    usage_by_user = db_load_usage_by_user()
+
     if st.session_state.admin_section == "Dashboard":
         total_users = len(non_admin_ids)
-        total_prompts = total_prompt_count()
-        total_chars = total_message_chars()
+        total_prompts = sum(usage["prompt_count"] for usage in usage_by_user.values())
+        total_tokens = sum(
+            usage["prompt_tokens"] + usage["completion_tokens"] for usage in usage_by_user.values()
+        )
         active_users = len(
-            [user_id for user_id in non_admin_ids if user_message_count(user_id) > 0]
+            [
+                user_id
+                for user_id in non_admin_ids
+                if usage_by_user.get(user_id, {}).get("message_count", 0) > 0
+            ]
         )
 
         kpi_cols = st.columns(4)
@@ -729,48 +1043,60 @@ if st.session_state.view_mode == "dashboard" and is_admin:
             unsafe_allow_html=True,
         )
         kpi_cols[3].markdown(
-            f'<div class="card"><h4>Estimated tokens</h4><div class="card-value">{total_chars // 4}</div></div>',
+            f'<div class="card"><h4>Tokens used</h4><div class="card-value">{total_tokens}</div></div>',
             unsafe_allow_html=True,
         )
 
+        start_day, end_day, granularity = activity_range_controls("dashboard_activity")
+        series = activity_series(start_day, end_day, granularity)
+        period_label = "Weekly" if granularity == "Week" else "Daily"
         chart_left, chart_right = st.columns([2, 1])
         with chart_left:
-            st.markdown("#### Weekly prompt volume")
-            st.line_chart(build_week_series(total_prompts), height=220, use_container_width=True)
+            st.markdown(f"#### {period_label} prompt volume")
+            st.line_chart(series, x="bucket", y="prompts", height=220, use_container_width=True)
         with chart_right:
-            st.markdown("#### Weekly active users")
-            st.line_chart(build_week_series(active_users), height=220, use_container_width=True)
+            st.markdown(f"#### {period_label} active users")
+            st.line_chart(series, x="bucket", y="active_users", height=220, use_container_width=True)
+
+        cache_counters = db_load_counters(["response_cache_hits", "response_cache_misses"])
+        cache_stats = db_response_cache_stats()
+        cache_lookups = cache_counters["response_cache_hits"] + cache_counters["response_cache_misses"]
+        hit_rate = cache_counters["response_cache_hits"] / cache_lookups if cache_lookups else 0
+        st.markdown("#### Response cache")
+        cache_cols = st.columns(4)
+        cache_cols[0].metric("Hits", cache_counters["response_cache_hits"])
+        cache_cols[1].metric("Misses", cache_counters["response_cache_misses"])
+        cache_cols[2].metric("Hit rate", f"{hit_rate:.0%}")
+        cache_cols[3].metric("Entries", f"{cache_stats['entries']} ({cache_stats['size'] / 1024:,.0f} KiB)")
 
         st.markdown("#### Recent activity")
-        activity_items = list(iter_all_messages())
-        activity_items = sorted(
-            activity_items, key=lambda item: item.get("created_at") or "", reverse=True
-        )[:6]
+        activity_items, has_more = feed_page("recent_activity", 6)
         if activity_items:
             for item in activity_items:
                 role_label = "User" if item["role"] == "user" else "Assistant"
-                content_preview = item["content"][:120]
+                # Message text and names are user input; escaped so the card
+                # cannot run script in an admin's browser.
+                content_preview = html.escape(item["content"][:120])
+                user_name = html.escape(item["user_name"])
                 st.markdown(
                     f"""
                     <div class="activity-card">
-                        <div class="activity-meta">{item['user_name']} · {role_label} · {item.get('created_at', '—') or '—'}</div>
+                        <div class="activity-meta">{user_name} · {role_label} · {item.get('created_at', '—') or '—'}</div>
                         <div>{content_preview}</div>
                     </div>
                     """,
                     unsafe_allow_html=True,
                 )
+            feed_pager("recent_activity", activity_items, has_more)
         else:
             st.write("No activity yet.")
 
         st.markdown("#### Recent prompts")
-        recent_prompts = [
-            message["content"]
-            for message in list(iter_all_messages())
-            if message["role"] == "user"
-        ][-6:]
+        recent_prompts, has_more = feed_page("recent_prompts", 6, role="user")
         if recent_prompts:
-            for prompt in reversed(recent_prompts):
-                st.write(f"- {prompt}")
+            for prompt in recent_prompts:
+                st.write(f"- {prompt['content']}")
+            feed_pager("recent_prompts", recent_prompts, has_more)
         else:
             st.write("No prompts yet.")
 
@@ -788,12 +1114,20 @@ if st.session_state.view_mode == "dashboard" and is_admin:
                     "status": user["status"],
                     "created_at": user["created_at"],
                     "last_active": user["last_active"],
-                    "message_count": user_message_count(user["id"]),
+                    "message_count": usage_by_user.get(user["id"], {}).get("message_count", 0),
                 }
                 for user in st.session_state.users.values()
                 if user.get("role") != "Admin"
             ]
             st.dataframe(filtered_users, use_container_width=True, hide_index=True)
+            # For a lost device or a shared password: every browser the user
+            # is signed in on has to sign in again.
+            with st.form("end_sessions_form"):
+                session_user_labels = {f"{user['name']} ({user['id']})": user["id"] for user in filtered_users}
+                end_sessions_label = st.selectbox("User", options=list(session_user_labels.keys()))
+                if st.form_submit_button("Sign out everywhere"):
+                    db_end_user_sessions(session_user_labels[end_sessions_label])
+                    st.success(f"{end_sessions_label} was signed out everywhere.")
 
     elif st.session_state.admin_section == "Add new User":
         st.subheader("Add new user")
@@ -853,15 +1187,14 @@ if st.session_state.view_mode == "dashboard" and is_admin:
             st.session_state.admin_view_user_id = user_labels[selected_label]
             view_user_id = st.session_state.admin_view_user_id
 
-            recent_prompts = []
-            for conversation in st.session_state.user_conversations.get(view_user_id, []):
-                recent_prompts.extend(
-                    msg["content"] for msg in conversation["messages"] if msg["role"] == "user"
-                )
+            recent_prompts, has_more = feed_page(
+                f"user_prompts_{view_user_id}", 10, role="user", user_ids=[view_user_id]
+            )
             st.markdown("#### Recent prompts")
             if recent_prompts:
-                for prompt in reversed(recent_prompts[-10:]):
-                    st.write(f"- {prompt}")
+                for prompt in recent_prompts:
+                    st.write(f"- {prompt['content']}")
+                feed_pager(f"user_prompts_{view_user_id}", recent_prompts, has_more)
             else:
                 st.write("No prompts yet.")
         else:
@@ -869,39 +1202,333 @@ if st.session_state.view_mode == "dashboard" and is_admin:
 
     elif st.session_state.admin_section == "Tokens & Costs":
         st.subheader("Tokens & Costs")
-        total_chars = total_message_chars()
-        estimated_tokens = total_chars // 4
-        estimated_cost = estimated_tokens * 0.000002
+        usage_by_model = db_load_usage_by_model()
+        total_tokens = sum(row["prompt_tokens"] + row["completion_tokens"] for row in usage_by_model)
+        total_cost = sum(row["cost"] for row in usage_by_model)
+        total_prompts = sum(usage["prompt_count"] for usage in usage_by_user.values())
         token_cols = st.columns(3)
         token_cols[0].markdown(
-            f'<div class="card"><h4>Estimated tokens</h4><div class="card-value">{estimated_tokens}</div></div>',
+            f'<div class="card"><h4>Tokens used</h4><div class="card-value">{total_tokens}</div></div>',
             unsafe_allow_html=True,
         )
         token_cols[1].markdown(
-            f'<div class="card"><h4>Estimated cost</h4><div class="card-value">${estimated_cost:,.4f}</div></div>',
+            f'<div class="card"><h4>Cost</h4><div class="card-value">${total_cost:,.4f}</div></div>',
             unsafe_allow_html=True,
         )
         token_cols[2].markdown(
-            f'<div class="card"><h4>Prompt volume</h4><div class="card-value">{total_prompt_count()}</div></div>',
+            f'<div class="card"><h4>Prompt volume</h4><div class="card-value">{total_prompts}</div></div>',
             unsafe_allow_html=True,
         )
-        st.markdown("#### Weekly token usage")
-        st.line_chart(build_week_series(estimated_tokens), height=220, use_container_width=True)
+        st.markdown("#### Usage by model")
+        if usage_by_model:
+            st.dataframe(usage_by_model, use_container_width=True, hide_index=True)
+        else:
+            st.write("No usage recorded yet.")
+        start_day, end_day, granularity = activity_range_controls("token_activity")
+        series = activity_series(start_day, end_day, granularity)
+        period_label = "Weekly" if granularity == "Week" else "Daily"
+        st.markdown(f"#### {period_label} token usage")
+        st.line_chart(series, x="bucket", y="tokens", height=220, use_container_width=True)
+
+        st.markdown("#### Prices (USD per million tokens)")
+        with st.form("model_prices_form"):
+            edited_prices = st.data_editor(
+                db_load_model_prices(),
+                use_container_width=True,
+                hide_index=True,
+                num_rows="dynamic",
+                key="model_prices_editor",
+            )
+            if st.form_submit_button("Save prices"):
+                db_save_model_prices(
+                    [
+                        price
+                        for price in edited_prices
+                        if price.get("model")
+                        and price.get("input_per_million") is not None
+                        and price.get("output_per_million") is not None
+                    ]
+                )
+                st.success("Prices saved.")
 
     elif st.session_state.admin_section == "API Logs":
         st.subheader("API Logs")
-        logs = []
-        for message in list(iter_all_messages())[-12:]:
-            logs.append(
+        today = date.today()
+        filter_cols = st.columns([2, 2, 2, 1])
+        selected_range = filter_cols[0].date_input(
+            "Date range", value=(today - timedelta(days=6), today), max_value=today, key="api_logs_range"
+        )
+        if isinstance(selected_range, (tuple, list)):
+            start_day = selected_range[0] if selected_range else today
+            end_day = selected_range[1] if len(selected_range) > 1 else start_day
+        else:
+            start_day = end_day = selected_range
+        selected_models = filter_cols[1].multiselect("Models", db_load_api_call_models())
+        user_options = {"All users": None}
+        user_options.update(
+            {f"{user['name']} ({user_id})": user_id for user_id, user in st.session_state.users.items()}
+        )
+        selected_user = filter_cols[2].selectbox("User", list(user_options))
+        selected_outcome = filter_cols[3].selectbox("Outcome", ["All", "Succeeded", "Failed"])
+        filters = {
+            "start_day": start_day.isoformat(),
+            "end_bound": (end_day + timedelta(days=1)).isoformat(),
+            "models": selected_models,
+            "user_id": user_options[selected_user],
+            "failed": {"All": None, "Succeeded": False, "Failed": True}[selected_outcome],
+        }
+
+        latency = db_load_api_latency_by_model(filters)
+        st.markdown("#### Latency by model")
+        if latency:
+            st.dataframe(
+                [
+                    {
+                        "model": row["model"],
+                        "calls": row["calls"],
+                        "error rate": f"{row['errors'] / row['calls']:.1%}",
+                        "p50 (ms)": round(row["p50_ms"]),
+                        "p95 (ms)": round(row["p95_ms"]),
+                        "p99 (ms)": round(row["p99_ms"]),
+                        "avg TTFT (ms)": round(row["avg_ttft_ms"]) if row["avg_ttft_ms"] is not None else None,
+                    }
+                    for row in latency
+                ],
+                use_container_width=True,
+                hide_index=True,
+            )
+
+        # Changing a filter starts a fresh cursor stack.
+        calls_key = "api_calls_" + hashlib.sha256(json.dumps(filters).encode("utf-8")).hexdigest()[:12]
+        cursors = st.session_state.feed_cursors.setdefault(calls_key, [None])
+        call_rows = db_load_api_calls(filters, API_LOG_PAGE_SIZE + 1, cursors[-1])
+        has_more = len(call_rows) > API_LOG_PAGE_SIZE
+        call_rows = call_rows[:API_LOG_PAGE_SIZE]
+        st.markdown("#### Calls")
+        if call_rows:
+            user_names = {user_id: user["name"] for user_id, user in st.session_state.users.items()}
+            st.dataframe(
+                [
+                    {
+                        "started": row["started_at"],
+                        "kind": row["kind"],
+                        "model": row["model"],
+                        "user": user_names.get(row["user_id"], row["user_id"]),
+                        "conversation": row["conversation_id"],
+                        "TTFT (ms)": round(row["ttft_ms"]) if row["ttft_ms"] is not None else None,
+                        "latency (ms)": round(row["latency_ms"]),
+                        "prompt tokens": row["prompt_tokens"],
+                        "completion tokens": row["completion_tokens"],
+                        "retries": row["retries"],
+                        "HTTP": row["http_status"],
+                        "error": row["error_class"] or "",
+                    }
+                    for row in call_rows
+                ],
+                use_container_width=True,
+                hide_index=True,
+            )
+            feed_pager(calls_key, call_rows, has_more, time_field="started_at")
+        else:
+            st.write("No API calls in this range.")
+
+    elif st.session_state.admin_section == "Routing":
+        st.subheader("Routing")
+        st.caption(
+            "Calls by the routing rule that picked their model. Calls made with a model picked "
+            "by hand are listed as manual."
+        )
+        today = date.today()
+        selected_range = st.date_input(
+            "Date range", value=(today - timedelta(days=6), today), max_value=today, key="routing_range"
+        )
+        if isinstance(selected_range, (tuple, list)):
+            start_day = selected_range[0] if selected_range else today
+            end_day = selected_range[1] if len(selected_range) > 1 else start_day
+        else:
+            start_day = end_day = selected_range
+        filters = {
+            "start_day": start_day.isoformat(),
+            "end_bound": (end_day + timedelta(days=1)).isoformat(),
+        }
+        route_stats = db_load_api_stats_by_route(filters)
+        models_by_route = {}
+        for row in db_load_api_route_models(filters):
+            models_by_route.setdefault(row["route"], []).append(row)
+        total_calls = sum(row["calls"] for row in route_stats)
+        st.markdown("#### Routes")
+        if route_stats:
+            st.dataframe(
+                [
+                    {
+                        "route": row["route"],
+                        "calls": row["calls"],
+                        "share": f"{row['calls'] / total_calls:.0%}",
+                        "models": ", ".join(
+                            f"{model_row['model']} {model_row['calls'] / row['calls']:.0%}"
+                            for model_row in models_by_route.get(row["route"], [])
+                        ),
+                        "error rate": f"{row['errors'] / row['calls']:.1%}",
+                        "p50 (ms)": round(row["p50_ms"]),
+                        "p95 (ms)": round(row["p95_ms"]),
+                        "avg TTFT (ms)": round(row["avg_ttft_ms"]) if row["avg_ttft_ms"] is not None else None,
+                        "avg completion tokens": (
+                            round(row["avg_completion_tokens"])
+                            if row["avg_completion_tokens"] is not None
+                            else None
+                        ),
+                        "cost": f"${row['cost']:,.4f}",
+                        "cost per call": f"${row['cost'] / row['calls']:,.5f}",
+                    }
+                    for row in route_stats
+                ],
+                use_container_width=True,
+                hide_index=True,
+            )
+        else:
+            st.write("No API calls in this range.")
+
+        st.markdown("#### Model health")
+        st.caption("Recent chat calls the router weighs. A model with a problem is skipped for its fallback.")
+        health = model_health.stats()
+        st.dataframe(
+            [
                 {
-                    "role": message["role"],
-                    "content": message["content"][:80] + ("..." if len(message["content"]) > 80 else ""),
+                    "model": model,
+                    "recent calls": health[model]["calls"] if model in health else 0,
+                    "error rate": (
+                        f"{health[model]['errors'] / health[model]['calls']:.1%}" if model in health else ""
+                    ),
+                    "avg TTFT (ms)": (
+                        round(health[model]["avg_ttft_ms"])
+                        if model in health and health[model]["avg_ttft_ms"] is not None
+                        else None
+                    ),
+                    "status": model_health.problem(model) or "healthy",
                 }
+                for model in CHAT_MODELS
+            ],
+            use_container_width=True,
+            hide_index=True,
+        )
+
+        st.markdown("#### Rules")
+        st.caption(
+            "Tried in order; the first rule whose conditions all hold picks the route, so the last "
+            "rule should have none. Routes: "
+            + ", ".join(CHAT_MODELS + ["image"])
+            + ". Conditions: keywords, intents (code, analysis, edit, chat), min/max_prompt_tokens, "
+            "min/max_history_tokens. A rule may name a fallback model. Only image rules apply when "
+            "a model is picked by hand."
+        )
+        router_settings = db_load_settings(ROUTER_DEFAULTS)
+        with st.form("router_rules_form"):
+            rules_text = st.text_area(
+                "Rules (JSON)", value=json.dumps(router_settings["router_rules"], indent=2), height=360
             )
-        if logs:
-            st.dataframe(logs, use_container_width=True, hide_index=True)
+            rule_cols = st.columns([1, 1, 4])
+            save_rules = rule_cols[0].form_submit_button("Save rules")
+            reset_rules = rule_cols[1].form_submit_button("Reset to defaults")
+        if save_rules or reset_rules:
+            if reset_rules:
+                rules, problems = DEFAULT_RULES, []
+            else:
+                try:
+                    rules = json.loads(rules_text)
+                except ValueError as exc:
+                    rules, problems = None, [f"Not valid JSON: {exc}"]
+                else:
+                    problems = validate_rules(rules)
+            if problems:
+                st.error("\n\n".join(problems))
+            else:
+                db_save_settings({"router_rules": rules})
+                st.success("Routing rules saved.")
+
+    elif st.session_state.admin_section == "Search":
+        st.subheader("Search")
+        search_text = st.text_input(
+            "Search all conversations", key="admin_search", placeholder="Words from a message or chat title"
+        ).strip()
+        result = st.session_state.admin_search_result
+        if result is not None:
+            if st.button("← Back to results"):
+                st.session_state.admin_search_result = None
+                st.rerun()
+            owner = st.session_state.users.get(result["user_id"], {}).get("name", result["user_id"])
+            st.markdown(f"#### {result['title']}")
+            st.caption(f"{owner} · {result['user_id']}")
+            if result["message_id"] is None:
+                thread = db_load_messages_after(result["conversation_id"], 0, SEARCH_CONTEXT_AFTER)
+            else:
+                thread = db_load_messages_before(
+                    result["conversation_id"], result["message_id"] + 1, SEARCH_CONTEXT_BEFORE + 1
+                ) + db_load_messages_after(
+                    result["conversation_id"], result["message_id"], SEARCH_CONTEXT_AFTER
+                )
+            for message in thread:
+                with st.chat_message(message["role"]):
+                    if message["id"] == result["message_id"]:
+                        st.caption("🔎 Search match")
+                    if message.get("image_sha256"):
+                        show_stored_image(message)
+                    else:
+                        st.markdown(message["content"])
+        elif search_text:
+            results, page, has_more = search_results("admin_search", search_text, None)
+            if not results:
+                st.info("No matches.")
+            for index, result in enumerate(results):
+                owner = st.session_state.users.get(result["user_id"], {}).get("name", result["user_id"])
+                with st.container(border=True):
+                    result_cols = st.columns([5, 1])
+                    with result_cols[0]:
+                        st.markdown(f"**{result['title']}** · {owner} · {result['created_at']}")
+                        st.caption(result["snippet"])
+                    with result_cols[1]:
+                        if st.button("Open", key=f"admin_search_open_{page}_{index}"):
+                            st.session_state.admin_search_result = result
+                            st.rerun()
+            search_pager(st, "admin_search", page, has_more)
+
+    elif st.session_state.admin_section == "Performance":
+        st.subheader("Performance")
+        if not METRICS_ENABLED:
+            st.info("Timing is turned off. Set CHATBOT_METRICS=1 to collect it.")
         else:
-            st.write("No logs yet.")
+            st.caption(
+                "Timings for this server process since it started or was last reset. "
+                "Percentiles are estimated from histogram buckets."
+            )
+            timing_rows = []
+            for item in registry.snapshot():
+                if not item["count"]:
+                    continue
+                timing_rows.append(
+                    {
+                        "stage": item["name"],
+                        "labels": ", ".join(f"{key}={value}" for key, value in item["labels"].items()),
+                        "count": item["count"],
+                        "mean (ms)": round(item["sum"] / item["count"] * 1000, 1),
+                        "p50 (ms)": round(quantile(item, 0.50) * 1000, 1),
+                        "p95 (ms)": round(quantile(item, 0.95) * 1000, 1),
+                        "p99 (ms)": round(quantile(item, 0.99) * 1000, 1),
+                    }
+                )
+            if timing_rows:
+                st.dataframe(timing_rows, use_container_width=True, hide_index=True)
+            else:
+                st.write("No timings recorded yet.")
+            export_cols = st.columns(3)
+            export_cols[0].download_button(
+                "Prometheus text", prometheus_text(), file_name="metrics.prom", mime="text/plain"
+            )
+            export_cols[1].download_button(
+                "JSON", json_text(), file_name="metrics.json", mime="application/json"
+            )
+            if export_cols[2].button("Reset timings"):
+                registry.reset()
+                st.rerun()
 
     elif st.session_state.admin_section == "Billing":
         st.subheader("Billing")
@@ -916,64 +1543,290 @@ if st.session_state.view_mode == "dashboard" and is_admin:
             '<div class="card"><h4>Workspace</h4><div class="card-value">Branding Marketing Agency</div><div class="subtle">Admin only</div></div>',
             unsafe_allow_html=True,
         )
+        cache_settings = db_load_settings(RESPONSE_CACHE_DEFAULTS)
+        st.markdown("#### Response cache")
+        with st.form("response_cache_form"):
+            cache_enabled = st.toggle(
+                "Reuse answers for repeated prompts",
+                value=cache_settings["response_cache_enabled"],
+            )
+            cache_ttl_hours = st.number_input(
+                "Keep answers for (hours)",
+                min_value=1,
+                value=int(cache_settings["response_cache_ttl_hours"]),
+            )
+            cache_max_mb = st.number_input(
+                "Maximum cache size (MB)",
+                min_value=1,
+                value=int(cache_settings["response_cache_max_mb"]),
+            )
+            if st.form_submit_button("Save cache settings"):
+                db_save_settings(
+                    {
+                        "response_cache_enabled": cache_enabled,
+                        "response_cache_ttl_hours": cache_ttl_hours,
+                        "response_cache_max_mb": cache_max_mb,
+                    }
+                )
+                st.success("Cache settings saved.")
+
+        compaction_settings = db_load_settings(COMPACTION_DEFAULTS)
+        st.markdown("#### Conversation compaction")
+        with st.form("compaction_form"):
+            compaction_enabled = st.toggle(
+                "Summarize the older part of long conversations",
+                value=compaction_settings["compaction_enabled"],
+            )
+            compaction_cols = st.columns(2)
+            compact_after_tokens = compaction_cols[0].number_input(
+                "Compact past (tokens)",
+                min_value=1000,
+                step=1000,
+                value=int(compaction_settings["compact_after_tokens"]),
+            )
+            keep_recent_tokens = compaction_cols[1].number_input(
+                "Keep verbatim (tokens)",
+                min_value=0,
+                step=500,
+                value=int(compaction_settings["keep_recent_tokens"]),
+            )
+            st.caption(
+                "Messages are summarized in the background once a conversation passes the first size. "
+                "The newest messages up to the second size are always sent as they are."
+            )
+            if st.form_submit_button("Save compaction settings"):
+                if keep_recent_tokens >= compact_after_tokens:
+                    st.error("Keep fewer tokens verbatim than the size that starts compaction.")
+                else:
+                    db_save_settings(
+                        {
+                            "compaction_enabled": compaction_enabled,
+                            "compact_after_tokens": int(compact_after_tokens),
+                            "keep_recent_tokens": int(keep_recent_tokens),
+                        }
+                    )
+                    st.success("Compaction settings saved.")
+
+        archive_settings = db_load_settings(ARCHIVE_DEFAULTS)
+        archive_stats = db_load_archive_stats()
+        st.markdown("#### Archive")
+        st.caption(
+            f"Archived chats: {archive_stats['conversations']:,} · messages: {archive_stats['messages']:,} · "
+            f"{archive_disk_bytes() / 1024 / 1024:,.1f} MB of compressed segments under data/archive"
+        )
+        with st.form("archive_form"):
+            archive_enabled = st.toggle(
+                "Archive chats nobody has written in for a while",
+                value=archive_settings["archive_enabled"],
+            )
+            archive_after_days = st.number_input(
+                "Archive after (days idle)",
+                min_value=7,
+                step=30,
+                value=int(archive_settings["archive_after_days"]),
+            )
+            st.caption(
+                "Archived chats keep their place in the chat list and are restored when they are opened. "
+                "Their messages no longer show up in search or the recent activity feed."
+            )
+            if st.form_submit_button("Save archive settings"):
+                db_save_settings(
+                    {
+                        "archive_enabled": archive_enabled,
+                        "archive_after_days": int(archive_after_days),
+                    }
+                )
+                st.success("Archive settings saved.")
+        archive_cols = st.columns([1, 3])
+        if archive_cols[0].button("Archive idle chats now"):
+            archiver.wake()
+            st.toast("Archiving in the background.")
+        if archiver.last_sweep is not None:
+            last_sweep = archiver.last_sweep
+            archive_cols[1].caption(
+                f"Last sweep on this instance: {last_sweep['finished_at']}, "
+                + (f"failed: {last_sweep['error']}" if last_sweep["error"] else f"{last_sweep['archived']} chats archived.")
+            )
+
+    section_span.end()
 else:
     conversation = get_active_conversation(active_user_id)
     if not conversation:
         st.info("Create a new chat to start chatting.")
     else:
-        selected_model = st.selectbox("Model", CHAT_MODELS, index=0)
+        selected_model = st.selectbox("Model", [AUTO_MODEL] + CHAT_MODELS, index=0)
         st.markdown(
             f"**Chatting as** {st.session_state.users[active_user_id]['name']}"
             if is_admin
             else ""
         )
-        for message in conversation["messages"]:
+        history_window = st.session_state.history_window_by_conversation.get(
+            conversation["id"], HISTORY_PAGE_SIZE
+        )
+        if conversation.get("archived_at"):
+            try:
+                with st.spinner("Restoring this chat from the archive..."):
+                    rehydrate_conversation(conversation, history_window)
+            except ArchiveError as exc:
+                st.error(f"This chat could not be restored. {exc}")
+                st.stop()
+        # Only the window on screen is kept in the session, however long the
+        # chat grows while it is open; older messages are read back on demand.
+        trim_messages(conversation, history_window + HISTORY_PAGE_SIZE)
+        messages = conversation["messages"]
+        summary = db_get_conversation_summary(conversation["id"])
+        if summary is not None:
+            with st.expander("Earlier messages are summarized for the model"):
+                st.caption(
+                    f"Updated {summary['updated_at']}. The original messages are kept and load with the earlier messages."
+                )
+                st.markdown(summary["summary"])
+        if len(messages) > history_window or conversation.get("has_earlier"):
+            if st.button("Load earlier messages", key=f"load_earlier_{conversation['id']}"):
+                if len(messages) < history_window + HISTORY_PAGE_SIZE:
+                    load_earlier_messages(
+                        conversation, history_window + HISTORY_PAGE_SIZE - len(messages)
+                    )
+                st.session_state.history_window_by_conversation[conversation["id"]] = (
+                    history_window + HISTORY_PAGE_SIZE
+                )
+                st.rerun()
+        # A reply still being generated (for example after a rerun interrupted
+        # the run that started it) is picked up from its worker.
+        active_job = generation_manager.job_for_conversation(
+            conversation["id"]
+        ) or image_queue.job_for_conversation(conversation["id"])
+        if active_job is not None and active_job.done:
+            active_job = None
+        history_span = start_span("history_render")
+        for message in messages[-history_window:]:
+            if active_job is not None and message.get("id") == active_job.message_id:
+                continue
             with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-
-        if prompt := st.chat_input("Message ChatGPT"):
-            add_message(conversation, "user", prompt)
-            with st.chat_message("user"):
-                st.markdown(prompt)
+                if message.get("id") and message["id"] == st.session_state.search_focus_message_id:
+                    st.caption("🔎 Search match")
+                if message.get("image_sha256"):
+                    show_stored_image(message)
+                else:
+                    st.markdown(message["content"])
+                status = message.get("status", "complete")
+                if status == "streaming" and active_job is None:
+                    # Left behind by a worker that is gone (a restart, or a job
+                    # running in another server process).
+                    status = "interrupted"
+                # A failed image request is reported by its reply text and
+                # cannot be continued as a chat reply.
+                image_failed = message["content"] == IMAGE_FAILED_REPLY
+                if status != "complete" and not image_failed:
+                    st.caption(
+                        "Still generating…" if status == "streaming" else "This reply was interrupted."
+                    )
+                if status in ("failed", "interrupted") and message is messages[-1] and not image_failed:
+                    modes = [("regenerate", "Regenerate")]
+                    if message["content"]:
+                        modes.insert(0, ("continue", "Continue"))
+                    resume_cols = st.columns([1, 1, 4])
+                    for column, (mode, label) in zip(resume_cols, modes):
+                        if column.button(label, key=f"{mode}_{message['id']}"):
+                            resume_reply(
+                                conversation, message, selected_model, active_user_id, mode
+                            )
+                            st.rerun()
+        history_span.end()
+
+        # The input is disabled in the browser while the run that sent a
+        # message streams its reply. It is not drawn disabled while a reply
+        # is attached: Streamlit drops anything sent to a disabled input.
+        prompt = st.chat_input("Message ChatGPT", submit_mode="disable")
+        queued_prompts = st.session_state.queued_prompts.setdefault(conversation["id"], [])
+        if active_job is not None:
+            # A message sent while the reply is still being generated waits
+            # for it instead of being dropped.
+            if prompt:
+                queued_prompts.append(prompt)
+                prompt = None
+            job_container = st.container()
+            notices = st.empty()
+            with notices.container():
+                for queued_prompt in queued_prompts:
+                    st.info(f"Sent once the reply above has finished: {queued_prompt}")
+            with job_container:
+                if isinstance(active_job, ImageJob):
+                    show_image_job(conversation, active_job)
+                else:
+                    show_generation_job(conversation, active_job)
+            notices.empty()
+        if not prompt and queued_prompts:
+            prompt = queued_prompts.pop(0)
+
+        if prompt:
+            job = None
+            image_job = None
+            route = choose_route(conversation, prompt, selected_model)
+            if route["note"]:
+                st.toast(route["note"])
+            with unit_of_work() as turn:
+                add_message(conversation, "user", prompt, turn)
+                with st.chat_message("user"):
+                    st.markdown(prompt)
+
+                if conversation["title"] == "New chat":
+                    conversation["title"] = (
+                        prompt[:42] + "..." if len(prompt) > 45 else prompt
+                    )
+                    turn.add(db_update_conversation_title, conversation["id"], conversation["title"])
 
-            if conversation["title"] == "New chat":
-                conversation["title"] = (
-                    prompt[:42] + "..." if len(prompt) > 45 else prompt
-                )
+                if route["image"]:
+                    image_prompt = prompt.replace("/image", "", 1).strip() or prompt.strip()
+                    image_job = ImageJob(conversation["id"], active_user_id, image_prompt, route["route"])
+                else:
+                    model = route["model"]
+                    context, counted_ids = conversation_context(
+                        conversation["id"], model, [{"role": "user", "content": prompt}]
+                    )
+                    if counted_ids:
+                        turn.add(db_set_message_token_counts, counted_ids)
+
+                    cache_settings = db_load_settings(RESPONSE_CACHE_DEFAULTS)
+                    cache = None
+                    cached_response = None
+                    if cache_settings["response_cache_enabled"]:
+                        cache = {
+                            "key": response_cache_key(model, context),
+                            "cutoff": response_cache_cutoff(cache_settings),
+                            "max_bytes": int(cache_settings["response_cache_max_mb"] * 1024 * 1024),
+                        }
+                        cached_response = db_response_cache_get(cache["key"], cache["cutoff"])
+
+                    if cached_response is not None:
+                        with st.chat_message("assistant"):
+                            response = st.write_stream(replay_text(cached_response))
+                        add_message(conversation, "assistant", response, turn)
+                        turn.add(db_response_cache_touch, cache["key"], now_timestamp())
+                        turn.add(db_increment_counter, "response_cache_hits")
+                    else:
+                        job = GenerationJob(
+                            conversation["id"], active_user_id, model, context, cache, route=route["route"]
+                        )
 
-            if is_image_prompt(prompt):
-                image_prompt = prompt.replace("/image", "", 1).strip() or prompt.strip()
+            # Submitted only once the prompt is committed, so the reply the
+            # worker writes always sorts after it.
+            if job is not None:
+                generation_manager.submit(job, client)
+                show_generation_job(conversation, job)
+            if image_job is None and db_load_settings(COMPACTION_DEFAULTS)["compaction_enabled"]:
+                compactor.request(conversation["id"], active_user_id, client)
+            if image_job is not None:
                 try:
-                    image = client.images.generate(
-                        model="gpt-image-1",
-                        prompt=image_prompt,
-                        size="1024x1024",
-                    )
-                    image_b64 = image.data[0].b64_json
-                    image_bytes = base64.b64decode(image_b64)
-                    with st.chat_message("assistant"):
-                        st.image(image_bytes, caption=image_prompt, use_container_width=True)
-                    add_message(conversation, "assistant", "[image]")
-                except Exception as exc:
+                    image_queue.submit(image_job, client)
+                except ImageQueueFull as exc:
                     with st.chat_message("assistant"):
-                        st.error(f"Image generation failed: {exc}")
-                    add_message(conversation, "assistant", "[image generation failed]")
-            else:
-                stream = client.chat.completions.create(
-                    model=selected_model,
-                    messages=[
-                        {"role": m["role"], "content": m["content"]}
-                        for m in conversation["messages"]
-                    ],
-                    stream=True,
-                )
-
-                with st.chat_message("assistant"):
-                    response = st.write_stream(stream)
-                add_message(conversation, "assistant", response)
+                        st.error(str(exc))
+                    add_message(conversation, "assistant", IMAGE_FAILED_REPLY, status="failed")
+                else:
+                    show_image_job(conversation, image_job)
 
-            st.session_state.users[active_user_id]["message_count"] = user_message_count(
-                active_user_id
-            )
             st.session_state.users[active_user_id]["last_active"] = now_timestamp()
-            db_update_user_activity(active_user_id, st.session_state.users[active_user_id]["last_active"])
+            touch_user_activity(active_user_id, st.session_state.users[active_user_id]["last_active"])
+            if queued_prompts:
+                st.rerun()
@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db  # noqa: E402
+
+# A PostgreSQL database the tests may wipe. When it is set, every database
+# test runs against it as well as against SQLite.
+TEST_DATABASE_URL = os.environ.get("CHATBOT_TEST_DATABASE_URL", "")
+
+def reset_postgres(url: str):
+    psycopg = pytest.importorskip("psycopg")
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+
+# Every test gets an empty database of its own. The db module keeps its
+# backend and per-thread connections in module globals, so those are swapped
+# for fresh ones and put back afterwards.
+@pytest.fixture(params=["sqlite", "postgres"])
+def database(request, tmp_path, monkeypatch):
+    url = ""
+    if request.param == "postgres":
+        if not TEST_DATABASE_URL:
+            pytest.skip("CHATBOT_TEST_DATABASE_URL is not set")
+        url = TEST_DATABASE_URL
+        reset_postgres(url)
+    monkeypatch.setenv("CHATBOT_DB_PATH", str(tmp_path / "chatbot.db"))
+    monkeypatch.setattr(db, "DATABASE_URL", url)
+    monkeypatch.setattr(db, "_backend", None)
+    monkeypatch.setattr(db, "_local", threading.local())
+    monkeypatch.setattr(db, "_held", {})
+    monkeypatch.setattr(db, "_initialized_backends", set())
+    db.init_db()
+    yield db
+    db.flush_api_calls()
+    backend = db.get_backend()
+    for conn in db._held.values():
+        backend.release(conn)
+    if url:
+        backend.pool.close()
+
+@pytest.fixture
+def add_user(database):
+    def add(user_id: str, role: str = "Member", password_hash: str = "") -> dict:
+        user = {
+            "id": user_id,
+            "name": user_id.split("@")[0].title(),
+            "email": user_id,
+            "role": role,
+            "status": "Active",
+            "created_at": db.now_timestamp(),
+            "last_active": db.now_timestamp(),
+            "password_hash": password_hash,
+        }
+        db.db_insert_user(user)
+        return user
+    return add
@@ -0,0 +1,54 @@
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_load_daily_activity,
+    db_load_weekly_active_users,
+    get_db,
+)
+
+def prompt(user_id: str, created_at: str, role: str = "user"):
+    conversation_id = db_create_conversation(user_id, "Chat", created_at)
+    db_add_message(conversation_id, role, "hello", created_at)
+
+def test_daily_activity_counts_prompts_and_members(add_user):
+    add_user("ana@example.com")
+    add_user("ben@example.com")
+    add_user("admin@example.com", role="Admin")
+    prompt("ana@example.com", "2026-03-02 09:00:00")
+    prompt("ana@example.com", "2026-03-02 18:00:00")
+    prompt("ben@example.com", "2026-03-02 23:59:59")
+    prompt("admin@example.com", "2026-03-02 10:00:00")
+    prompt("ben@example.com", "2026-03-03 00:00:00", role="assistant")
+    activity = db_load_daily_activity("2026-03-01", "2026-03-03", "2026-03-10")
+    assert {day: (row["prompt_count"], row["active_users"]) for day, row in activity.items()} == {
+        "2026-03-01": (0, 0),
+        "2026-03-02": (4, 2),
+        "2026-03-03": (0, 0),
+    }
+
+def test_past_days_are_kept_and_today_is_recomputed(add_user):
+    add_user("ana@example.com")
+    prompt("ana@example.com", "2026-03-02 09:00:00")
+    db_load_daily_activity("2026-03-01", "2026-03-03", "2026-03-03")
+    stored = get_db().execute("SELECT day, prompt_count FROM daily_activity ORDER BY day").fetchall()
+    assert [(row["day"], row["prompt_count"]) for row in stored] == [("2026-03-01", 0), ("2026-03-02", 1)]
+    prompt("ana@example.com", "2026-03-03 12:00:00")
+    activity = db_load_daily_activity("2026-03-01", "2026-03-03", "2026-03-03")
+    assert activity["2026-03-03"]["prompt_count"] == 1
+
+def test_weekly_active_users_are_bucketed_by_monday(add_user):
+    add_user("ana@example.com")
+    add_user("ben@example.com")
+    add_user("admin@example.com", role="Admin")
+    # 2026-03-02 is a Monday and 2026-03-08 the Sunday of the same week.
+    prompt("ana@example.com", "2026-03-02 09:00:00")
+    prompt("ana@example.com", "2026-03-08 09:00:00")
+    prompt("ben@example.com", "2026-03-08 22:00:00")
+    prompt("admin@example.com", "2026-03-04 09:00:00")
+    prompt("ben@example.com", "2026-03-09 09:00:00")
+    prompt("ana@example.com", "2026-03-01 09:00:00")
+    assert db_load_weekly_active_users("2026-02-23", "2026-03-15") == {
+        "2026-02-23": 1,
+        "2026-03-02": 2,
+        "2026-03-09": 1,
+    }
@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import openai
+
+from db import db_load_api_calls, db_load_api_latency_by_model, flush_api_calls, log_api_call
+from generation import ApiCall
+
+# Stands in for the client's HTTP status errors, which carry status_code.
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+FILTERS = {"start_day": "2026-03-01", "end_bound": "2026-03-03"}
+
+def call(index: int, **fields) -> dict:
+    return {
+        "kind": "chat",
+        "model": "gpt-4o-mini",
+        "route": None,
+        "user_id": "ana@example.com",
+        "conversation_id": "c1",
+        "started_at": f"2026-03-02 09:{index // 60:02d}:{index % 60:02d}",
+        "ttft_ms": 100.0,
+        "latency_ms": float(index),
+        "prompt_tokens": 10,
+        "completion_tokens": 5,
+        "retries": 0,
+        "http_status": 200,
+        "error_class": None,
+        **fields,
+    }
+
+def test_calls_are_buffered_and_paged_newest_first(database):
+    for index in range(1, 8):
+        log_api_call(call(index, model="gpt-4o" if index % 2 else "gpt-4o-mini"))
+    assert db_load_api_calls(FILTERS, 10) == []
+    flush_api_calls()
+    pages = []
+    before = None
+    while rows := db_load_api_calls({**FILTERS, "models": ["gpt-4o"]}, 2, before):
+        pages.append([row["latency_ms"] for row in rows])
+        before = (rows[-1]["started_at"], rows[-1]["id"])
+    assert pages == [[7.0, 5.0], [3.0, 1.0]]
+
+def test_failed_filter_and_user_filter(database):
+    log_api_call(call(1, error_class="RateLimitError", http_status=429))
+    log_api_call(call(2, user_id="ben@example.com"))
+    log_api_call(call(3))
+    flush_api_calls()
+    assert [row["latency_ms"] for row in db_load_api_calls({**FILTERS, "failed": True}, 10)] == [1.0]
+    assert [row["latency_ms"] for row in db_load_api_calls({**FILTERS, "failed": False}, 10)] == [3.0, 2.0]
+    assert [row["latency_ms"] for row in db_load_api_calls({**FILTERS, "user_id": "ben@example.com"}, 10)] == [2.0]
+
+def test_latency_percentiles_use_the_nearest_rank(database):
+    for index in range(1, 101):
+        log_api_call(call(index, error_class="APIError" if index > 98 else None))
+    flush_api_calls()
+    (stats,) = db_load_api_latency_by_model(FILTERS)
+    assert (stats["calls"], stats["errors"]) == (100, 2)
+    assert (stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]) == (50.0, 95.0, 99.0)
+
+def test_api_call_records_the_outcome(database):
+    client = SimpleNamespace(max_retries=2)
+    ok = ApiCall(client, "chat", "gpt-4o-mini", "ana@example.com", "c1", "short")
+    ok.responded(SimpleNamespace(status_code=200, retries_taken=1))
+    ok.first_token()
+    ok.finish({"prompt_tokens": 10, "completion_tokens": 5})
+    assert ok.record["ttft_ms"] <= ok.record["latency_ms"]
+    assert (ok.record["http_status"], ok.record["retries"], ok.record["route"]) == (200, 1, "short")
+
+    failed = ApiCall(client, "chat", "gpt-4o-mini", "ana@example.com", "c1")
+    failed.finish(error=openai.APIConnectionError(request=None))
+    limited = ApiCall(client, "chat", "gpt-4o-mini", "ana@example.com", "c1")
+    limited.finish(error=StatusError(429))
+    refused = ApiCall(client, "chat", "gpt-4o-mini", "ana@example.com", "c1")
+    refused.finish(error=StatusError(400))
+    flush_api_calls()
+    rows = db_load_api_calls({**FILTERS, "start_day": "2000-01-01", "end_bound": "2100-01-01"}, 10)
+    outcomes = sorted((row["error_class"] or "", row["http_status"] or 0, row["retries"]) for row in rows)
+    assert outcomes == [("", 200, 1), ("APIConnectionError", 0, 2), ("StatusError", 400, 0), ("StatusError", 429, 2)]
@@ -0,0 +1,145 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+from archive import (
+    ArchiveError,
+    archive_conversation,
+    archive_idle_conversations,
+    get_archive_dir,
+    read_record,
+    reclaim_segments,
+    restore_conversation,
+)
+from db import (
+    db_add_message,
+    db_save_settings,
+    db_create_conversation,
+    db_delete_conversation,
+    db_load_archive_stats,
+    db_load_conversation_headers,
+    db_load_conversation_messages,
+    db_load_usage_by_user,
+)
+
+OLD = "2025-01-10 09:00:00"
+CUTOFF = "2025-06-01 00:00:00"
+
+# Each test writes segments of its own, so the shared writer is swapped out.
+@pytest.fixture(autouse=True)
+def writer(monkeypatch):
+    monkeypatch.setattr(archive, "segment_writer", archive.SegmentWriter())
+
+@pytest.fixture
+def chat(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Old plans", OLD)
+    db_add_message(conversation_id, "user", "Plan the winter sale", OLD)
+    db_add_message(conversation_id, "assistant", "Here is a plan", "2025-01-10 09:00:05", image_sha256="ab" * 32)
+    return conversation_id
+
+def archived_entry(conversation_id: str) -> dict:
+    return archive.db_take_archive_entry(conversation_id, archive.now_timestamp())
+
+def test_archived_messages_come_back_unchanged(chat):
+    before = db_load_conversation_messages(chat)
+    usage = db_load_usage_by_user()
+    assert archive_conversation(chat, CUTOFF) == 2
+    assert db_load_conversation_messages(chat) == []
+    assert db_load_archive_stats() == {"conversations": 1, "messages": 2}
+    assert restore_conversation(chat) == 2
+    assert db_load_conversation_messages(chat) == before
+    assert db_load_archive_stats() == {"conversations": 0, "messages": 0}
+    # Restored messages were counted when they were first added.
+    assert db_load_usage_by_user() == usage
+    assert restore_conversation(chat) == 0
+
+def test_recent_or_empty_conversations_are_left_alone(chat):
+    assert archive_conversation(chat, "2025-01-10 09:00:05") == 0
+    empty = db_create_conversation("ana@example.com", "Empty", OLD)
+    assert archive_conversation(empty, CUTOFF) == 0
+    assert os.listdir(get_archive_dir()) == []
+
+def test_headers_show_when_a_conversation_was_archived(chat):
+    archive_conversation(chat, CUTOFF)
+    [header] = db_load_conversation_headers(["ana@example.com"])
+    assert header["id"] == chat and header["archived_at"] is not None
+    restore_conversation(chat)
+    [header] = db_load_conversation_headers(["ana@example.com"])
+    assert header["archived_at"] is None
+
+def test_records_share_a_segment_and_restore_independently(chat):
+    other = db_create_conversation("ana@example.com", "Older plans", OLD)
+    db_add_message(other, "user", "Plan the autumn sale", OLD)
+    archive_conversation(chat, CUTOFF)
+    archive_conversation(other, CUTOFF)
+    assert len(os.listdir(get_archive_dir())) == 1
+    assert restore_conversation(other) == 1
+    assert [m["content"] for m in db_load_conversation_messages(other)] == ["Plan the autumn sale"]
+    assert db_load_archive_stats() == {"conversations": 1, "messages": 2}
+
+def test_damaged_records_are_reported(chat):
+    archive_conversation(chat, CUTOFF)
+    entry = archived_entry(chat)
+    with pytest.raises(ArchiveError, match="has no record"):
+        read_record({**entry, "byte_offset": entry["byte_offset"] + 1})
+    with pytest.raises(ArchiveError, match="another conversation"):
+        read_record({**entry, "conversation_id": "someone-else"})
+    with pytest.raises(ArchiveError, match="cannot be read"):
+        read_record({**entry, "segment": "missing.seg"})
+    path = archive.segment_path(entry["segment"])
+    with open(path, "r+b") as handle:
+        handle.truncate(4)
+    with pytest.raises(ArchiveError, match="truncated"):
+        read_record(entry)
+
+def test_a_failed_restore_keeps_the_archive_entry(chat):
+    archive_conversation(chat, CUTOFF)
+    with open(archive.segment_path(archive.segment_writer._segment), "r+b") as handle:
+        handle.truncate(4)
+    with pytest.raises(ArchiveError):
+        restore_conversation(chat)
+    assert db_load_archive_stats() == {"conversations": 1, "messages": 2}
+    assert db_load_conversation_messages(chat) == []
+
+def test_only_closed_unreferenced_segments_are_reclaimed(chat, monkeypatch):
+    archive_conversation(chat, CUTOFF)
+    referenced = archive.segment_writer._segment
+    stale = f"{datetime.now() - timedelta(days=3):%Y%m%d%H%M%S}-00000000.seg"
+    still_open = f"{datetime.now() + timedelta(days=1):%Y%m%d%H%M%S}-11111111.seg"
+    for segment in (stale, still_open, "notes.txt"):
+        with open(archive.segment_path(segment), "wb") as handle:
+            handle.write(b"x")
+    assert reclaim_segments() == 1
+    assert sorted(os.listdir(get_archive_dir())) == sorted([referenced, still_open, "notes.txt"])
+    # Once its conversation is deleted and its open period is over, the
+    # referenced segment goes too.
+    monkeypatch.setattr(archive, "SEGMENT_OPEN_SECONDS", 0)
+    db_delete_conversation(chat)
+    assert reclaim_segments() == 1
+    assert sorted(os.listdir(get_archive_dir())) == sorted([still_open, "notes.txt"])
+
+def test_sweep_archives_only_idle_conversations(chat):
+    recent = db_create_conversation("ana@example.com", "This week", archive.now_timestamp())
+    db_add_message(recent, "user", "What's new?", archive.now_timestamp())
+    stale = db_create_conversation("ana@example.com", "Picked back up", OLD)
+    db_add_message(stale, "user", "Old question", OLD)
+    db_add_message(stale, "user", "New question", archive.now_timestamp())
+    assert archive_idle_conversations(30) == 1
+    assert db_load_archive_stats() == {"conversations": 1, "messages": 2}
+    assert archive_idle_conversations(30) == 0
+    # A restored conversation is not archived again until it goes idle anew.
+    restore_conversation(chat)
+    assert archive_idle_conversations(30) == 0
+    assert len(db_load_conversation_messages(chat)) == 2
+
+def test_sweeps_archive_nothing_until_an_admin_turns_archiving_on(chat):
+    sweeper = archive.Archiver()
+    sweeper.sweep()
+    assert sweeper.last_sweep is None
+    assert db_load_archive_stats()["conversations"] == 0
+    db_save_settings({"archive_enabled": True})
+    sweeper.sweep()
+    assert sweeper.last_sweep["archived"] == 1
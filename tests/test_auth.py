@@ -0,0 +1,118 @@
+import hashlib
+import time
+
+import pytest
+
+import auth
+from auth import (
+    Authenticator,
+    LoginThrottle,
+    SignInThrottled,
+    end_session,
+    hash_password,
+    issue_session_token,
+    verify_password,
+    verify_session_token,
+)
+from db import db_end_user_sessions, db_get_user, db_upgrade_password_hash
+
+@pytest.fixture(autouse=True)
+def fast_hashing(monkeypatch):
+    monkeypatch.setattr(auth, "PASSWORD_ITERATIONS", 1000)
+    monkeypatch.setattr(auth, "_dummy_hash", None)
+    monkeypatch.setattr(auth, "_secret", b"test secret")
+
+@pytest.fixture
+def authenticator():
+    return Authenticator(workers=1)
+
+def test_password_hashes_are_salted():
+    first, second = hash_password("hunter2"), hash_password("hunter2")
+    assert first != second
+    assert verify_password("hunter2", first) and verify_password("hunter2", second)
+    assert not verify_password("hunter3", first)
+    assert not verify_password("hunter2", "")
+
+def test_sign_in_upgrades_a_legacy_hash(add_user, authenticator):
+    add_user("ana@example.com", password_hash=hashlib.sha256(b"hunter2").hexdigest())
+    assert authenticator.authenticate("ana@example.com", "hunter2")["id"] == "ana@example.com"
+    stored = db_get_user("ana@example.com")["password_hash"]
+    assert stored.startswith("pbkdf2$") and verify_password("hunter2", stored)
+
+def test_unknown_accounts_are_checked_against_a_dummy_hash(database, authenticator, monkeypatch):
+    checked = []
+
+    def check_password(password, password_hash):
+        checked.append(password_hash)
+        return True, None
+
+    monkeypatch.setattr(auth, "check_password", check_password)
+    assert authenticator.authenticate("nobody@example.com", "hunter2") is None
+    assert checked == [auth.dummy_password_hash()]
+    assert checked[0].startswith("pbkdf2$")
+
+def test_failed_attempts_lock_the_account_with_doubling_waits(add_user, authenticator):
+    add_user("ana@example.com", password_hash=hash_password("hunter2"))
+    authenticator.throttle = LoginThrottle(free_attempts=2, max_seconds=60)
+    for _ in range(2):
+        assert authenticator.authenticate("ana@example.com", "wrong") is None
+    assert authenticator.throttle.retry_after("ana@example.com") == 0
+    assert authenticator.authenticate("ana@example.com", "wrong") is None
+    with pytest.raises(SignInThrottled) as first:
+        authenticator.authenticate("ana@example.com", "hunter2")
+    assert 0 < first.value.retry_after <= 1
+    authenticator.throttle._failures["ana@example.com"] = (3, time.monotonic(), time.monotonic())
+    authenticator.authenticate("ana@example.com", "wrong")
+    assert 1 < authenticator.throttle.retry_after("ana@example.com") <= 2
+
+def test_success_clears_the_failures(add_user, authenticator):
+    add_user("ana@example.com", password_hash=hash_password("hunter2"))
+    authenticator.throttle = LoginThrottle(free_attempts=1, max_seconds=60)
+    authenticator.authenticate("ana@example.com", "wrong")
+    assert authenticator.authenticate("ana@example.com", "hunter2") is not None
+    authenticator.authenticate("ana@example.com", "wrong")
+    assert authenticator.throttle.retry_after("ana@example.com") == 0
+
+def test_unknown_accounts_are_throttled_too(database, authenticator):
+    authenticator.throttle = LoginThrottle(free_attempts=0, max_seconds=60)
+    authenticator.authenticate("nobody@example.com", "guess")
+    with pytest.raises(SignInThrottled):
+        authenticator.authenticate("nobody@example.com", "guess")
+
+def test_session_token_round_trip(add_user):
+    add_user("ana@example.com", password_hash=hash_password("hunter2"))
+    token = issue_session_token(db_get_user("ana@example.com"))
+    assert verify_session_token(token)["id"] == "ana@example.com"
+    user_part, expires, session_id, signature = token.split(".")
+    assert verify_session_token(".".join([user_part, str(int(expires) + 1), session_id, signature])) is None
+    assert verify_session_token(".".join([user_part, expires, "other", signature])) is None
+    assert verify_session_token("not a token") is None
+
+def test_expired_session_tokens_are_refused(add_user, monkeypatch):
+    add_user("ana@example.com", password_hash=hash_password("hunter2"))
+    monkeypatch.setattr(auth, "SESSION_TTL_HOURS", -1)
+    assert verify_session_token(issue_session_token(db_get_user("ana@example.com"))) is None
+
+def test_sign_out_ends_only_that_session(add_user):
+    add_user("ana@example.com", password_hash=hash_password("hunter2"))
+    user = db_get_user("ana@example.com")
+    laptop = issue_session_token(user)
+    # A restored session keeps its id, so its earlier tokens end with it.
+    phone = issue_session_token(user)
+    phone_restored = issue_session_token(user, phone.split(".")[2])
+    end_session(phone_restored)
+    assert verify_session_token(phone) is None
+    assert verify_session_token(phone_restored) is None
+    assert verify_session_token(laptop)["id"] == "ana@example.com"
+
+def test_signing_out_everywhere_and_password_change_end_existing_tokens(add_user):
+    add_user("ana@example.com", password_hash=hash_password("hunter2"))
+    user = db_get_user("ana@example.com")
+    token = issue_session_token(user)
+    db_end_user_sessions("ana@example.com")
+    assert verify_session_token(token) is None
+
+    user = db_get_user("ana@example.com")
+    token = issue_session_token(user)
+    db_upgrade_password_hash("ana@example.com", user["password_hash"], hash_password("changed"))
+    assert verify_session_token(token) is None
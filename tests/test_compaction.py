@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import pytest
+
+from compaction import compact_conversation
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_get_conversation_summary,
+    db_load_usage_by_model,
+    db_load_usage_by_user,
+    db_message_tokens_after,
+    db_save_settings,
+    flush_api_calls,
+    get_db,
+)
+
+class FakeClient:
+    max_retries = 0
+
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create))
+        )
+
+    def create(self, model: str, messages: list):
+        self.requests.append(messages)
+        response = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=f" summary {len(self.requests)} "))],
+            usage=SimpleNamespace(prompt_tokens=300, completion_tokens=40),
+        )
+        return SimpleNamespace(status_code=200, retries_taken=0, parse=lambda: response)
+
+@pytest.fixture
+def long_conversation(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    message_ids = [
+        db_add_message(
+            conversation_id,
+            "user" if index % 2 == 0 else "assistant",
+            " ".join(["brand"] * 200),
+            f"2026-03-02 09:{index:02d}:00",
+        )
+        for index in range(20)
+    ]
+    return conversation_id, message_ids
+
+def test_compaction_is_off_by_default(long_conversation):
+    conversation_id, _ = long_conversation
+    client = FakeClient()
+    compact_conversation(conversation_id, "ana@example.com", client)
+    assert client.requests == []
+    assert db_get_conversation_summary(conversation_id) is None
+
+def test_older_messages_are_folded_into_the_summary(long_conversation):
+    conversation_id, message_ids = long_conversation
+    db_save_settings({"compaction_enabled": True, "compact_after_tokens": 2000, "keep_recent_tokens": 1000})
+    client = FakeClient()
+    compact_conversation(conversation_id, "ana@example.com", client)
+    summary = db_get_conversation_summary(conversation_id)
+    assert summary["summary"] == f"summary {len(client.requests)}"
+    # What is left is under the threshold but at least keep_recent_tokens.
+    assert message_ids[0] < summary["through_message_id"] < message_ids[-1]
+    assert 1000 <= db_message_tokens_after(conversation_id, summary["through_message_id"]) <= 2000
+    # The second call folds into the first call's summary.
+    if len(client.requests) > 1:
+        assert "summary 1" in client.requests[1][-1]["content"]
+
+def test_summary_calls_are_recorded_as_their_own_kind(long_conversation):
+    conversation_id, _ = long_conversation
+    db_save_settings({"compaction_enabled": True, "compact_after_tokens": 2000, "keep_recent_tokens": 1000})
+    client = FakeClient()
+    compact_conversation(conversation_id, "ana@example.com", client)
+    calls = len(client.requests)
+    assert calls > 0
+    assert [(row["kind"], row["calls"]) for row in db_load_usage_by_model()] == [("summary", calls)]
+    flush_api_calls()
+    kinds = [row["kind"] for row in get_db().execute("SELECT kind FROM api_calls")]
+    assert kinds == ["summary"] * calls
+    usage = db_load_usage_by_user()["ana@example.com"]
+    assert (usage["prompt_tokens"], usage["completion_tokens"]) == (300 * calls, 40 * calls)
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import pytest
+
+from db import (
+    db_create_conversation,
+    db_load_conversation_messages,
+    db_load_counters,
+    db_load_usage_by_model,
+    db_response_cache_get,
+)
+from generation import GenerationJob, run_chat_job
+
+def chunk(text: str | None = None, usage: tuple | None = None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=text))] if text is not None else [],
+        usage=SimpleNamespace(prompt_tokens=usage[0], completion_tokens=usage[1]) if usage else None,
+    )
+
+class StreamingClient:
+    max_retries = 0
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create))
+        )
+
+    def create(self, **kwargs):
+        return SimpleNamespace(status_code=200, retries_taken=0, parse=lambda: self.stream)
+
+@pytest.fixture
+def conversation_id(add_user):
+    add_user("ana@example.com")
+    return db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+
+def stored(conversation_id: str) -> list:
+    return [(message["content"], message["status"]) for message in db_load_conversation_messages(conversation_id)]
+
+def test_reply_is_written_while_it_streams(conversation_id):
+    seen = []
+
+    def stream():
+        yield chunk("Hello")
+        seen.append(stored(conversation_id))
+        yield chunk(" there")
+        yield chunk(usage=(12, 2))
+
+    job = GenerationJob(conversation_id, "ana@example.com", "gpt-4o-mini", [{"role": "user", "content": "hi"}])
+    run_chat_job(job, StreamingClient(stream()))
+    assert seen == [[("Hello", "streaming")]]
+    assert stored(conversation_id) == [("Hello there", "complete")]
+    assert (job.status, job.message["id"], job.text) == ("complete", job.message_id, "Hello there")
+    assert [(row["kind"], row["prompt_tokens"], row["completion_tokens"]) for row in db_load_usage_by_model()] == [
+        ("chat", 12, 2)
+    ]
+
+def test_a_broken_stream_keeps_what_arrived(conversation_id):
+    def stream():
+        yield chunk("Half")
+        raise ConnectionError("reset")
+
+    job = GenerationJob(conversation_id, "ana@example.com", "gpt-4o-mini", [])
+    run_chat_job(job, StreamingClient(stream()))
+    assert job.status == "failed" and isinstance(job.error, ConnectionError)
+    assert stored(conversation_id) == [("Half", "failed")]
+
+def test_continuing_a_reply_rewrites_its_row(conversation_id):
+    first = GenerationJob(conversation_id, "ana@example.com", "gpt-4o-mini", [])
+    run_chat_job(first, StreamingClient(iter([chunk("Once upon")])))
+    resumed = GenerationJob(
+        conversation_id, "ana@example.com", "gpt-4o-mini", [], message_id=first.message_id, prefix="Once upon"
+    )
+    run_chat_job(resumed, StreamingClient(iter([chunk(" a time")])))
+    assert stored(conversation_id) == [("Once upon a time", "complete")]
+
+def test_complete_replies_fill_the_response_cache(conversation_id):
+    cache = {"key": "k", "cutoff": "2026-01-01 00:00:00", "max_bytes": 1000}
+    job = GenerationJob(conversation_id, "ana@example.com", "gpt-4o-mini", [], cache=cache)
+    run_chat_job(job, StreamingClient(iter([chunk("Cached")])))
+    assert db_response_cache_get("k", "2026-01-01 00:00:00") == "Cached"
+    assert db_load_counters(["response_cache_misses"])["response_cache_misses"] == 1
@@ -0,0 +1,102 @@
+import base64
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from db import db_create_conversation, db_load_conversation_messages, db_load_usage_by_model, get_db
+from generation import ImageJob, ImageQueue, ImageQueueFull
+
+class ImageClient:
+    max_retries = 0
+
+    def __init__(self):
+        self.prompts = []
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+        self.images = SimpleNamespace(with_raw_response=SimpleNamespace(generate=self.generate))
+
+    def generate(self, model: str, prompt: str, size: str):
+        self.prompts.append(prompt)
+        self.started.release()
+        self.release.wait(10)
+        image = SimpleNamespace(
+            data=[SimpleNamespace(b64_json=base64.b64encode(prompt.encode("utf-8")).decode("ascii"))],
+            usage=SimpleNamespace(input_tokens=5, output_tokens=100),
+        )
+        return SimpleNamespace(status_code=200, retries_taken=0, parse=lambda: image)
+
+@pytest.fixture
+def client():
+    client = ImageClient()
+    yield client
+    client.release.set()
+
+@pytest.fixture
+def chats(add_user):
+    def create(user_id: str, count: int) -> list:
+        if get_db().execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone() is None:
+            add_user(user_id)
+        return [db_create_conversation(user_id, "Chat", "2026-03-02 09:00:00") for _ in range(count)]
+    return create
+
+def submit(queue: ImageQueue, client, conversation_id: str, user_id: str, prompt: str) -> ImageJob:
+    return queue.submit(ImageJob(conversation_id, user_id, prompt), client)
+
+def test_identical_prompts_in_flight_share_one_call(client, chats):
+    first_chat, second_chat = chats("ana@example.com", 1) + chats("ben@example.com", 1)
+    queue = ImageQueue(workers=1)
+    first = submit(queue, client, first_chat, "ana@example.com", "A teal logo")
+    client.started.acquire(timeout=5)
+    second = submit(queue, client, second_chat, "ben@example.com", "  a TEAL   logo ")
+    assert second.coalesced and second.task is first.task
+    client.release.set()
+    assert first.wait(5) and second.wait(5)
+    assert client.prompts == ["A teal logo"]
+    assert first.message["image_sha256"] == second.message["image_sha256"]
+    for conversation_id in (first_chat, second_chat):
+        assert [m["content"] for m in db_load_conversation_messages(conversation_id)] == ["[image]"]
+    assert [(row["kind"], row["calls"]) for row in db_load_usage_by_model()] == [("image", 1)]
+
+def test_waiting_requests_take_turns_between_users(client, chats):
+    ana_chats = chats("ana@example.com", 3)
+    ben_chat = chats("ben@example.com", 1)[0]
+    queue = ImageQueue(workers=1)
+    jobs = [submit(queue, client, ana_chats[0], "ana@example.com", "ana 1")]
+    client.started.acquire(timeout=5)
+    jobs += [submit(queue, client, chat, "ana@example.com", f"ana {index}") for index, chat in enumerate(ana_chats[1:], 2)]
+    jobs.append(submit(queue, client, ben_chat, "ben@example.com", "ben 1"))
+    assert [queue.position(job) for job in jobs] == [0, 1, 3, 2]
+    client.release.set()
+    assert all(job.wait(5) for job in jobs)
+    assert client.prompts == ["ana 1", "ana 2", "ben 1", "ana 3"]
+
+def test_full_queues_turn_requests_away(client, chats):
+    ana_chats = chats("ana@example.com", 4)
+    ben_chat = chats("ben@example.com", 1)[0]
+    queue = ImageQueue(workers=1, limit=2, limit_per_user=1)
+    accepted = [submit(queue, client, ana_chats[0], "ana@example.com", "running")]
+    client.started.acquire(timeout=5)
+    accepted.append(submit(queue, client, ana_chats[1], "ana@example.com", "waiting"))
+    with pytest.raises(ImageQueueFull, match="1 images waiting"):
+        submit(queue, client, ana_chats[2], "ana@example.com", "one too many for ana")
+    accepted.append(submit(queue, client, ben_chat, "ben@example.com", "ben's turn"))
+    with pytest.raises(ImageQueueFull, match="queue is full"):
+        submit(queue, client, ana_chats[3], "ana@example.com", "one too many")
+    statuses = get_db().execute("SELECT status, COUNT(*) AS n FROM image_jobs GROUP BY status ORDER BY status")
+    assert [(row["status"], row["n"]) for row in statuses] == [("failed", 2), ("queued", 2), ("running", 1)]
+    client.release.set()
+    assert all(job.wait(5) for job in accepted)
+
+def test_failed_requests_are_stored_as_failed_replies(client, chats):
+    [chat] = chats("ana@example.com", 1)
+
+    def generate(model: str, prompt: str, size: str):
+        raise RuntimeError("content policy")
+
+    client.images.with_raw_response.generate = generate
+    job = submit(ImageQueue(workers=1), client, chat, "ana@example.com", "A teal logo")
+    assert job.wait(5) and job.status == "failed"
+    [message] = db_load_conversation_messages(chat)
+    assert (message["content"], message["status"]) == ("[image generation failed]", "failed")
+    assert job.message["status"] == "failed"
@@ -0,0 +1,43 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from image_store import image_path, store_image, thumbnail_path
+
+@pytest.fixture
+def image_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHATBOT_DB_PATH", str(tmp_path / "chatbot.db"))
+    return tmp_path / "images"
+
+def png(width: int, height: int) -> bytes:
+    Image = pytest.importorskip("PIL.Image")
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), (0, 128, 128)).save(output, format="PNG")
+    return output.getvalue()
+
+def test_images_are_stored_once_under_their_hash(image_dir):
+    data = png(8, 8)
+    sha256 = store_image(data)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert image_path(sha256) == str(image_dir / sha256[:2] / f"{sha256}.png")
+    modified = os.path.getmtime(image_path(sha256))
+    os.utime(image_path(sha256), (modified - 60, modified - 60))
+    assert store_image(data) == sha256
+    assert os.path.getmtime(image_path(sha256)) == modified - 60
+    with open(image_path(sha256), "rb") as handle:
+        assert handle.read() == data
+
+def test_thumbnails_fit_the_configured_size(image_dir):
+    sha256 = store_image(png(1200, 600))
+    from PIL import Image
+
+    assert thumbnail_path(sha256).endswith(".thumb.jpg")
+    with Image.open(thumbnail_path(sha256)) as thumbnail:
+        assert thumbnail.size == (320, 160)
+
+def test_unreadable_images_are_kept_without_a_thumbnail(image_dir):
+    sha256 = store_image(b"not an image")
+    assert thumbnail_path(sha256) == image_path(sha256)
+    assert not [name for name in os.listdir(os.path.dirname(image_path(sha256))) if name.endswith(".tmp")]
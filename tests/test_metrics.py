@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+import metrics
+from metrics import Histogram, json_text, observe, prometheus_text, quantile, span, write_exports
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    metrics.registry.reset()
+    yield metrics.registry
+    metrics.registry.reset()
+
+def test_observations_land_in_the_first_bucket_that_holds_them():
+    histogram = Histogram()
+    for seconds in (0.001, 0.0011, 0.3, 120):
+        histogram.observe(seconds)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 4 and snapshot["sum"] == pytest.approx(120.3021)
+    assert snapshot["counts"][0] == 1
+    assert snapshot["counts"][metrics.BUCKETS.index(0.0025)] == 1
+    assert snapshot["counts"][metrics.BUCKETS.index(0.5)] == 1
+    assert snapshot["counts"][-1] == 1
+
+def test_quantiles_interpolate_within_a_bucket():
+    histogram = Histogram()
+    for _ in range(10):
+        histogram.observe(0.2)
+    assert quantile(histogram.snapshot(), 0.5) == pytest.approx(0.175)
+    histogram.observe(100)
+    assert quantile(histogram.snapshot(), 0.99) == metrics.BUCKETS[-1]
+    assert quantile(Histogram().snapshot(), 0.5) is None
+
+def test_spans_and_observations_are_labelled(registry):
+    with span("history_render"):
+        pass
+    observe("openai_request", 0.3, model="gpt-4o", outcome="ok")
+    observe("openai_request", 0.4, model="gpt-4o", outcome="ok")
+    snapshot = {(item["name"], tuple(item["labels"].items())): item["count"] for item in registry.snapshot()}
+    assert snapshot == {
+        ("history_render", ()): 1,
+        ("openai_request", (("model", "gpt-4o"), ("outcome", "ok"))): 2,
+    }
+
+def test_nothing_is_recorded_when_disabled(registry, monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+    with span("history_render"):
+        pass
+    observe("auth_hash", 0.1)
+    assert registry.snapshot() == []
+
+def test_prometheus_buckets_are_cumulative_and_labels_escaped():
+    observe("auth_hash", 0.02, method='pass"word')
+    observe("auth_hash", 0.2, method='pass"word')
+    lines = prometheus_text().splitlines()
+    assert lines[0] == "# TYPE chatbot_auth_hash_seconds histogram"
+    assert 'chatbot_auth_hash_seconds_bucket{method="pass\\"word",le="0.025"} 1' in lines
+    assert 'chatbot_auth_hash_seconds_bucket{method="pass\\"word",le="0.25"} 2' in lines
+    assert 'chatbot_auth_hash_seconds_bucket{method="pass\\"word",le="+Inf"} 2' in lines
+    assert 'chatbot_auth_hash_seconds_count{method="pass\\"word"} 2' in lines
+
+def test_exports_are_written_next_to_the_database(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHATBOT_DB_PATH", str(tmp_path / "chatbot.db"))
+    observe("auth_hash", 0.02)
+    write_exports()
+    assert (tmp_path / "metrics.prom").read_text(encoding="utf-8") == prometheus_text()
+    assert json.loads((tmp_path / "metrics.json").read_text(encoding="utf-8")) == json.loads(json_text())
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["metrics.json", "metrics.prom"]
@@ -0,0 +1,37 @@
+from db import db_add_message, db_create_conversation, db_load_recent_messages
+
+def walk(limit: int, **filters) -> list:
+    pages = []
+    before = None
+    while True:
+        rows = db_load_recent_messages(limit, before, **filters)
+        if not rows:
+            return pages
+        pages.append([row["content"] for row in rows])
+        before = (rows[-1]["created_at"], rows[-1]["id"])
+
+def test_pages_walk_back_through_rows_sharing_a_timestamp(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    # Written out of time order, and five of them in the same second.
+    for index, created_at in enumerate(
+        ["2026-03-02 09:00:05"] + ["2026-03-02 09:00:03"] * 5 + ["2026-03-02 09:00:04", "2026-03-02 09:00:01"]
+    ):
+        db_add_message(conversation_id, "user", f"m{index}", created_at)
+    assert walk(3) == [["m0", "m6", "m5"], ["m4", "m3", "m2"], ["m1", "m7"]]
+
+def test_filters_apply_to_every_page(add_user):
+    add_user("ana@example.com")
+    add_user("ben@example.com")
+    ana = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    ben = db_create_conversation("ben@example.com", "Chat", "2026-03-02 09:00:00")
+    for minute in range(4):
+        db_add_message(ana, "user", f"ana prompt {minute}", f"2026-03-02 09:0{minute}:00")
+        db_add_message(ana, "assistant", f"ana reply {minute}", f"2026-03-02 09:0{minute}:30")
+        db_add_message(ben, "user", f"ben prompt {minute}", f"2026-03-02 09:0{minute}:10")
+    assert walk(3, role="user", user_ids=["ana@example.com"]) == [
+        ["ana prompt 3", "ana prompt 2", "ana prompt 1"],
+        ["ana prompt 0"],
+    ]
+    rows = db_load_recent_messages(1, role="user")
+    assert (rows[0]["content"], rows[0]["user_name"]) == ("ben prompt 3", "Ben")
@@ -0,0 +1,43 @@
+from db import (
+    db_response_cache_get,
+    db_response_cache_put,
+    db_response_cache_stats,
+    db_response_cache_touch,
+    get_db,
+)
+
+def put(key: str, response: str, created_at: str, cutoff: str = "2026-03-01 00:00:00", max_bytes: int = 1000):
+    db_response_cache_put(key, "gpt-4o-mini", response, created_at, cutoff, max_bytes)
+
+def test_entries_are_served_until_they_expire(database):
+    put("a", "cached answer", "2026-03-02 09:00:00")
+    assert db_response_cache_get("a", "2026-03-02 08:00:00") == "cached answer"
+    assert db_response_cache_get("a", "2026-03-02 10:00:00") is None
+    assert db_response_cache_get("b", "2026-03-02 08:00:00") is None
+
+def test_hits_are_counted(database):
+    put("a", "cached answer", "2026-03-02 09:00:00")
+    db_response_cache_touch("a", "2026-03-02 09:30:00")
+    db_response_cache_touch("a", "2026-03-02 09:45:00")
+    row = get_db().execute("SELECT hits, last_used_at FROM response_cache WHERE key = 'a'").fetchone()
+    assert (row["hits"], row["last_used_at"]) == (2, "2026-03-02 09:45:00")
+
+def test_expired_entries_are_dropped_on_write(database):
+    put("old", "x" * 10, "2026-03-01 09:00:00")
+    put("new", "y" * 10, "2026-03-02 09:00:00", cutoff="2026-03-02 00:00:00")
+    assert db_response_cache_stats() == {"entries": 1, "size": 10}
+
+def test_least_recently_used_entries_go_once_the_cache_is_full(database):
+    put("a", "a" * 400, "2026-03-02 09:00:00")
+    put("b", "b" * 400, "2026-03-02 09:01:00")
+    db_response_cache_touch("a", "2026-03-02 09:02:00")
+    put("c", "c" * 400, "2026-03-02 09:03:00")
+    keys = [row["key"] for row in get_db().execute("SELECT key FROM response_cache ORDER BY key")]
+    assert keys == ["a", "c"]
+    assert db_response_cache_stats() == {"entries": 2, "size": 800}
+
+def test_sizes_are_counted_in_bytes(database):
+    put("a", "é" * 300, "2026-03-02 09:00:00")
+    put("b", "e" * 500, "2026-03-02 09:01:00")
+    assert db_response_cache_get("a", "2026-03-01 00:00:00") is None
+    assert db_response_cache_stats() == {"entries": 1, "size": 500}
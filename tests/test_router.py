@@ -0,0 +1,99 @@
+import pytest
+
+import router
+from db import flush_api_calls, log_api_call, now_timestamp
+from router import AUTO_MODEL, DEFAULT_RULES, ModelHealth, detect_intent, route_prompt, validate_rules
+
+@pytest.fixture
+def health(database, monkeypatch):
+    model_health = ModelHealth(refresh_seconds=0)
+    monkeypatch.setattr(router, "model_health", model_health)
+    return model_health
+
+def record_calls(model: str, calls: int, errors: int = 0, ttft_ms: float = 300.0, kind: str = "chat"):
+    for index in range(calls):
+        log_api_call(
+            {
+                "kind": kind,
+                "model": model,
+                "route": None,
+                "user_id": "ana@example.com",
+                "conversation_id": "c1",
+                "started_at": now_timestamp(),
+                "ttft_ms": ttft_ms,
+                "latency_ms": ttft_ms + 100,
+                "prompt_tokens": 10,
+                "completion_tokens": 5,
+                "retries": 0,
+                "http_status": 500 if index < errors else 200,
+                "error_class": "InternalServerError" if index < errors else None,
+            }
+        )
+    flush_api_calls()
+
+def routed(prompt: str, history_tokens: int = 0, selected_model: str = AUTO_MODEL, rules=DEFAULT_RULES) -> tuple:
+    route = route_prompt(prompt, history_tokens, selected_model, rules)
+    return route["route"], route["model"]
+
+def test_intents_match_whole_words():
+    assert detect_intent("Why is this SQL slow?") == "code"
+    assert detect_intent("Compare these two taglines") == "analysis"
+    assert detect_intent("Please proofread this") == "edit"
+    assert detect_intent("The codec and the planet") == "chat"
+
+def test_default_rules_in_auto_mode(health):
+    assert routed("Draw a picture of a fox") == ("image", None)
+    assert routed("Write a python script that renames files") == ("complex", "gpt-4o")
+    assert routed("word " * 450) == ("long-prompt", "gpt-4o")
+    assert routed("Thanks!", history_tokens=9000) == ("long-history", "gpt-4o")
+    assert routed("Thanks!") == ("default", "gpt-4o-mini")
+
+def test_a_model_picked_by_hand_only_yields_to_image_rules(health):
+    assert routed("Write a python script", selected_model="gpt-4o-mini") == (None, "gpt-4o-mini")
+    route = route_prompt("Make an image of a lighthouse", 0, "gpt-4o-mini", DEFAULT_RULES)
+    assert (route["route"], route["model"], route["image"]) == ("image", None, True)
+
+def test_prompts_no_rule_matches_get_the_default_model(health):
+    rules = [{"name": "short", "route": "gpt-4o", "max_prompt_tokens": 3}]
+    assert routed("hi there", rules=rules) == ("short", "gpt-4o")
+    assert routed("a much longer prompt than three tokens", rules=rules) == ("unmatched", "gpt-4o-mini")
+
+def test_an_unhealthy_model_is_swapped_for_a_healthy_fallback(health):
+    record_calls("gpt-4o", 8, errors=4)
+    route = route_prompt("Compare the two slogans", 0, AUTO_MODEL, DEFAULT_RULES)
+    assert (route["route"], route["model"]) == ("complex", "gpt-4o-mini")
+    assert route["note"] == "gpt-4o skipped: 4 of 8 recent calls failed"
+
+def test_slow_first_tokens_count_as_unhealthy(health):
+    record_calls("gpt-4o", 5, ttft_ms=9000)
+    assert health.problem("gpt-4o") == "first tokens take 9.0 s"
+
+def test_the_model_is_kept_when_the_fallback_is_no_better(health):
+    record_calls("gpt-4o", 8, errors=8)
+    record_calls("gpt-4o-mini", 8, errors=8)
+    assert routed("Compare the two slogans") == ("complex", "gpt-4o")
+
+def test_health_needs_enough_chat_calls(health):
+    record_calls("gpt-4o", 4, errors=4)
+    record_calls("gpt-4o", 10, errors=10, kind="summary")
+    assert health.problem("gpt-4o") is None
+
+def test_rules_are_validated_before_saving():
+    assert validate_rules(DEFAULT_RULES) == []
+    assert validate_rules([]) == ["Rules must be a non-empty list."]
+    assert validate_rules(
+        [
+            {"name": "", "route": "gpt-5"},
+            {"name": "x", "route": "gpt-4o", "fallback": "gpt-3", "min_prompt_tokens": True, "colour": "red"},
+            {"name": "y", "route": "image", "keywords": ["ok", 3]},
+            "not a rule",
+        ]
+    ) == [
+        "Rule 1: needs a name.",
+        "Rule 1: route must be one of gpt-4o, gpt-4o-mini, image.",
+        "x: fallback must be one of gpt-4o, gpt-4o-mini.",
+        "x: min_prompt_tokens must be a int.",
+        "x: unknown condition 'colour'.",
+        "y: keywords must list strings.",
+        "Rule 4 is not an object.",
+    ]
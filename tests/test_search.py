@@ -0,0 +1,75 @@
+import pytest
+
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_delete_conversation,
+    db_search,
+    db_update_conversation_title,
+    db_update_message_content,
+)
+
+@pytest.fixture
+def chats(add_user):
+    add_user("ana@example.com")
+    add_user("ben@example.com")
+    ana = db_create_conversation("ana@example.com", "Spring launch", "2026-03-02 09:00:00")
+    ben = db_create_conversation("ben@example.com", "Logo ideas", "2026-03-02 09:00:00")
+    db_add_message(ana, "user", "Draft the spring campaign email for returning customers", "2026-03-02 09:00:00")
+    db_add_message(ana, "assistant", "Here is a teal logo concept", "2026-03-02 09:00:01")
+    db_add_message(ben, "user", "Three logo concepts in teal and coral", "2026-03-02 09:00:02")
+    return ana, ben
+
+def found(text: str, user_ids: list | None = None) -> set:
+    return {(row["conversation_id"], row["message_id"] is None) for row in db_search(text, user_ids, 50)}
+
+def test_words_match_stemmed_and_all_are_required(chats):
+    ana, ben = chats
+    assert found("campaigns") == {(ana, False)}
+    assert found("teal concepts") == {(ana, False), (ben, False)}
+    assert found("teal coral") == {(ben, False)}
+    assert found("teal purple") == set()
+    assert db_search("   ", None, 10) == []
+
+def test_the_last_word_matches_as_a_prefix(chats):
+    ana, _ = chats
+    assert found("returning cust") == {(ana, False)}
+
+def test_titles_are_searched_too(chats):
+    ana, ben = chats
+    assert found("launch") == {(ana, True)}
+    assert found("logo") == {(ana, False), (ben, False), (ben, True)}
+    db_update_conversation_title(ana, "Autumn relaunch")
+    assert found("spring") == {(ana, False)}
+    assert found("autumn") == {(ana, True)}
+
+def test_results_can_be_limited_to_users(chats):
+    _, ben = chats
+    assert found("teal", ["ben@example.com"]) == {(ben, False)}
+    assert found("teal", []) == set()
+
+def test_streaming_replies_are_indexed_once_finished(chats):
+    ana, _ = chats
+    reply_id = db_add_message(ana, "assistant", "", "2026-03-02 09:01:00", status="streaming")
+    db_update_message_content(reply_id, "A mauve palette", "streaming")
+    assert found("mauve") == set()
+    db_update_message_content(reply_id, "A mauve palette for the summer", "complete")
+    assert [row["message_id"] for row in db_search("mauve summer", None, 10)] == [reply_id]
+
+def test_deleted_chats_leave_the_index(chats):
+    ana, ben = chats
+    db_delete_conversation(ana)
+    assert found("teal") == {(ben, False)}
+    assert found("spring") == set()
+
+def test_pages_neither_repeat_nor_skip_results(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    ids = {
+        db_add_message(conversation_id, "user", "teal logo", "2026-03-02 09:00:00")
+        for _ in range(7)
+    }
+    pages = [db_search("teal", None, 3, offset) for offset in (0, 3, 6)]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    # Equally ranked hits come newest first.
+    assert [row["message_id"] for page in pages for row in page] == sorted(ids, reverse=True)
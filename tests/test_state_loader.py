@@ -0,0 +1,118 @@
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_delete_conversation,
+    db_update_conversation_title,
+    db_update_message_content,
+    now_timestamp,
+)
+from state_loader import empty_state, load_earlier_messages, load_state_from_db
+
+def chat(user_id: str, title: str, messages: int) -> str:
+    conversation_id = db_create_conversation(user_id, title, now_timestamp())
+    for index in range(messages):
+        db_add_message(conversation_id, "user" if index % 2 == 0 else "assistant", f"message {index}", now_timestamp())
+    return conversation_id
+
+def conversation(state, user_id: str, conversation_id: str) -> dict:
+    return next(c for c in state.user_conversations[user_id] if c["id"] == conversation_id)
+
+def test_loads_only_requested_users(add_user):
+    add_user("ana@example.com")
+    add_user("ben@example.com")
+    chat("ana@example.com", "Ana's chat", 2)
+    chat("ben@example.com", "Ben's chat", 2)
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    assert set(state.user_conversations) == {"ana@example.com"}
+    assert [c["title"] for c in state.user_conversations["ana@example.com"]] == ["Ana's chat"]
+
+def test_resync_applies_new_messages_and_conversations(add_user):
+    add_user("ana@example.com")
+    first = chat("ana@example.com", "First", 2)
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    db_add_message(first, "user", "later", now_timestamp())
+    second = chat("ana@example.com", "Second", 1)
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    assert [m["content"] for m in conversation(state, "ana@example.com", first)["messages"]][-1] == "later"
+    assert len(conversation(state, "ana@example.com", second)["messages"]) == 1
+
+def test_resync_refreshes_titles_and_drops_deleted_chats(add_user):
+    add_user("ana@example.com")
+    renamed = chat("ana@example.com", "Old title", 1)
+    deleted = chat("ana@example.com", "Doomed", 1)
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    cached = conversation(state, "ana@example.com", renamed)
+    db_update_conversation_title(renamed, "New title")
+    db_delete_conversation(deleted)
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    assert [c["id"] for c in state.user_conversations["ana@example.com"]] == [renamed]
+    # The loaded dict is kept, messages and all, with the new title.
+    assert conversation(state, "ana@example.com", renamed) is cached
+    assert cached["title"] == "New title"
+    assert len(cached["messages"]) == 1
+
+def test_window_loads_newest_messages_and_pages_back(add_user):
+    add_user("ana@example.com")
+    conversation_id = chat("ana@example.com", "Long", 25)
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    loaded = conversation(state, "ana@example.com", conversation_id)
+    assert [m["content"] for m in loaded["messages"]] == [f"message {i}" for i in range(15, 25)]
+    assert loaded["has_earlier"]
+    load_earlier_messages(loaded, 10)
+    assert [m["content"] for m in loaded["messages"]][:2] == ["message 5", "message 6"]
+    assert loaded["has_earlier"]
+    load_earlier_messages(loaded, 10)
+    assert len(loaded["messages"]) == 25
+    assert not loaded["has_earlier"]
+
+def test_window_of_exactly_the_history_has_nothing_earlier(add_user):
+    add_user("ana@example.com")
+    conversation_id = chat("ana@example.com", "Short", 10)
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    loaded = conversation(state, "ana@example.com", conversation_id)
+    assert len(loaded["messages"]) == 10
+    assert not loaded["has_earlier"]
+
+def test_full_load_reads_whole_history(add_user):
+    add_user("ana@example.com")
+    conversation_id = chat("ana@example.com", "Long", 25)
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    load_state_from_db(state, ["ana@example.com"], window=None)
+    assert len(conversation(state, "ana@example.com", conversation_id)["messages"]) == 25
+
+def test_window_applies_per_conversation(add_user):
+    add_user("ana@example.com")
+    long_id = chat("ana@example.com", "Long", 12)
+    short_id = chat("ana@example.com", "Short", 3)
+    empty_id = chat("ana@example.com", "Empty", 0)
+    db_add_message(long_id, "user", "newest", now_timestamp())
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=5)
+    long_chat = conversation(state, "ana@example.com", long_id)
+    assert [m["content"] for m in long_chat["messages"]] == [
+        "message 8", "message 9", "message 10", "message 11", "newest"
+    ]
+    assert long_chat["has_earlier"]
+    assert len(conversation(state, "ana@example.com", short_id)["messages"]) == 3
+    assert not conversation(state, "ana@example.com", short_id)["has_earlier"]
+    assert conversation(state, "ana@example.com", empty_id)["messages"] == []
+
+def test_resync_follows_a_reply_still_being_streamed(add_user):
+    add_user("ana@example.com")
+    conversation_id = chat("ana@example.com", "Chat", 1)
+    reply_id = db_add_message(conversation_id, "assistant", "", now_timestamp(), status="streaming")
+    db_update_message_content(reply_id, "Half", "streaming")
+    state = empty_state()
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    reply = conversation(state, "ana@example.com", conversation_id)["messages"][-1]
+    assert (reply["content"], reply["status"]) == ("Half", "streaming")
+    db_update_message_content(reply_id, "Half a reply", "complete")
+    load_state_from_db(state, ["ana@example.com"], window=10)
+    assert conversation(state, "ana@example.com", conversation_id)["messages"][-1] is reply
+    assert (reply["content"], reply["status"]) == ("Half a reply", "complete")
@@ -0,0 +1,209 @@
+import threading
+
+import pytest
+
+import db
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_load_conversation_messages,
+    db_load_users,
+    db_search,
+    get_db,
+    write_transaction,
+)
+from storage import PostgresConnection
+
+def test_placeholders_become_psycopg_ones():
+    assert PostgresConnection.translate("SELECT * FROM t WHERE a = ? AND b = ?") == (
+        "SELECT * FROM t WHERE a = %s AND b = %s"
+    )
+    assert PostgresConnection.translate("UPDATE t SET a = :a WHERE id = :id") == (
+        "UPDATE t SET a = %(a)s WHERE id = %(id)s"
+    )
+
+def test_literals_casts_and_percent_signs_are_left_alone():
+    assert PostgresConnection.translate("SELECT 'a?b :c 50%', x::text FROM t WHERE y LIKE ?") == (
+        "SELECT 'a?b :c 50%%', x::text FROM t WHERE y LIKE %s"
+    )
+    assert PostgresConnection.translate("SELECT 'it''s ?' WHERE a = ?") == "SELECT 'it''s ?' WHERE a = %s"
+
+def test_sqlite_only_syntax_is_rewritten():
+    assert PostgresConnection.translate("SELECT value FROM json_each(?)") == (
+        "SELECT value FROM json_array_elements_text(%s::json)"
+    )
+    assert PostgresConnection.translate("SELECT value FROM json_each(:ids)") == (
+        "SELECT value FROM json_array_elements_text(%(ids)s::json)"
+    )
+    assert PostgresConnection.translate(
+        "CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, n INTEGER, r REAL)"
+    ) == "CREATE TABLE t (id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY, n BIGINT, r DOUBLE PRECISION)"
+
+def test_schema_set_up_twice_is_unchanged(add_user, monkeypatch):
+    add_user("ana@example.com")
+    backend = db.get_backend()
+    columns = {table: backend.columns(get_db(), table) for table in ("users", "messages", "api_usage")}
+    monkeypatch.setattr(db, "_initialized_backends", set())
+    db.init_db()
+    assert {table: backend.columns(get_db(), table) for table in columns} == columns
+    assert list(db_load_users()) == ["ana@example.com"]
+
+def test_id_lists_are_bound_as_one_parameter(add_user):
+    for user_id in ("ana@example.com", "bo@example.com", "o'hara@example.com"):
+        add_user(user_id)
+    assert sorted(db_load_users(["o'hara@example.com", "ana@example.com", "nobody"])) == [
+        "ana@example.com",
+        "o'hara@example.com",
+    ]
+    assert db_load_users([]) == {}
+
+def test_ids_are_returned_by_inserts(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    first = db_add_message(conversation_id, "user", "hello", "2026-03-02 09:00:00")
+    second = db_add_message(conversation_id, "assistant", "hi", "2026-03-02 09:00:01")
+    assert second > first
+    assert [message["id"] for message in db_load_conversation_messages(conversation_id)] == [first, second]
+
+def test_search_operators_typed_by_users_are_literal(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    db_add_message(conversation_id, "user", "teal logo for the spring campaign", "2026-03-02 09:00:00")
+    for text in ("teal & !logo", 'teal "logo', "teal | (logo", "teal:* OR NOT logo", "logo's"):
+        db_search(text, None, 10)
+    assert [row["snippet"] for row in db_search("spring camp", None, 10)] == [
+        "teal logo for the **spring** **campaign**"
+    ]
+
+def test_postgres_writers_wait_for_other_instances(add_user):
+    backend = db.get_backend()
+    if backend.dialect != "postgres":
+        pytest.skip("PostgreSQL only")
+    import psycopg
+
+    add_user("ana@example.com")
+    created = []
+    writer = threading.Thread(
+        target=lambda: created.append(db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00"))
+    )
+    # Another instance holds the write lock.
+    with psycopg.connect(db.DATABASE_URL, autocommit=True) as other:
+        other.execute("BEGIN")
+        other.execute("SELECT pg_advisory_xact_lock(%s)", (backend.WRITE_LOCK_ID,))
+        writer.start()
+        writer.join(timeout=0.5)
+        assert writer.is_alive()
+        other.execute("COMMIT")
+    writer.join()
+    assert len(created) == 1
+
+def test_postgres_write_lock_is_held_until_commit(database):
+    backend = db.get_backend()
+    if backend.dialect != "postgres":
+        pytest.skip("PostgreSQL only")
+    import psycopg
+
+    with psycopg.connect(db.DATABASE_URL, autocommit=True) as other:
+        with write_transaction():
+            locked = other.execute("SELECT pg_try_advisory_lock(%s)", (backend.WRITE_LOCK_ID,)).fetchone()[0]
+        assert not locked
+        unlocked = other.execute("SELECT pg_try_advisory_lock(%s)", (backend.WRITE_LOCK_ID,)).fetchone()[0]
+        assert unlocked
+        other.execute("SELECT pg_advisory_unlock(%s)", (backend.WRITE_LOCK_ID,))
+
+def test_sqlite_connections_use_wal_and_wait_when_busy(database):
+    if db.get_backend().dialect != "sqlite":
+        pytest.skip("SQLite only")
+    conn = get_db()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == db.BUSY_TIMEOUT_MS
+    assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+def test_sqlite_writers_wait_for_other_processes(add_user):
+    if db.get_backend().dialect != "sqlite":
+        pytest.skip("SQLite only")
+    import sqlite3
+
+    add_user("ana@example.com")
+    created = []
+    writer = threading.Thread(
+        target=lambda: created.append(db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00"))
+    )
+    # Another process holds the write lock.
+    other = sqlite3.connect(db.get_db_path(), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    writer.start()
+    writer.join(timeout=0.5)
+    assert writer.is_alive()
+    other.execute("COMMIT")
+    other.close()
+    writer.join()
+    assert len(created) == 1
+
+def test_threads_keep_a_connection_and_hand_it_back_when_done(database):
+    if db.get_backend().dialect != "sqlite":
+        pytest.skip("SQLite only")
+    seen = []
+
+    def use_connection():
+        seen.append(get_db())
+        seen.append(get_db())
+
+    first = threading.Thread(target=use_connection)
+    first.start()
+    first.join()
+    assert seen[0] is seen[1] and seen[0] is not get_db()
+    second = threading.Thread(target=use_connection)
+    second.start()
+    second.join()
+    assert seen[2] is seen[0]
+
+def test_postgres_threads_hold_no_connection_between_statements(add_user):
+    backend = db.get_backend()
+    if backend.dialect != "postgres":
+        pytest.skip("PostgreSQL only")
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    # More threads than the pool has connections stay alive between their
+    # statements, as the generation workers and streaming threads do.
+    workers = backend.pool.max_size + 5
+    between = threading.Barrier(workers, timeout=20)
+    errors = []
+
+    def work(worker: int):
+        try:
+            for n in range(2):
+                db_add_message(conversation_id, "user", f"message {worker}-{n}", "2026-03-02 09:00:01")
+                db_load_conversation_messages(conversation_id)
+                between.wait()
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(db_load_conversation_messages(conversation_id)) == workers * 2
+    assert db._held == {}
+
+def test_concurrent_writers_all_succeed(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    errors = []
+
+    def send(worker: int):
+        try:
+            for n in range(10):
+                db_add_message(conversation_id, "user", f"message {worker}-{n}", "2026-03-02 09:00:01")
+        except Exception as exc:
+            errors.append(exc)
+
+    workers = [threading.Thread(target=send, args=(worker,)) for worker in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert errors == []
+    assert len(db_load_conversation_messages(conversation_id)) == 80
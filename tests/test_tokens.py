@@ -0,0 +1,88 @@
+import pytest
+
+import tokens
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_iter_message_history_desc,
+    db_message_tokens_after,
+    db_update_message_content,
+)
+from tokens import MESSAGE_TOKEN_OVERHEAD, SUMMARY_PREFIX, build_context, count_tokens
+
+@pytest.fixture(autouse=True)
+def small_budget(monkeypatch):
+    # 100 tokens of context once the completion reserve is taken off.
+    monkeypatch.setitem(tokens.CONTEXT_TOKEN_BUDGETS, "test-model", 100 + tokens.COMPLETION_TOKEN_RESERVE)
+
+def history(*token_counts: int) -> list:
+    # Newest first, as db_iter_message_history_desc yields it.
+    return [
+        {"id": index, "role": "user", "content": f"m{index}", "token_count": token_count}
+        for index, token_count in reversed(list(enumerate(token_counts, 1)))
+    ]
+
+def test_newest_whole_messages_that_fit_are_kept_in_order():
+    pending = [{"role": "user", "content": "next"}]
+    pending_tokens = count_tokens("next") + MESSAGE_TOKEN_OVERHEAD
+    fits = 100 - pending_tokens - 2 * MESSAGE_TOKEN_OVERHEAD
+    context, counted_ids = build_context(history(5, fits - 10, 10), "test-model", pending)
+    assert [message["content"] for message in context] == ["m2", "m3", "next"]
+    assert counted_ids == {}
+
+def test_history_stops_at_the_first_message_that_does_not_fit():
+    context, _ = build_context(history(1, 200, 1), "test-model")
+    assert [message["content"] for message in context] == ["m3"]
+
+def test_pending_messages_are_always_sent():
+    pending = [{"role": "user", "content": "word " * 500}]
+    context, _ = build_context(history(1), "test-model", pending)
+    assert context == pending
+
+def test_summary_leads_and_counts_against_the_budget():
+    summary_tokens = count_tokens(SUMMARY_PREFIX + "notes") + MESSAGE_TOKEN_OVERHEAD
+    room = 100 - summary_tokens - MESSAGE_TOKEN_OVERHEAD
+    context, _ = build_context(history(1, room), "test-model", summary="notes")
+    assert context[0] == {"role": "system", "content": SUMMARY_PREFIX + "notes"}
+    assert [message["content"] for message in context[1:]] == ["m2"]
+
+def test_uncounted_messages_are_counted_and_reported():
+    messages = history(3)
+    messages[0]["token_count"] = None
+    messages[0]["content"] = "a few words here"
+    _, counted_ids = build_context(messages, "test-model")
+    assert counted_ids == {1: count_tokens("a few words here")}
+
+def test_image_placeholders_are_left_out():
+    messages = history(3, 3)
+    messages[0]["content"] = "[image]"
+    context, _ = build_context(messages, "test-model")
+    assert [message["content"] for message in context] == ["m1"]
+
+def test_history_is_read_newest_first_across_pages(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    ids = [
+        db_add_message(conversation_id, "user", f"message {index}", f"2026-03-02 09:00:{index:02d}")
+        for index in range(7)
+    ]
+    streaming_id = db_add_message(conversation_id, "assistant", "", "2026-03-02 09:01:00", status="streaming")
+    db_update_message_content(streaming_id, "partial", "streaming")
+    rows = list(db_iter_message_history_desc(conversation_id, page_size=3))
+    assert [row["id"] for row in rows] == ids[::-1]
+    assert all(row["token_count"] == count_tokens(row["content"]) for row in rows)
+    rows = list(db_iter_message_history_desc(conversation_id, page_size=2, before_id=ids[5], after_id=ids[1]))
+    assert [row["id"] for row in rows] == [ids[4], ids[3], ids[2]]
+
+def test_conversation_size_counts_every_finished_message(add_user):
+    add_user("ana@example.com")
+    conversation_id = db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+    ids = [
+        db_add_message(conversation_id, "user", f"message number {index}", "2026-03-02 09:00:00")
+        for index in range(80)
+    ]
+    db_add_message(conversation_id, "assistant", "partial", "2026-03-02 09:01:00", status="streaming")
+    counts = [count_tokens(f"message number {index}") for index in range(80)]
+    assert db_message_tokens_after(conversation_id, 0) == sum(counts)
+    assert db_message_tokens_after(conversation_id, 0, ids[10]) == sum(counts[:10])
+    assert db_message_tokens_after(conversation_id, ids[9], ids[20]) == sum(counts[10:20])
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+import db
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_load_conversation_messages,
+    db_load_usage_by_user,
+    unit_of_work,
+    write_transaction,
+)
+
+@pytest.fixture
+def conversation_id(add_user):
+    add_user("ana@example.com")
+    return db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+
+def contents(conversation_id: str) -> list:
+    return [message["content"] for message in db_load_conversation_messages(conversation_id)]
+
+def test_nested_transactions_commit_with_the_outermost(conversation_id):
+    with write_transaction():
+        db_add_message(conversation_id, "user", "first", "2026-03-02 09:00:00")
+        with write_transaction():
+            db_add_message(conversation_id, "assistant", "second", "2026-03-02 09:00:01")
+    assert contents(conversation_id) == ["first", "second"]
+
+def test_failure_rolls_back_every_nested_write(conversation_id):
+    with pytest.raises(RuntimeError):
+        with write_transaction():
+            db_add_message(conversation_id, "user", "first", "2026-03-02 09:00:00")
+            with write_transaction():
+                db_add_message(conversation_id, "assistant", "second", "2026-03-02 09:00:01")
+            raise RuntimeError("interrupted")
+    assert contents(conversation_id) == []
+    assert "ana@example.com" not in db_load_usage_by_user()
+    # The depth is reset, so the next write commits on its own.
+    db_add_message(conversation_id, "user", "again", "2026-03-02 09:01:00")
+    assert contents(conversation_id) == ["again"]
+
+def test_unit_of_work_flushes_queued_writes_in_order(conversation_id):
+    ids = []
+    with unit_of_work() as unit:
+        unit.add(db_add_message, conversation_id, "user", "question", "2026-03-02 09:00:00", on_done=ids.append)
+        unit.add(db_add_message, conversation_id, "assistant", "answer", "2026-03-02 09:00:01", on_done=ids.append)
+        assert contents(conversation_id) == []
+    assert contents(conversation_id) == ["question", "answer"]
+    assert ids == sorted(ids) and len(ids) == 2
+
+def test_unit_of_work_flushes_when_the_script_is_interrupted(conversation_id):
+    with pytest.raises(KeyboardInterrupt):
+        with unit_of_work() as unit:
+            unit.add(db_add_message, conversation_id, "user", "question", "2026-03-02 09:00:00")
+            raise KeyboardInterrupt
+    assert contents(conversation_id) == ["question"]
+
+def test_unit_of_work_writes_all_or_nothing(conversation_id):
+    def fail():
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError):
+        with unit_of_work() as unit:
+            unit.add(db_add_message, conversation_id, "user", "question", "2026-03-02 09:00:00")
+            unit.add(fail)
+    assert contents(conversation_id) == []
+
+def test_writers_on_other_threads_wait_for_the_open_transaction(conversation_id):
+    started = threading.Event()
+
+    def write():
+        started.set()
+        db_add_message(conversation_id, "assistant", "other thread", "2026-03-02 09:00:02")
+
+    with write_transaction():
+        db_add_message(conversation_id, "user", "this thread", "2026-03-02 09:00:00")
+        thread = threading.Thread(target=write)
+        thread.start()
+        started.wait()
+        thread.join(timeout=0.2)
+        assert thread.is_alive()
+    thread.join()
+    assert contents(conversation_id) == ["this thread", "other thread"]
+
+def test_activity_writer_keeps_the_latest_time_per_user(add_user):
+    add_user("ana@example.com")
+    writer = db.ActivityWriter(interval=3600)
+    writer._thread = object()  # flushed by hand below
+    writer.touch("ana@example.com", "2099-03-02 09:05:00")
+    writer.touch("ana@example.com", "2099-03-02 09:01:00")
+    writer.flush()
+    assert db.db_load_users(["ana@example.com"])["ana@example.com"]["last_active"] == "2099-03-02 09:05:00"
@@ -0,0 +1,147 @@
+import pytest
+
+import db
+from db import (
+    db_add_message,
+    db_create_conversation,
+    db_load_daily_token_usage,
+    db_load_usage_by_model,
+    db_load_usage_by_user,
+    db_record_api_usage,
+    db_update_message_content,
+    get_db,
+    rebuild_usage_counters,
+    write_transaction,
+)
+
+@pytest.fixture
+def conversation_id(add_user):
+    add_user("ana@example.com")
+    return db_create_conversation("ana@example.com", "Chat", "2026-03-02 09:00:00")
+
+def record(
+    conversation_id: str,
+    prompt: int,
+    completion: int,
+    created_at: str,
+    user_id: str = "ana@example.com",
+    model: str = "gpt-4o-mini",
+):
+    db_record_api_usage(
+        {
+            "message_id": None,
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "kind": "chat",
+            "model": model,
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "created_at": created_at,
+        }
+    )
+
+def counters(user_id: str = "ana@example.com") -> dict:
+    usage = db_load_usage_by_user()[user_id]
+    return {key: usage[key] for key in ("message_count", "prompt_count", "char_count", "prompt_tokens", "completion_tokens")}
+
+def test_messages_count_once_and_streamed_text_by_its_growth(conversation_id):
+    db_add_message(conversation_id, "user", "hello", "2026-03-02 09:00:00")
+    reply_id = db_add_message(conversation_id, "assistant", "", "2026-03-02 09:00:01", status="streaming")
+    db_update_message_content(reply_id, "partial", "streaming")
+    db_update_message_content(reply_id, "partial reply", "complete")
+    assert counters() == {
+        "message_count": 2,
+        "prompt_count": 1,
+        "char_count": len("hello") + len("partial reply"),
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+    }
+
+def test_tokens_come_from_recorded_usage(conversation_id):
+    db_add_message(conversation_id, "user", "x" * 400, "2026-03-02 09:00:00")
+    record(conversation_id, 120, 30, "2026-03-02 09:00:02")
+    record(conversation_id, 80, 20, "2026-03-03 10:00:00")
+    usage = counters()
+    assert (usage["prompt_tokens"], usage["completion_tokens"]) == (200, 50)
+    assert db_load_daily_token_usage("2026-03-01", "2026-03-03") == {"2026-03-02": 150, "2026-03-03": 100}
+
+def test_usage_of_unknown_users_is_kept_out_of_the_counters(conversation_id):
+    record(conversation_id, 10, 5, "2026-03-02 09:00:00", user_id="gone@example.com")
+    assert "gone@example.com" not in db_load_usage_by_user()
+    assert get_db().execute("SELECT COUNT(*) AS n FROM api_usage").fetchone()["n"] == 1
+
+def test_rebuild_matches_incremental_counters(conversation_id):
+    db_add_message(conversation_id, "user", "hello", "2026-03-02 09:00:00")
+    db_add_message(conversation_id, "assistant", "hi there", "2026-03-02 09:00:01")
+    record(conversation_id, 12, 7, "2026-03-02 09:00:01")
+    incremental = counters()
+    by_day = get_db().execute("SELECT * FROM usage_by_day ORDER BY day").fetchall()
+    with write_transaction() as conn:
+        rebuild_usage_counters(conn)
+    assert counters() == incremental
+    assert [dict(row) for row in get_db().execute("SELECT * FROM usage_by_day ORDER BY day")] == [
+        dict(row) for row in by_day
+    ]
+
+def by_model() -> list:
+    return [
+        (row["kind"], row["model"], row["calls"], row["prompt_tokens"], row["completion_tokens"], round(row["cost"], 6))
+        for row in db_load_usage_by_model()
+    ]
+
+def test_usage_by_model_is_kept_as_calls_are_recorded(conversation_id, monkeypatch):
+    record(conversation_id, 1000000, 0, "2026-03-02 09:00:00", model="gpt-4o")
+    record(conversation_id, 0, 1000000, "2026-03-02 09:00:01", model="gpt-4o")
+    record(conversation_id, 1000000, 0, "2026-03-02 09:00:02", user_id="gone@example.com")
+    recorded = by_model()
+    assert recorded == [
+        ("chat", "gpt-4o", 2, 1000000, 1000000, 12.5),
+        ("chat", "gpt-4o-mini", 1, 1000000, 0, 0.15),
+    ]
+    # Databases from before the rollup get it filled in from api_usage.
+    with write_transaction() as conn:
+        conn.execute("DROP TABLE usage_by_model")
+    monkeypatch.setattr(db, "_initialized_backends", set())
+    db.init_db()
+    assert by_model() == recorded
+
+def test_char_estimated_token_columns_are_migrated(conversation_id, monkeypatch):
+    db_add_message(conversation_id, "user", "hello", "2026-03-02 09:00:00")
+    record(conversation_id, 12, 7, "2026-03-02 09:00:01")
+    with write_transaction() as conn:
+        for table in ("usage_by_user", "usage_by_day"):
+            conn.execute(f"ALTER TABLE {table} DROP COLUMN prompt_tokens")
+            conn.execute(f"ALTER TABLE {table} DROP COLUMN completion_tokens")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0")
+        conn.execute("ALTER TABLE daily_activity ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0")
+    monkeypatch.setattr(db, "_initialized_backends", set())
+    db.init_db()
+    backend = db.get_backend()
+    for table in ("usage_by_user", "usage_by_day", "daily_activity"):
+        assert "token_count" not in backend.columns(get_db(), table)
+    usage = counters()
+    assert (usage["message_count"], usage["prompt_tokens"], usage["completion_tokens"]) == (1, 12, 7)
+
+def test_usage_from_before_kinds_is_labelled_from_its_message(conversation_id, monkeypatch):
+    image_id = db_add_message(conversation_id, "assistant", "[image]", "2026-03-02 09:00:00", image_sha256="ab" * 32)
+    reply_id = db_add_message(conversation_id, "assistant", "hi", "2026-03-02 09:00:01")
+    for message_id in (image_id, reply_id):
+        db_record_api_usage(
+            {
+                "message_id": message_id,
+                "user_id": "ana@example.com",
+                "conversation_id": conversation_id,
+                "kind": "chat",
+                "model": "gpt-4o-mini",
+                "prompt_tokens": 1,
+                "completion_tokens": 1,
+                "created_at": "2026-03-02 09:00:01",
+            }
+        )
+    with write_transaction() as conn:
+        conn.execute("ALTER TABLE api_usage DROP COLUMN kind")
+    monkeypatch.setattr(db, "_initialized_backends", set())
+    db.init_db()
+    kinds = get_db().execute("SELECT message_id, kind FROM api_usage ORDER BY message_id").fetchall()
+    assert [(row["message_id"], row["kind"]) for row in kinds] == [(image_id, "image"), (reply_id, "chat")]
+    assert sorted(row[:3] for row in by_model()) == [("chat", "gpt-4o-mini", 1), ("image", "gpt-4o-mini", 1)]
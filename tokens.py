@@ -0,0 +1,84 @@
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token budget for the history sent with each chat turn, per model. This is a
+# cost and latency limit, well below the models' context windows.
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-4o": 12000,
+    "gpt-4o-mini": 24000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 8000
+# Room left in the context window for the model's reply.
+COMPLETION_TOKEN_RESERVE = 1000
+# Chat formatting adds a few tokens around every message.
+MESSAGE_TOKEN_OVERHEAD = 4
+# Both chat models use o200k_base, so counts stored per message are valid for
+# either of them.
+TOKENIZER_ENCODING = "o200k_base"
+
+# Introduces a compacted conversation's summary to the model.
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation:\n"
+
+# Assistant placeholders for image turns carry nothing the chat model can use.
+NON_CONTEXT_CONTENT = ("[image]", "[image generation failed]")
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                if tiktoken is not None:
+                    try:
+                        _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                    except Exception:
+                        # The BPE file is fetched on first use; without it we
+                        # fall back to the character estimate below.
+                        _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def context_token_budget(model: str) -> int:
+    return CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET) - COMPLETION_TOKEN_RESERVE
+
+# Walks history newest first and keeps whole messages until the budget is
+# spent. Messages without a stored count are counted here and reported back in
+# counted_ids so the caller can persist them. The pending messages (the new
+# prompt) are always included, and so is the summary of the messages before
+# the history, when the conversation has been compacted.
+def build_context(history_desc, model: str, pending: list = (), summary: str | None = None):
+    budget = context_token_budget(model)
+    used = sum(count_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD for message in pending)
+    preamble = []
+    if summary:
+        preamble = [{"role": "system", "content": SUMMARY_PREFIX + summary}]
+        used += count_tokens(preamble[0]["content"]) + MESSAGE_TOKEN_OVERHEAD
+    selected = []
+    counted_ids = {}
+    for message in history_desc:
+        if message["content"] in NON_CONTEXT_CONTENT:
+            continue
+        token_count = message.get("token_count")
+        if token_count is None:
+            token_count = count_tokens(message["content"])
+            counted_ids[message["id"]] = token_count
+        if used + token_count + MESSAGE_TOKEN_OVERHEAD > budget:
+            break
+        used += token_count + MESSAGE_TOKEN_OVERHEAD
+        selected.append({"role": message["role"], "content": message["content"]})
+    selected.reverse()
+    selected.extend({"role": message["role"], "content": message["content"]} for message in pending)
+    return preamble + selected, counted_ids